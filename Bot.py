@@ -4,6 +4,7 @@ import asyncio
 import math
 import subprocess
 import shutil
+import signal
 from pathlib import Path
 from collections import deque
 import yaml
@@ -13,11 +14,36 @@ import time
 import threading
 import uuid
 import glob
+import contextlib
+import hashlib
+import json
+import sqlite3
+import contextvars
+import socket
+import argparse
+import importlib.util
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+try:
+    import fcntl
+except ImportError:
+    # Windows: блокировка файлов через msvcrt
+    fcntl = None
+    import msvcrt
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
-from aiogram.types import FSInputFile
+from aiogram.types import FSInputFile, InputFile
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import SendMessage
+import aiohttp
+from aiohttp import web
 import yt_dlp
+from yt_dlp.networking import Request
+from yt_dlp.networking.exceptions import HTTPError, RequestError
 
 
 # Логи в UTF-8, чтобы на Windows не было кракозябр
@@ -29,35 +55,1332 @@ logging.root.setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- Конфиг ---
-config_path = Path(__file__).parent / "config.yaml"
+# BOT_CONFIG позволяет подсунуть другой конфиг (бенчмарки, отладка)
+config_path = Path(os.environ.get("BOT_CONFIG") or Path(__file__).parent / "config.yaml")
 if not config_path.exists():
     raise FileNotFoundError("Файл config.yaml не найден")
 with open(config_path, encoding="utf-8") as f:
     cfg = yaml.safe_load(f)
 
 TOKEN = cfg.get("telegram_token")
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка из bench/), по умолчанию — api.telegram.org
+TELEGRAM_API_SERVER = cfg.get("telegram_api_server")
 SEGMENT_MS = cfg.get("segment_length_ms", 10 * 60 * 1000)
 SEGMENT_S = SEGMENT_MS // 1000
 SPEED_OPTIONS = cfg.get("speed_options", [1.0, 1.25, 1.5, 1.75, 2.0])
+# Сколько закодированных, но ещё не отправленных сегментов может лежать в work_dir
+SEGMENT_PREFETCH = max(1, int(cfg.get("segment_prefetch", 2)))
+# Потолок по диску для таких сегментов; при превышении ffmpeg ставится на паузу
+SEGMENT_DISK_BUDGET = int(cfg.get("segment_disk_budget_mb", 200)) * 1024 * 1024
+# Сколько задач обрабатывается одновременно и сколько ffmpeg может работать разом
+WORKERS = max(1, int(cfg.get("workers", 2)))
+FFMPEG_PROCESSES = max(1, int(cfg.get("ffmpeg_processes") or os.cpu_count() or 1))
+TASK_QUEUE_SIZE = int(cfg.get("task_queue_size", 10))
 # Папка для временных файлов по задачам; подпапка на каждую задачу
 TMP_DIR = Path(__file__).parent / "tmp"
+# Постоянный кэш: исходное аудио и готовые сегменты, у каждого слоя свой бюджет
+CACHE_DIR = Path(cfg.get("cache_dir") or Path(__file__).parent / "cache")
+SOURCE_CACHE_BUDGET = int(cfg.get("source_cache_mb", 4096)) * 1024 * 1024
+SEGMENT_CACHE_BUDGET = int(cfg.get("segment_cache_mb", 4096)) * 1024 * 1024
+# Формат yt-dlp входит в ключ кэша исходников
+DOWNLOAD_FORMAT = 'bestaudio/best'
+# Долгоживущие экземпляры YoutubeDL: player JS и расшифровка подписей остаются в памяти,
+# а в ydl_cache_dir — на диске между перезапусками
+YDL_POOL_SIZE = max(1, int(cfg.get("ydl_pool_size") or WORKERS + 1))
+YDL_CACHE_DIR = Path(cfg.get("ydl_cache_dir") or CACHE_DIR / "yt-dlp")
+# Видео, на котором пул прогревается при старте; пусто — без сетевого прогрева
+YDL_WARMUP_URL = cfg.get("ydl_warmup_url", "https://www.youtube.com/watch?v=jNQXAC9IVRw")
+# Метаданные ссылки запрашиваются сразу в handle_link: ошибки видны до выбора скорости
+PREFLIGHT_PROBE = bool(cfg.get("preflight_probe", True))
+# Сколько живут метаданные из предпроверки (ссылка на поток действует несколько часов)
+PROBE_TTL_S = float(cfg.get("probe_ttl_s", 1800))
+# Видео длиннее этого отклоняются сразу (0 — без ограничения)
+MAX_DURATION_S = float(cfg.get("max_duration_s", 0))
+# Плейлисты и каналы: до batch_max_videos записей. Пока текущая запись кодируется и отправляется,
+# исходники следующих batch_concurrency записей качаются заранее — пока занимают меньше batch_disk_budget_mb
+BATCH_MAX_VIDEOS = max(1, int(cfg.get("batch_max_videos", 200)))
+BATCH_CONCURRENCY = max(0, int(cfg.get("batch_concurrency", 2)))
+BATCH_DISK_BUDGET = int(cfg.get("batch_disk_budget_mb", 1024)) * 1024 * 1024
+# Оценка места под ещё не скачанную запись: bestaudio YouTube — до ~160 кбит/с
+PREFETCH_BYTES_PER_S = 160_000 // 8
+PREFETCH_UNKNOWN_DURATION_S = 3600
+# Стриминг: ffmpeg режет сегменты, пока аудио ещё качается
+STREAMING_INGEST = bool(cfg.get("streaming_ingest", True))
+STREAMABLE_EXTS = ('webm', 'm4a', 'mp3', 'ogg', 'opus')
+# Размер Range-запроса, как http_chunk_size у yt-dlp для YouTube
+STREAM_CHUNK = int(float(cfg.get("download_chunk_mb", 10)) * 1024 * 1024)
+STREAM_BLOCK = 256 * 1024
+STREAM_RETRIES = 5
+# Параллельная загрузка по Range: до download_connections соединений на задачу (1 — последовательно),
+# начиная с download_connections_start; при 403/429 число соединений к клиенту YouTube падает вдвое
+DOWNLOAD_CONNECTIONS = max(1, int(cfg.get("download_connections", 4)))
+DOWNLOAD_CONNECTIONS_START = min(DOWNLOAD_CONNECTIONS, max(1, int(cfg.get("download_connections_start", 2))))
+# После стольких кусков подряд без 403/429 пробуем добавить соединение
+DOWNLOAD_RAMP_CHUNKS = max(1, int(cfg.get("download_ramp_chunks", 2)))
+# Общий для всех задач лимит скорости загрузки, байт/с (0 — без лимита)
+DOWNLOAD_BANDWIDTH = float(cfg.get("download_bandwidth_mbps", 0)) * 1e6 / 8
+# Пауза yt-dlp перед каждой загрузкой (путь без стриминга), с; 0 — без паузы
+YDL_SLEEP_INTERVAL = float(cfg.get("ydl_sleep_interval", 0))
+# Постоянное хранилище задач: незавершённые задачи продолжаются после перезапуска
+JOB_DB = Path(cfg.get("job_db") or Path(__file__).parent / "jobs.sqlite3")
+# Где живёт очередь задач: local — в процессе бота (как раньше); sqlite — общий файл для
+# процессов на одной машине; http — брокер (python Bot.py --broker) для воркеров на разных машинах.
+# С sqlite/http задачи обрабатывают отдельные процессы: python Bot.py --worker
+QUEUE_BACKEND = cfg.get("queue_backend", "local")
+if QUEUE_BACKEND not in ('local', 'sqlite', 'http'):
+    raise ValueError(f"Неизвестный queue_backend: {QUEUE_BACKEND}")
+QUEUE_DB = Path(cfg.get("queue_db") or Path(__file__).parent / "queue.sqlite3")
+QUEUE_URL = cfg.get("queue_url", "http://127.0.0.1:9109").rstrip('/')
+QUEUE_TOKEN = cfg.get("queue_token")
+BROKER_HOST = cfg.get("broker_host", "127.0.0.1")
+BROKER_PORT = int(cfg.get("broker_port", 9109))
+# Аренда задачи воркером; heartbeat продлевает её втрое чаще. Истекла — задачу получит другой воркер
+QUEUE_LEASE_S = float(cfg.get("queue_lease_s", 60))
+QUEUE_HEARTBEAT_S = QUEUE_LEASE_S / 3
+QUEUE_POLL_S = float(cfg.get("queue_poll_s", 1.0))
+# Задача, которую столько раз выдавали и не завершили (воркеры падали на ней), снимается с ошибкой
+QUEUE_MAX_ATTEMPTS = int(cfg.get("queue_max_attempts", 3))
+WORKER_NAME = f"{socket.gethostname()}:{os.getpid()}"
+# Индекс Telegram file_id уже отправленных сегментов
+FILE_ID_DB = Path(cfg.get("file_id_db") or Path(__file__).parent / "file_ids.sqlite3")
+# Профили кодирования сегментов; в config.yaml можно добавить свои или переопределить эти
+DEFAULT_OUTPUT_PROFILES = {
+    'mp3': {'codec': 'libmp3lame', 'bitrate': '128k', 'channels': 2, 'ext': 'mp3'},
+    'mp3_mono': {'codec': 'libmp3lame', 'bitrate': '64k', 'channels': 1, 'ext': 'mp3'},
+    'aac': {'codec': 'aac', 'bitrate': '96k', 'channels': 2, 'ext': 'm4a'},
+    'opus': {'codec': 'libopus', 'bitrate': '48k', 'channels': 1, 'ext': 'ogg'},
+}
+OUTPUT_PROFILES = {**DEFAULT_OUTPUT_PROFILES, **(cfg.get("output_profiles") or {})}
+OUTPUT_PROFILE_NAME = cfg.get("output_profile", "mp3")
+if OUTPUT_PROFILE_NAME not in OUTPUT_PROFILES:
+    raise ValueError(f"Неизвестный output_profile: {OUTPUT_PROFILE_NAME}")
+OUTPUT_PROFILE = OUTPUT_PROFILES[OUTPUT_PROFILE_NAME]
+# На 1.0× режем без перекодирования, если кодек источника можно отправить как есть
+STREAM_COPY = bool(cfg.get("stream_copy", True))
+COPY_CONTAINERS = {'opus': 'ogg', 'vorbis': 'ogg', 'mp4a': 'm4a', 'aac': 'm4a', 'mp3': 'mp3'}
+# Резать по паузам: точка реза ищется в окне ±silence_window_s (в секундах результата)
+# вокруг номинальной границы сегмента. Нужен исходник с перемоткой, поэтому стриминг тогда не используется
+SILENCE_SPLIT = bool(cfg.get("silence_split", False))
+SILENCE_WINDOW_S = float(cfg.get("silence_window_s", 15))
+SILENCE_RATE = 8000  # Гц, моно PCM для анализа громкости
+SILENCE_FRAME_S = 0.1  # шаг огибающей RMS
+SILENCE_BLOCK_S = 60  # секунд PCM за одно чтение из ffmpeg
+SILENCE_GROUP = 32  # окон (входов ffmpeg) на один запуск анализа
 # YouTube: клиенты без PO Token (см. PO Token Guide). Можно переопределить в config.yaml
 DEFAULT_YOUTUBE_PLAYER_CLIENTS = ['tv', 'tv_simply', 'tv_embedded', 'web_embedded', 'android_vr']
 YOUTUBE_PLAYER_CLIENTS = cfg.get("youtube_player_clients") or DEFAULT_YOUTUBE_PLAYER_CLIENTS
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 — выключено)
+METRICS_HOST = cfg.get("metrics_host", "127.0.0.1")
+METRICS_PORT = int(cfg.get("metrics_port", 9108))
+# Трассы задач (JSON по строке на задачу) — отдельно от bot.log, который clear_logs обнуляет
+TRACE_LOG = Path(cfg.get("trace_log") or Path(__file__).parent / "traces.jsonl")
+STAGE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+# Лимиты исходящих сообщений (Telegram: ~30/с на бота и ~1/с в один чат, короткие всплески допустимы)
+# Лимиты действуют на процесс: с queue_backend sqlite/http у каждого --worker они свои
+SEND_RATE_GLOBAL = float(cfg.get("send_rate_global", 25))
+SEND_RATE_CHAT = float(cfg.get("send_rate_chat", 1))
+SEND_BURST_CHAT = max(1, int(cfg.get("send_burst_chat", 3)))
+# Сколько раз повторять отправку после 429 (RetryAfter), прежде чем сдаться
+SEND_RETRIES = max(1, int(cfg.get("send_retries", 8)))
+# Одновременные выгрузки файлов и размер пула соединений к Bot API
+UPLOAD_CONCURRENCY = max(1, int(cfg.get("upload_concurrency", 3)))
+TELEGRAM_CONNECTIONS = max(UPLOAD_CONCURRENCY + 4, int(cfg.get("telegram_connections", 20)))
+# Лимит длины сообщения Telegram; склеенные статусные сообщения не должны его превышать
+MESSAGE_LIMIT = 4096
 
-bot = Bot(token=TOKEN)
+
+# --- Метрики ---
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter:
+    """Счётчик Prometheus с метками; потокобезопасен (растёт и из потоков executor)."""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels.get(n, '')) for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """Мгновенное значение, которое считается при каждом запросе /metrics."""
+
+    def __init__(self, name: str, help_text: str, fn):
+        self.name, self.help_text, self.fn = name, help_text, fn
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {self.fn()}"]
+
+
+class Histogram:
+    """Гистограмма Prometheus (накопительные корзины) с метками."""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets=STAGE_BUCKETS):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self.buckets = tuple(buckets)
+        # метки -> [счётчики по корзинам, сумма, количество]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(n, '')) for n in self.labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = [counts, total + value, count + 1]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, n in [*zip(self.buckets, counts), ('+Inf', count)]:
+                    le = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {n}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class JobTrace:
+    """Время по этапам одной задачи; пишется в TRACE_LOG, когда задача завершена."""
+
+    def __init__(self, job_id: str, chat_id: int, url: str, speed: float):
+        self.job_id, self.chat_id, self.url, self.speed = job_id, chat_id, url, speed
+        self.started = time.monotonic()
+        self.stages: dict[str, list] = {}  # этап -> [число замеров, сумма секунд]
+        self.bytes: dict[str, int] = {}
+        self.client = ''
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            n, total = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = [n + 1, total + seconds]
+
+    def add_bytes(self, kind: str, amount: int) -> None:
+        with self._lock:
+            self.bytes[kind] = self.bytes.get(kind, 0) + amount
+
+    def emit(self, result: str) -> None:
+        total = time.monotonic() - self.started
+        record = {
+            'job_id': self.job_id, 'chat_id': self.chat_id, 'url': self.url, 'speed': self.speed,
+            'result': result, 'client': self.client, 'total_s': round(total, 3),
+            'stages': {k: {'count': n, 'seconds': round(s, 3)} for k, (n, s) in self.stages.items()},
+            'bytes': self.bytes,
+        }
+        summary = ', '.join(f"{k} {s:.1f}с×{n}" for k, (n, s) in self.stages.items())
+        logger.info(f"Трасса задачи {self.job_id} ({result}): {total:.1f} с — {summary}")
+        try:
+            with open(TRACE_LOG, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except OSError as e:
+            logger.warning(f"Не удалось записать трассу задачи: {e}")
+
+
+# Трасса задачи, которую выполняет текущий воркер (копируется и в потоки executor)
+current_trace: contextvars.ContextVar[JobTrace | None] = contextvars.ContextVar('current_trace', default=None)
+
+stage_seconds = Histogram(
+    'ytbot_stage_seconds', 'Duration of a processing stage', ('stage', 'client'),
+)
+bytes_total = Counter('ytbot_bytes_total', 'Bytes downloaded, encoded and uploaded', ('kind',))
+jobs_total = Counter('ytbot_jobs_total', 'Finished jobs by result', ('result',))
+retry_after_total = Counter('ytbot_telegram_retry_after_total', '429 RetryAfter responses from Telegram', ('method',))
+download_throttled_total = Counter('ytbot_download_throttled_total', '403/429 responses while downloading',
+                                   ('client', 'status'))
+
+
+def observe_stage(stage: str, seconds: float, client: str = '') -> None:
+    """Записывает длительность этапа в гистограмму и в трассу текущей задачи."""
+    stage_seconds.observe(seconds, stage=stage, client=client)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+def count_bytes(kind: str, amount: int) -> None:
+    bytes_total.inc(amount, kind=kind)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_bytes(kind, amount)
+
+
+@contextlib.contextmanager
+def timed_stage(stage: str, client: str = ''):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.monotonic() - started, client)
+
+
+def _player_client(info: dict) -> str:
+    """Клиент YouTube, выдавший ссылку на поток (параметр c= у googlevideo), например ANDROID_VR."""
+    return parse_qs(urlparse(info.get('url') or '').query).get('c', [''])[0]
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor, который считает занятые потоки и передаёт в них contextvars."""
+
+    def __init__(self, max_workers: int):
+        super().__init__(max_workers=max_workers)
+        self.max_workers = max_workers
+        self.busy = 0
+        self._busy_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        ctx = contextvars.copy_context()
+
+        def run():
+            with self._busy_lock:
+                self.busy += 1
+            try:
+                return ctx.run(fn, *args, **kwargs)
+            finally:
+                with self._busy_lock:
+                    self.busy -= 1
+        return super().submit(run)
+
+    def backlog(self) -> int:
+        """Сколько вызовов ждут свободного потока."""
+        return self._work_queue.qsize()
+
+
+class TokenBucket:
+    """Ведро токенов: rate в секунду, не больше burst подряд. acquire() ждёт по очереди."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.tokens, self.updated = 1.0, time.monotonic()
+            self.tokens -= 1
+
+
+class _MessageBatch:
+    def __init__(self, method: SendMessage, seq: int):
+        self.texts = [method.text]
+        self.seq = seq
+        self.result: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Единая точка для всех исходящих вызовов Bot API (request middleware aiogram).
+
+    Отправка сообщений проходит через общее ведро токенов (SEND_RATE_GLOBAL) и ведро
+    чата (SEND_RATE_CHAT). На 429 чат «паркуется» на retry_after секунд и вызов
+    повторяется — сегмент не считается неудавшимся. Простые текстовые сообщения,
+    которые ждут своей очереди в одном чате, склеиваются в одно. Выгрузка файлов
+    ограничена UPLOAD_CONCURRENCY одновременными запросами.
+    """
+
+    THROTTLED = {'sendMessage', 'sendAudio', 'sendDocument', 'forwardMessage', 'copyMessage'}
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_RATE_GLOBAL, max(1, int(SEND_RATE_GLOBAL)))
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.chat_locks: dict[int, asyncio.Lock] = {}
+        self.parked_until: dict[int, float] = {}
+        self.uploads = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        self._batches: dict[int, _MessageBatch] = {}
+        # Номер последнего вызова в чате: склеивать можно, только если между ними ничего не вклинилось
+        self._seq: dict[int, int] = {}
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__ not in self.THROTTLED:
+            # getUpdates, answerCallbackQuery, deleteMessage — без очереди и повторов
+            return await make_request(bot, method)
+        chat_id = getattr(method, 'chat_id', None)
+        seq = self._seq[chat_id] = self._seq.get(chat_id, 0) + 1
+        batch = None
+        if isinstance(method, SendMessage) and self._batchable(method):
+            batch = self._batches.get(chat_id)
+            if batch is not None and batch.seq == seq - 1 and \
+                    sum(len(t) + 1 for t in batch.texts) + len(method.text) <= MESSAGE_LIMIT:
+                batch.texts.append(method.text)
+                batch.seq = seq
+                return await asyncio.shield(batch.result)
+            batch = self._batches[chat_id] = _MessageBatch(method, seq)
+        # Один запрос на чат за раз: порядок сообщений сохраняется и при повторах после 429
+        lock = self.chat_locks.get(chat_id)
+        if lock is None:
+            lock = self.chat_locks[chat_id] = asyncio.Lock()
+        try:
+            async with lock:
+                if batch is not None:
+                    # Дальше склейка закрыта: текст уходит как есть
+                    if self._batches.get(chat_id) is batch:
+                        del self._batches[chat_id]
+                    if len(batch.texts) > 1:
+                        logger.info(f"Склеено {len(batch.texts)} сообщений в чат {chat_id}")
+                        method = method.model_copy(update={'text': '\n'.join(batch.texts)})
+                await self._wait_turn(chat_id)
+                if self._uploads_file(method):
+                    async with self.uploads:
+                        response = await self._send(make_request, bot, method, chat_id)
+                else:
+                    response = await self._send(make_request, bot, method, chat_id)
+        except BaseException as e:
+            if batch is not None:
+                if self._batches.get(chat_id) is batch:
+                    del self._batches[chat_id]
+                if not batch.result.done():
+                    batch.result.set_exception(e)
+                    batch.result.exception()  # ожидающих может не быть — не шумим в лог
+            raise
+        if batch is not None:
+            batch.result.set_result(response)
+        return response
+
+    @staticmethod
+    def _batchable(method: SendMessage) -> bool:
+        return method.reply_markup is None and method.entities is None and method.reply_parameters is None
+
+    @staticmethod
+    def _uploads_file(method) -> bool:
+        return any(isinstance(v, InputFile) for v in method.__dict__.values())
+
+    async def _wait_turn(self, chat_id: int | None) -> None:
+        started = time.monotonic()
+        await self._wait_parked(chat_id)
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(SEND_RATE_CHAT, SEND_BURST_CHAT)
+        await bucket.acquire()
+        await self.global_bucket.acquire()
+        waited = time.monotonic() - started
+        if waited > 0.01:
+            observe_stage('send_wait', waited)
+
+    async def _wait_parked(self, chat_id: int | None) -> None:
+        while True:
+            delay = self.parked_until.get(chat_id, 0) - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _send(self, make_request, bot, method, chat_id: int | None):
+        for attempt in range(1, SEND_RETRIES + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == SEND_RETRIES:
+                    raise
+                retry_after_total.inc(method=method.__api_method__)
+                self.parked_until[chat_id] = time.monotonic() + e.retry_after
+                logger.warning(f"429 от Telegram ({method.__api_method__}, чат {chat_id}): "
+                               f"ждём {e.retry_after} с, попытка {attempt}")
+                await self._wait_parked(chat_id)
+                await self.global_bucket.acquire()
+
+
+# Одна сессия (пул соединений) на все вызовы; исходящие сообщения идут через планировщик
+_session_kwargs = {'api': TelegramAPIServer.from_base(TELEGRAM_API_SERVER)} if TELEGRAM_API_SERVER else {}
+bot = Bot(token=TOKEN, session=AiohttpSession(limit=TELEGRAM_CONNECTIONS, **_session_kwargs))
+outbound = OutboundScheduler()
+bot.session.middleware(outbound)
 dp = Dispatcher()
-executor = ThreadPoolExecutor(max_workers=4)
+# Потоки: загрузки воркеров, заранее качаемые записи плейлистов (prefetch_slots) и короткие вызовы
+executor = InstrumentedExecutor(max_workers=max(4, WORKERS * 2 + 2))
+# Ограничение на число одновременно работающих ffmpeg (по числу ядер)
+ffmpeg_slots = asyncio.Semaphore(FFMPEG_PROCESSES)
+# Одновременные загрузки записей плейлистов наперёд — на все пакеты вместе
+prefetch_slots = asyncio.Semaphore(WORKERS)
+
+
+class FairTaskQueue:
+    """Очередь задач с честным round-robin по чатам.
+
+    У каждого чата своя очередь; воркер берёт по одной задаче из каждого чата
+    по кругу, поэтому десять ссылок от одного пользователя не задерживают остальных.
+    Пока задача чата выполняется, следующая задача того же чата не выдаётся
+    (до task_done(chat_id)) — сегменты разных видео не перемешиваются в чате.
+    Задача — кортеж (url, chat_id, orig_msg_id, speed, job_id).
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self._per_chat: dict[int, deque[tuple[str, int, int, float, str]]] = {}
+        self._order: deque[int] = deque()
+        # Чаты, задача которых сейчас выполняется
+        self._busy: set[int] = set()
+        self._size = 0
+        self._unfinished = 0
+        self._not_empty = asyncio.Condition()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self._size
+
+    async def put(self, task: tuple[str, int, int, float, str], force: bool = False) -> int:
+        """Ставит задачу в очередь чата и возвращает, сколько задач будет взято раньше неё.
+
+        При переполнении сразу бросает asyncio.QueueFull, а не ждёт места;
+        force=True — для задач, восстановленных после перезапуска.
+        """
+        if self.full() and not force:
+            raise asyncio.QueueFull
+        chat_id = task[1]
+        async with self._not_empty:
+            dq = self._per_chat.setdefault(chat_id, deque())
+            dq.append(task)
+            if chat_id not in self._order:
+                self._order.append(chat_id)
+            self._size += 1
+            self._unfinished += 1
+            self._not_empty.notify()
+            return self.position(chat_id, len(dq) - 1)
+
+    def position(self, chat_id: int, index: int) -> int:
+        """Сколько задач будет выдано до index-й задачи чата при обходе по кругу."""
+        ahead = index
+        passed_own_chat = False
+        for other in self._order:
+            if other == chat_id:
+                passed_own_chat = True
+                continue
+            # Чаты перед нашим успевают отдать на одну задачу больше в последнем круге
+            ahead += min(len(self._per_chat[other]), index if passed_own_chat else index + 1)
+        return ahead
+
+    def _ready_chat(self) -> int | None:
+        return next((chat_id for chat_id in self._order if chat_id not in self._busy), None)
+
+    async def get(self) -> tuple[str, int, int, float, str]:
+        async with self._not_empty:
+            await self._not_empty.wait_for(lambda: self._ready_chat() is not None)
+            chat_id = self._ready_chat()
+            self._order.remove(chat_id)
+            self._busy.add(chat_id)
+            dq = self._per_chat[chat_id]
+            task = dq.popleft()
+            if dq:
+                self._order.append(chat_id)
+            else:
+                del self._per_chat[chat_id]
+            self._size -= 1
+            return task
+
+    async def task_done(self, chat_id: int) -> None:
+        """Задача чата выполнена — следующую задачу этого чата можно выдавать."""
+        async with self._not_empty:
+            self._unfinished -= 1
+            self._busy.discard(chat_id)
+            self._not_empty.notify_all()
+
+
+def worker_alive(name: str | None) -> bool:
+    """Жив ли процесс воркера name (hostname:pid) на этой машине."""
+    if not name:
+        return False
+    host, _, pid = name.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobStore:
+    """Постоянное хранилище задач (SQLite).
+
+    Для каждой задачи хранит состояние, папку work_dir, скачанный исходник и номер
+    последнего доставленного сегмента. Завершённые задачи удаляются; всё, что
+    осталось в базе при старте, продолжается со следующего недоставленного сегмента.
+    Используется только из потока event loop.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path))
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                video_id TEXT,
+                speed REAL NOT NULL,
+                orig_msg_id INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                work_dir TEXT,
+                source_path TEXT,
+                title TEXT,
+                duration REAL,
+                acodec TEXT,
+                last_segment INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                worker TEXT
+            )
+        ''')
+        if 'worker' not in {row[1] for row in self._db.execute('PRAGMA table_info(jobs)')}:
+            self._db.execute('ALTER TABLE jobs ADD COLUMN worker TEXT')
+        # Плейлисты: записи и номер текущей; job_id — задача текущей записи
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                title TEXT,
+                speed REAL NOT NULL,
+                entries TEXT NOT NULL,
+                next_entry INTEGER NOT NULL DEFAULT 0,
+                job_id TEXT,
+                created_at REAL NOT NULL
+            )
+        ''')
+        self._db.commit()
+
+    def add(self, chat_id: int, url: str, video_id: str | None, speed: float, orig_msg_id: int) -> str:
+        job_id = uuid.uuid4().hex[:12]
+        self._db.execute(
+            'INSERT INTO jobs (id, chat_id, url, video_id, speed, orig_msg_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, chat_id, url, video_id, speed, orig_msg_id, time.time()),
+        )
+        self._db.commit()
+        return job_id
+
+    def get(self, job_id: str | None) -> dict | None:
+        if not job_id:
+            return None
+        row = self._db.execute('SELECT * FROM jobs WHERE id=?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def _update(self, job_id: str | None, **fields) -> None:
+        if not job_id:
+            return
+        cols = ', '.join(f'{k}=?' for k in fields)
+        self._db.execute(f'UPDATE jobs SET {cols} WHERE id=?', (*fields.values(), job_id))
+        self._db.commit()
+
+    def start(self, job_id: str | None, work_dir: Path) -> None:
+        self._update(job_id, state='running', work_dir=str(work_dir))
+
+    def set_source(self, job_id: str | None, path: str, title: str, duration: float, acodec: str | None) -> None:
+        self._update(job_id, source_path=str(path), title=title, duration=duration, acodec=acodec)
+
+    def checkpoint(self, job_id: str | None, segment: int) -> None:
+        """Сегмент segment доставлен; после перезапуска продолжим со следующего."""
+        self._update(job_id, last_segment=segment)
+
+    def finish(self, job_id: str | None) -> None:
+        if job_id:
+            self._db.execute('DELETE FROM jobs WHERE id=?', (job_id,))
+            self._db.commit()
+
+    def unfinished(self) -> list[dict]:
+        return [dict(r) for r in self._db.execute('SELECT * FROM jobs ORDER BY created_at')]
+
+    def add_batch(self, chat_id: int, url: str, title: str, speed: float, entries: list[dict]) -> str:
+        batch_id = uuid.uuid4().hex[:12]
+        self._db.execute(
+            'INSERT INTO batches (id, chat_id, url, title, speed, entries, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (batch_id, chat_id, url, title, speed, json.dumps(entries, ensure_ascii=False), time.time()),
+        )
+        self._db.commit()
+        return batch_id
+
+    def batch_progress(self, batch_id: str, next_entry: int, job_id: str | None) -> None:
+        self._db.execute('UPDATE batches SET next_entry=?, job_id=? WHERE id=?', (next_entry, job_id, batch_id))
+        self._db.commit()
+
+    def finish_batch(self, batch_id: str) -> None:
+        self._db.execute('DELETE FROM batches WHERE id=?', (batch_id,))
+        self._db.commit()
+
+    def unfinished_batches(self) -> list[dict]:
+        rows = [dict(r) for r in self._db.execute('SELECT * FROM batches ORDER BY created_at')]
+        for row in rows:
+            row['entries'] = json.loads(row['entries'])
+        return rows
+
+    def unfinished_batch(self, batch_id: str) -> dict | None:
+        row = self._db.execute('SELECT * FROM batches WHERE id=?', (batch_id,)).fetchone()
+        if row is None:
+            return None
+        batch = dict(row)
+        batch['entries'] = json.loads(batch['entries'])
+        return batch
+
+    def adopt(self, job: dict, resumed: bool) -> Path:
+        """Заводит локально задачу, выданную общей очередью, под её id; возвращает её work_dir.
+
+        resumed — задачу уже начинал другой (упавший) воркер: доставленные сегменты
+        не повторяются, исходное сообщение заново не пересылается. База общая для
+        воркеров одной машины: папку и исходник прежнего владельца задачи берём, только
+        если его процесса больше нет, — живой воркер, у которого истекла аренда, ещё
+        может в неё писать и сам удалит её, когда заметит потерю задачи.
+        """
+        self._db.execute(
+            'INSERT OR IGNORE INTO jobs (id, chat_id, url, video_id, speed, orig_msg_id, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job['id'], job['chat_id'], job['url'], job['video_id'], job['speed'], job['orig_msg_id'], time.time()),
+        )
+        row = self.get(job['id'])
+        if row['work_dir'] and not worker_alive(row['worker']):
+            work_dir, source = row['work_dir'], row['source_path']
+        else:
+            work_dir, source = str(TMP_DIR / uuid.uuid4().hex[:12]), None
+        self._db.execute(
+            'UPDATE jobs SET worker=?, state=?, work_dir=?, source_path=?, last_segment=MAX(last_segment, ?) '
+            'WHERE id=?',
+            (WORKER_NAME, 'running' if resumed else 'queued', work_dir, source, job['last_segment'], job['id']),
+        )
+        self._db.commit()
+        return Path(work_dir)
+
+    def owned(self, job_id: str) -> bool:
+        """Задача по-прежнему числится за этим процессом (её не перехватил другой воркер машины)."""
+        row = self.get(job_id)
+        return row is not None and row['worker'] == WORKER_NAME
+
+
+class SqliteJobQueue:
+    """Общая очередь задач в SQLite для отдельных процессов-воркеров (queue_backend: sqlite).
+
+    Фронтенд кладёт задачи, воркеры (python Bot.py --worker) берут их в аренду на
+    QUEUE_LEASE_S и продлевают её heartbeat'ом, заодно сообщая номер последнего
+    доставленного сегмента. Задачу с истёкшей арендой (воркер умер) получает другой
+    воркер и продолжает с этого сегмента. Из ждущих задач выдаётся задача чата, у
+    которого меньше всего задач в работе и который дольше всех ничего не получал, —
+    тот же честный round-robin, что у FairTaskQueue. Этот же класс стоит за брокером
+    (python Bot.py --broker) для queue_backend: http.
+
+    Запросы к SQLite идут в отдельном потоке: ожидание блокировки файла (до 30 с,
+    пока его держит другой процесс) не должно останавливать event loop.
+    """
+
+    def __init__(self, path: Path, maxsize: int = 0):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.maxsize = maxsize
+        # Один поток — запросы к соединению выполняются строго по очереди
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='job-queue')
+        # Автокоммит; составные операции — в явных транзакциях BEGIN IMMEDIATE
+        self._db = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS queue (
+                id TEXT PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                video_id TEXT,
+                speed REAL NOT NULL,
+                orig_msg_id INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_segment INTEGER NOT NULL DEFAULT 0,
+                enqueued_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, last_claim REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS workers (name TEXT PRIMARY KEY, seen REAL NOT NULL, jobs INTEGER NOT NULL);
+        ''')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    async def _call(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._thread, func, *args)
+
+    async def submit(self, job: dict) -> int | None:
+        """Ставит задачу; возвращает число задач впереди или None, если чат уже ждёт это видео."""
+        return await self._call(self._submit, job)
+
+    async def claim(self, worker: str) -> dict | None:
+        return await self._call(self._claim, worker)
+
+    async def heartbeat(self, worker: str, progress: dict[str, int]) -> list[str]:
+        """Продлевает аренду задач воркера; возвращает задачи, которые у него уже забрали."""
+        return await self._call(self._heartbeat, worker, progress)
+
+    async def complete(self, worker: str, job_id: str) -> None:
+        await self._call(self._db.execute, 'DELETE FROM queue WHERE id=? AND worker=?', (job_id, worker))
+
+    async def release(self, worker: str, job_id: str, last_segment: int) -> None:
+        """Возвращает задачу в очередь (воркер останавливается) — без ожидания истечения аренды."""
+        await self._call(
+            self._db.execute,
+            "UPDATE queue SET state='queued', worker=NULL, lease_until=NULL, attempts=MAX(attempts-1, 0), "
+            "last_segment=MAX(last_segment, ?) WHERE id=? AND worker=?",
+            (last_segment, job_id, worker),
+        )
+
+    async def known(self, job_ids: list[str]) -> list[str]:
+        """Какие из задач ещё в очереди (остальные уже кем-то завершены)."""
+        return await self._call(self._known, job_ids)
+
+    async def stats(self) -> dict:
+        return await self._call(self._stats)
+
+    def _submit(self, job: dict) -> int | None:
+        with self._transaction():
+            if job['video_id'] and self._db.execute(
+                'SELECT 1 FROM queue WHERE chat_id=? AND video_id=? AND speed=?',
+                (job['chat_id'], job['video_id'], job['speed']),
+            ).fetchone():
+                return None
+            queued = self._db.execute("SELECT COUNT(*) FROM queue WHERE state='queued'").fetchone()[0]
+            if 0 < self.maxsize <= queued:
+                raise asyncio.QueueFull
+            self._db.execute(
+                'INSERT INTO queue (id, chat_id, url, video_id, speed, orig_msg_id, enqueued_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job['id'], job['chat_id'], job['url'], job['video_id'], job['speed'], job['orig_msg_id'], time.time()),
+            )
+            return self._position(job['chat_id'])
+
+    def _position(self, chat_id: int) -> int:
+        """Сколько ждущих задач будет выдано раньше последней задачи чата (обход по кругу)."""
+        counts = dict(self._db.execute("SELECT chat_id, COUNT(*) FROM queue WHERE state='queued' GROUP BY chat_id"))
+        index = counts.pop(chat_id, 1) - 1
+        return index + sum(min(c, index + 1) for c in counts.values())
+
+    def _claim(self, worker: str) -> dict | None:
+        now = time.time()
+        with self._transaction():
+            row = self._db.execute('''
+                SELECT q.* FROM queue q LEFT JOIN chats c ON c.chat_id = q.chat_id
+                WHERE (q.state = 'queued' OR q.lease_until < :now)
+                  -- Пока у чата есть выполняемая задача, следующую его задачу не выдаём
+                  AND NOT EXISTS (SELECT 1 FROM queue r
+                                  WHERE r.chat_id = q.chat_id AND r.id != q.id
+                                    AND r.state = 'running' AND r.lease_until >= :now)
+                ORDER BY COALESCE(c.last_claim, 0), q.enqueued_at
+                LIMIT 1
+            ''', {'now': now}).fetchone()
+            if row is None:
+                return None
+            if row['state'] == 'running':
+                logger.warning(f"Аренда задачи {row['id']} у {row['worker']} истекла — выдаём заново")
+            self._db.execute(
+                "UPDATE queue SET state='running', worker=?, lease_until=?, attempts=attempts+1 WHERE id=?",
+                (worker, now + QUEUE_LEASE_S, row['id']),
+            )
+            self._db.execute('INSERT OR REPLACE INTO chats (chat_id, last_claim) VALUES (?, ?)', (row['chat_id'], now))
+        return {**dict(row), 'attempts': row['attempts'] + 1}
+
+    def _heartbeat(self, worker: str, progress: dict[str, int]) -> list[str]:
+        now = time.time()
+        lost = []
+        with self._transaction():
+            for job_id, last_segment in progress.items():
+                cur = self._db.execute(
+                    'UPDATE queue SET lease_until=?, last_segment=MAX(last_segment, ?) WHERE id=? AND worker=?',
+                    (now + QUEUE_LEASE_S, last_segment, job_id, worker),
+                )
+                if cur.rowcount == 0:
+                    lost.append(job_id)
+            self._db.execute('INSERT OR REPLACE INTO workers (name, seen, jobs) VALUES (?, ?, ?)',
+                             (worker, now, len(progress) - len(lost)))
+        return lost
+
+    def _known(self, job_ids: list[str]) -> list[str]:
+        return [job_id for job_id in job_ids
+                if self._db.execute('SELECT 1 FROM queue WHERE id=?', (job_id,)).fetchone()]
+
+    def _stats(self) -> dict:
+        now = time.time()
+        row = self._db.execute(
+            "SELECT SUM(state='queued'), SUM(state='running' AND lease_until >= ?), SUM(state='running' AND lease_until < ?) "
+            "FROM queue", (now, now),
+        ).fetchone()
+        workers = self._db.execute('SELECT COUNT(*) FROM workers WHERE seen >= ?', (now - QUEUE_LEASE_S,)).fetchone()[0]
+        return {'queued': row[0] or 0, 'running': row[1] or 0, 'expired': row[2] or 0, 'workers': workers}
+
+
+class HttpJobQueue:
+    """Клиент брокера очереди (queue_backend: http): те же методы, что у SqliteJobQueue, по HTTP."""
+
+    METHODS = ('submit', 'claim', 'heartbeat', 'complete', 'release', 'known', 'stats')
+
+    def __init__(self, url: str, token: str | None = None):
+        self.url = url
+        self.headers = {'Authorization': f'Bearer {token}'} if token else {}
+        self._session: aiohttp.ClientSession | None = None
+
+    async def _call(self, method: str, **payload):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30), headers=self.headers)
+        async with self._session.post(f"{self.url}/{method}", json=payload) as resp:
+            if resp.status == 429:
+                raise asyncio.QueueFull
+            resp.raise_for_status()
+            return (await resp.json())['result']
+
+    async def submit(self, job: dict) -> int | None:
+        return await self._call('submit', job=job)
+
+    async def claim(self, worker: str) -> dict | None:
+        return await self._call('claim', worker=worker)
+
+    async def heartbeat(self, worker: str, progress: dict[str, int]) -> list[str]:
+        return await self._call('heartbeat', worker=worker, progress=progress)
+
+    async def complete(self, worker: str, job_id: str) -> None:
+        await self._call('complete', worker=worker, job_id=job_id)
+
+    async def release(self, worker: str, job_id: str, last_segment: int) -> None:
+        await self._call('release', worker=worker, job_id=job_id, last_segment=last_segment)
+
+    async def known(self, job_ids: list[str]) -> list[str]:
+        return await self._call('known', job_ids=job_ids)
+
+    async def stats(self) -> dict:
+        return await self._call('stats')
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+class SharedJob:
+    """Одна обработка (видео, скорость) на несколько чатов — single-flight.
+
+    Ведущий чат обрабатывается как обычно: загрузка, нарезка, отправка файлов.
+    Остальные чаты подписываются и получают те же сегменты по file_id: сначала
+    уже отправленные ведущему, затем новые по мере появления.
+    """
+
+    def __init__(self, video_id: str, speed: float, leader: int):
+        self.video_id = video_id
+        self.speed = speed
+        self.leader = leader
+        # (file_id, kind) доставленных ведущему сегментов — по порядку
+        self.file_ids: list[tuple[str, str]] = []
+        self.finished = False
+        self.failed_segments = 0
+        self.error: str | None = None
+        self._changed = asyncio.Condition()
+        self._followers: dict[int, asyncio.Task] = {}
+
+    def attach(self, chat_id: int, orig_msg_id: int, job_id: str, start: int = 0) -> bool:
+        """Подписывает чат; False — этот чат уже получает это видео.
+
+        start — сколько сегментов чат уже получил до перезапуска.
+        """
+        if chat_id == self.leader or chat_id in self._followers:
+            return False
+        self._followers[chat_id] = asyncio.create_task(self._follow(chat_id, orig_msg_id, job_id, start))
+        logger.info(f"Чат {chat_id} присоединён к обработке {self.video_id}@{self.speed}")
+        return True
+
+    async def publish(self, idx: int, file_id: str, kind: str = 'audio') -> None:
+        async with self._changed:
+            # Сегменты доставляются строго по порядку, повторы (skip) игнорируем
+            if idx == len(self.file_ids) + 1:
+                self.file_ids.append((file_id, kind))
+                self._changed.notify_all()
+
+    async def finish(self, failed_segments: int = 0, error: str | None = None) -> None:
+        async with self._changed:
+            self.finished = True
+            self.failed_segments = failed_segments
+            self.error = error
+            self._changed.notify_all()
+
+    async def _follow(self, chat_id: int, orig_msg_id: int, job_id: str, start: int) -> None:
+        sent = start
+        try:
+            if not start:
+                await bot.forward_message(chat_id=chat_id, from_chat_id=chat_id, message_id=orig_msg_id)
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: sent < len(self.file_ids) or self.finished)
+                    pending = self.file_ids[sent:]
+                    finished = self.finished
+                for file_id, kind in pending:
+                    await send_file_id(chat_id, file_id, kind)
+                    sent += 1
+                    job_store.checkpoint(job_id, sent)
+                if finished and sent >= len(self.file_ids):
+                    break
+            if self.error:
+                await bot.send_message(chat_id=chat_id, text=self.error)
+            elif self.failed_segments:
+                await bot.send_message(chat_id=chat_id, text=f"Готово, но с ошибками: {self.failed_segments} сегм.")
+            else:
+                await bot.send_message(chat_id=chat_id, text="Готово!")
+        except Exception as e:
+            logger.error(f"Ошибка отправки общей задачи {self.video_id} в чат {chat_id}: {e}")
+            # Без сообщения чат так и ждал бы оставшиеся сегменты
+            with contextlib.suppress(Exception):
+                await bot.send_message(chat_id=chat_id,
+                                       text=f"❌ Не удалось отправить видео: доставлено {sent} сегм. Пришли ссылку ещё раз.")
+        # При отмене (остановка бота) запись остаётся — подписка восстановится при старте
+        job_store.finish(job_id)
+        resolve_batch_waiter(job_id)
+
+
+class EtaEstimator:
+    """Оценка ожидания в очереди по уже обработанным задачам (экспоненциальное среднее).
+
+    Учитываются только задачи, которые качались и кодировались: выдача из кэша
+    почти мгновенна и исказила бы оценку.
+    """
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.job_s: float | None = None
+        self.per_media_s: float | None = None
+
+    def observe(self, elapsed: float, duration: float) -> None:
+        if duration <= 0:
+            return
+        a = self.alpha
+        self.job_s = elapsed if self.job_s is None else a * elapsed + (1 - a) * self.job_s
+        rate = elapsed / duration
+        self.per_media_s = rate if self.per_media_s is None else a * rate + (1 - a) * self.per_media_s
+
+    def estimate(self, ahead: int, duration: float | None) -> float | None:
+        """Секунды до окончания задачи: ahead задач впереди делят WORKERS воркеров."""
+        if self.job_s is None:
+            return None
+        own = duration * self.per_media_s if duration else self.job_s
+        return ahead * self.job_s / WORKERS + own
+
+
+class PlaylistBatch:
+    """Плейлист или канал: записи ставятся в общую очередь по одной, следующие качаются заранее.
+
+    У пакета в очереди не больше одной задачи: следующая ставится, когда закончится
+    предыдущая. Поэтому записи приходят в чат по порядку, а пакет на 200 видео не
+    упирается в task_queue_size и не отнимает очередь у других чатов. Пока запись
+    кодируется и отправляется, исходники следующих BATCH_CONCURRENCY записей
+    качаются в source_cache (prefetch_source), пока скачанные и ещё качающиеся
+    (по оценке prefetch_estimate) занимают не больше BATCH_DISK_BUDGET.
+    Ход пакета хранится в job_store и продолжается после перезапуска.
+    """
+
+    def __init__(self, batch: dict):
+        self.id = batch['id']
+        self.chat_id = batch['chat_id']
+        self.title = batch['title']
+        self.speed = batch['speed']
+        self.entries: list[dict] = batch['entries']
+        self.next_entry = batch['next_entry']
+        self.job_id: str | None = batch['job_id']
+        self._prefetch: dict[int, asyncio.Task] = {}
+        # Записи, скачанные заранее и захваченные в source_cache: индекс -> байты
+        self._pinned: dict[int, int] = {}
+        # Записи, которые ещё качаются: индекс -> оценка размера (prefetch_estimate)
+        self._reserved: dict[int, int] = {}
+
+    def start(self) -> None:
+        batches[self.id] = self
+        if self.job_id and job_queue is None and job_store.get(self.job_id):
+            # Задача текущей записи пережила перезапуск — ждём её, а не ставим запись заново
+            batch_waiters[self.job_id] = asyncio.get_event_loop().create_future()
+        asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        lock = chat_batch_locks.setdefault(self.chat_id, asyncio.Lock())
+        try:
+            # Пакеты одного чата идут друг за другом, иначе их записи перемешаются
+            async with lock:
+                if self.job_id:
+                    await self._wait(self.job_id)
+                    self._advance()
+                while self.next_entry < len(self.entries):
+                    index = self.next_entry
+                    entry = self.entries[index]
+                    self._prefetch_ahead(index)
+                    prefetch = self._prefetch.pop(index, None)
+                    if prefetch is not None:
+                        # Исходник уже качается — дожидаемся, чтобы задача не качала его второй раз
+                        await asyncio.gather(prefetch, return_exceptions=True)
+                    await bot.send_message(chat_id=self.chat_id,
+                                           text=f"▶️ {index + 1}/{len(self.entries)}: {entry['title']}")
+                    job_id = await self._submit(index, entry)
+                    if job_id:
+                        await self._wait(job_id)
+                    self._unpin(index)
+                    self._advance()
+                await bot.send_message(chat_id=self.chat_id,
+                                       text=f"Плейлист «{self.title}» готов: {len(self.entries)} видео.")
+            job_store.finish_batch(self.id)
+        except asyncio.CancelledError:
+            # Остановка бота: пакет продолжится со своей записи после перезапуска
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка пакета {self.id} для чата {self.chat_id}: {e}")
+            job_store.finish_batch(self.id)
+        finally:
+            for task in self._prefetch.values():
+                task.cancel()
+            for index in list(self._pinned):
+                self._unpin(index)
+            batches.pop(self.id, None)
+
+    def _advance(self) -> None:
+        self.next_entry += 1
+        self.job_id = None
+        job_store.batch_progress(self.id, self.next_entry, None)
+
+    async def _submit(self, index: int, entry: dict) -> str | None:
+        """Ставит запись в очередь; None — такая задача у чата уже есть (внешняя очередь)."""
+        url = canonical_video_url(entry['id'])
+        # orig_msg_id=0: вместо пересылки ссылки каждая запись начинается с заголовка
+        if job_queue is not None:
+            job_id = uuid.uuid4().hex[:12]
+            job = {'id': job_id, 'chat_id': self.chat_id, 'url': url, 'video_id': entry['id'],
+                   'speed': self.speed, 'orig_msg_id': 0}
+            while True:
+                try:
+                    ahead = await job_queue.submit(job)
+                    break
+                except asyncio.QueueFull:
+                    await asyncio.sleep(QUEUE_POLL_S * 5)
+            if ahead is None:
+                return None
+        else:
+            while task_queue.full():
+                await asyncio.sleep(1)
+            job_id = job_store.add(self.chat_id, url, entry['id'], self.speed, 0)
+            batch_waiters[job_id] = asyncio.get_event_loop().create_future()
+        self.job_id = job_id
+        job_store.batch_progress(self.id, index, job_id)
+        if job_queue is None:
+            await task_queue.put((url, self.chat_id, 0, self.speed, job_id), force=True)
+        return job_id
+
+    async def _wait(self, job_id: str) -> None:
+        if job_queue is None:
+            waiter = batch_waiters.get(job_id)
+            if waiter is not None:
+                await waiter
+            return
+        # Задачу выполняет отдельный воркер: она пропадает из очереди, когда завершена
+        while await job_queue.known([job_id]):
+            await asyncio.sleep(QUEUE_POLL_S * 5)
+
+    def _prefetch_ahead(self, current: int) -> None:
+        # Отдельные воркеры качают сами: их source_cache — не наш
+        if job_queue is not None:
+            return
+        for index in range(current + 1, min(len(self.entries), current + 1 + BATCH_CONCURRENCY)):
+            if index in self._prefetch or index in self._pinned:
+                continue
+            # Место под запись резервируется до начала загрузки, иначе одновременные
+            # загрузки превысили бы бюджет на batch_concurrency исходников
+            estimate = prefetch_estimate(self.entries[index])
+            if sum(self._pinned.values()) + sum(self._reserved.values()) + estimate > BATCH_DISK_BUDGET:
+                break
+            self._reserved[index] = estimate
+            self._prefetch[index] = asyncio.create_task(self._prefetch_entry(index))
+
+    async def _prefetch_entry(self, index: int) -> None:
+        video_id = self.entries[index]['id']
+        async with prefetch_slots:
+            download = asyncio.get_event_loop().run_in_executor(
+                executor, prefetch_source, canonical_video_url(video_id), video_id
+            )
+            try:
+                self._pinned[index] = await asyncio.shield(download)
+            except asyncio.CancelledError:
+                # Поток executor доработает сам — отпускаем запись, когда он закончит
+                download.add_done_callback(
+                    lambda f: f.cancelled() or f.exception() or source_cache.release(source_cache_key(video_id))
+                )
+                raise
+            except Exception as e:
+                # Не страшно: задача этой записи скачает исходник сама и сообщит об ошибке
+                logger.warning(f"Не удалось скачать заранее {video_id}: {e}")
+            finally:
+                self._reserved.pop(index, None)
+
+    def _unpin(self, index: int) -> None:
+        if self._pinned.pop(index, None) is not None:
+            source_cache.release(source_cache_key(self.entries[index]['id']))
+
+
+def prefetch_estimate(entry: dict) -> int:
+    """Ожидаемый размер исходника записи плейлиста — по длительности из плоского списка."""
+    return int((entry.get('duration') or PREFETCH_UNKNOWN_DURATION_S) * PREFETCH_BYTES_PER_S)
+
+
+def resolve_batch_waiter(job_id: str) -> None:
+    """Задача завершена — пакет, который её ждёт, переходит к следующей записи."""
+    waiter = batch_waiters.pop(job_id, None)
+    if waiter is not None and not waiter.done():
+        waiter.set_result(None)
+
 
 # --- Очереди и состояния ---
-task_queue: asyncio.Queue[tuple[str, int, int, float]] = asyncio.Queue(maxsize=10)
-pending_videos: dict[int, deque[tuple[str, int, int]]] = {}
+task_queue = FairTaskQueue(maxsize=TASK_QUEUE_SIZE)
+# Ссылки, ждущие выбора скорости: чат → {id сообщения с клавиатурой: (url, ID видео, id сообщения со ссылкой)}.
+# По id клавиатуры, а не по порядку: проверки ссылок завершаются в любом порядке
+pending_videos: dict[int, dict[int, tuple[str, str | None, int]]] = {}
+# Задачи в очереди или в работе по (ID видео, скорость) — для single-flight
+inflight_jobs: dict[tuple[str, float], SharedJob] = {}
+job_store = JobStore(JOB_DB)
+# Общая очередь для отдельных воркеров (queue_backend: sqlite/http); None — задачи в task_queue
+job_queue: SqliteJobQueue | HttpJobQueue | None = (
+    SqliteJobQueue(QUEUE_DB, TASK_QUEUE_SIZE) if QUEUE_BACKEND == 'sqlite'
+    else HttpJobQueue(QUEUE_URL, QUEUE_TOKEN) if QUEUE_BACKEND == 'http'
+    else None
+)
+# ID задачи из job_store, которую сейчас выполняет текущий воркер (для чекпоинтов)
+current_job_id: contextvars.ContextVar[str | None] = contextvars.ContextVar('current_job_id', default=None)
 active_tasks_lock = threading.Lock()
 active_tasks: int = 0
+job_eta = EtaEstimator()
+# Плейлисты в работе; задачи их записей ждут через batch_waiters (job_id -> future)
+batches: dict[str, PlaylistBatch] = {}
+batch_waiters: dict[str, asyncio.Future] = {}
+chat_batch_locks: dict[int, asyncio.Lock] = {}
+
+METRICS = [
+    stage_seconds, bytes_total, jobs_total, retry_after_total, download_throttled_total,
+    Gauge('ytbot_queue_depth', 'Tasks waiting in the queue', lambda: task_queue.qsize()),
+    Gauge('ytbot_active_workers', 'Workers currently processing a task', lambda: active_tasks),
+    Gauge('ytbot_workers', 'Configured number of workers', lambda: WORKERS),
+    Gauge('ytbot_executor_busy_threads', 'Executor threads running a call', lambda: executor.busy),
+    Gauge('ytbot_executor_max_threads', 'Executor pool size', lambda: executor.max_workers),
+    Gauge('ytbot_executor_backlog', 'Calls waiting for a free executor thread', lambda: executor.backlog()),
+    Gauge('ytbot_ffmpeg_busy', 'ffmpeg slots in use', lambda: FFMPEG_PROCESSES - ffmpeg_slots._value),
+    Gauge('ytbot_inflight_videos', 'Distinct (video, speed) jobs in flight', lambda: len(inflight_jobs)),
+    Gauge('ytbot_download_connections', 'Range connections downloading right now',
+          lambda: download_governor.active),
+    Gauge('ytbot_uploads_active', 'File uploads to Telegram in progress',
+          lambda: UPLOAD_CONCURRENCY - outbound.uploads._value),
+]
+
+
+def render_metrics() -> str:
+    return '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server() -> web.AppRunner | None:
+    """Поднимает HTTP-эндпоинт /metrics; ошибка запуска не мешает работе бота."""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        logger.warning(f"Эндпоинт метрик не запущен ({METRICS_HOST}:{METRICS_PORT}): {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    h, m, s = seconds // 3600, seconds % 3600 // 60, seconds % 60
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
 
 def sanitize_filename(name: str) -> str:
     return re.sub(r'[\\/*?:<>|\"]', "-", name)
 
+_VIDEO_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+def canonical_video_url(video_id: str) -> str:
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+def _is_host(host: str, domain: str) -> bool:
+    """host — сам domain или его поддомен (notyoutube.com — нет)."""
+    return host == domain or host.endswith(f'.{domain}')
+
+def extract_video_id(url: str) -> str | None:
+    """Канонический ID видео из ссылок youtube.com/watch?v=, youtu.be/, /shorts/, /embed/, /live/."""
+    url = url.strip()
+    parsed = urlparse(url if '://' in url else f'https://{url}')
+    host = (parsed.hostname or '').lower()
+    parts = [p for p in parsed.path.split('/') if p]
+    candidate = None
+    if _is_host(host, 'youtu.be'):
+        candidate = parts[0] if parts else None
+    elif _is_host(host, 'youtube.com') or _is_host(host, 'youtube-nocookie.com'):
+        v = parse_qs(parsed.query).get('v')
+        if v:
+            candidate = v[0]
+        elif len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v', 'e'):
+            candidate = parts[1]
+    if candidate and _VIDEO_ID_RE.match(candidate):
+        return candidate
+    return None
+
+def collection_url(url: str) -> str | None:
+    """Каноническая ссылка на плейлист или вкладку канала; None — это не плейлист и не канал.
+
+    Ссылка на видео из плейлиста (watch?v=...&list=...) остаётся одним видео.
+    """
+    url = url.strip()
+    parsed = urlparse(url if '://' in url else f'https://{url}')
+    host = (parsed.hostname or '').lower()
+    if not _is_host(host, 'youtube.com') or extract_video_id(url):
+        return None
+    parts = [p for p in parsed.path.split('/') if p]
+    playlist = parse_qs(parsed.query).get('list')
+    if parts[:1] == ['playlist'] and playlist:
+        return f"https://www.youtube.com/playlist?list={playlist[0]}"
+    if parts and parts[0].startswith('@'):
+        base = parts[:1]
+    elif len(parts) >= 2 and parts[0] in ('channel', 'c', 'user'):
+        base = parts[:2]
+    else:
+        return None
+    # Без вкладки канал отдаёт список вкладок, а не видео — берём «Видео»
+    tab = parts[len(base)] if len(parts) > len(base) else 'videos'
+    if tab not in ('videos', 'streams', 'podcasts'):
+        tab = 'videos'
+    return f"https://www.youtube.com/{'/'.join(base)}/{tab}"
+
+def _dir_size(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+
 def cleanup_work_dir(work_dir: Path) -> None:
     """Удаляет папку задачи со всем содержимым."""
     if not work_dir or not work_dir.exists():
@@ -68,6 +1391,265 @@ def cleanup_work_dir(work_dir: Path) -> None:
     except Exception as e:
         logger.warning(f"Не удалось удалить папку {work_dir}: {e}")
 
+class DiskCache:
+    """Файловый кэш с LRU-вытеснением по байтовому бюджету.
+
+    Запись — папка root/<sha1(ключа)> с файлами и meta.json. Порядок LRU хранится
+    в mtime папок и переживает перезапуск. Методы потокобезопасны: ими пользуются
+    и воркеры, и потоки executor. Захваченные через acquire() записи не вытесняются
+    до release(). Папку кэша использует один процесс — у каждого --worker своя
+    (см. claim_worker_cache_dir).
+    """
+
+    def __init__(self, root: Path, max_bytes: int, name: str):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()  # digest -> байты
+        self._pins: dict[str, int] = {}
+        self._load()
+
+    @staticmethod
+    def _digest(key: str) -> str:
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _load(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        found = []
+        for entry in self.root.iterdir():
+            if not entry.is_dir():
+                continue
+            # Недописанные записи (упали посреди store) просто удаляем
+            if entry.name.startswith('.') or not (entry / 'meta.json').exists():
+                shutil.rmtree(entry, ignore_errors=True)
+                continue
+            found.append((entry.stat().st_mtime, entry.name, _dir_size(entry)))
+        for _, digest, size in sorted(found):
+            self._entries[digest] = size
+        logger.info(f"Кэш {self.name}: {len(self._entries)} записей, "
+                    f"{sum(self._entries.values()) // (1024 * 1024)} МБ из {self.max_bytes // (1024 * 1024)} МБ")
+
+    def acquire(self, key: str) -> tuple[Path, dict] | None:
+        """Возвращает (папка, meta) и защищает запись от вытеснения; None — промах."""
+        digest = self._digest(key)
+        with self._lock:
+            if digest not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(digest)
+            self._pins[digest] = self._pins.get(digest, 0) + 1
+        path = self.root / digest
+        with contextlib.suppress(OSError):
+            os.utime(path, None)
+        try:
+            meta = json.loads((path / 'meta.json').read_text(encoding='utf-8'))
+        except Exception as e:
+            logger.warning(f"Кэш {self.name}: повреждённая запись {digest}: {e}")
+            self.release(key)
+            return None
+        return path, meta
+
+    def release(self, key: str) -> None:
+        digest = self._digest(key)
+        with self._lock:
+            pins = self._pins.get(digest, 0) - 1
+            if pins > 0:
+                self._pins[digest] = pins
+            else:
+                self._pins.pop(digest, None)
+            victims = self._evict_locked()
+        self._remove(victims)
+
+    def store(self, key: str, src_dir: Path, meta: dict) -> Path:
+        """Переносит src_dir в кэш и возвращает папку записи, уже захваченную как в acquire().
+
+        Если другой воркер успел сохранить ту же запись раньше, берётся его копия.
+        """
+        digest = self._digest(key)
+        staging = self.root / f".tmp-{uuid.uuid4().hex[:12]}"
+        shutil.move(str(src_dir), str(staging))
+        (staging / 'meta.json').write_text(
+            json.dumps({**meta, 'key': key}, ensure_ascii=False), encoding='utf-8'
+        )
+        size = _dir_size(staging)
+        with self._lock:
+            duplicate = digest in self._entries
+            if not duplicate:
+                os.replace(staging, self.root / digest)
+                self._entries[digest] = size
+            self._entries.move_to_end(digest)
+            self._pins[digest] = self._pins.get(digest, 0) + 1
+            victims = self._evict_locked()
+        if duplicate:
+            shutil.rmtree(staging, ignore_errors=True)
+        self._remove(victims)
+        return self.root / digest
+
+    def _evict_locked(self) -> list[str]:
+        total = sum(self._entries.values())
+        victims = []
+        for digest in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if digest in self._pins:
+                continue
+            total -= self._entries.pop(digest)
+            victims.append(digest)
+        return victims
+
+    def _remove(self, victims: list[str]) -> None:
+        for digest in victims:
+            shutil.rmtree(self.root / digest, ignore_errors=True)
+            logger.info(f"Кэш {self.name}: вытеснена запись {digest}")
+
+
+source_cache = DiskCache(CACHE_DIR / "source", SOURCE_CACHE_BUDGET, "source")
+segment_cache = DiskCache(CACHE_DIR / "segments", SEGMENT_CACHE_BUDGET, "segments")
+# Открытый файл блокировки слота кэша этого воркера (держится до выхода процесса)
+_cache_slot = None
+
+
+def _try_lock(f) -> bool:
+    """Эксклюзивная блокировка файла без ожидания; ОС снимает её, когда процесс завершается."""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def claim_worker_cache_dir() -> Path:
+    """Папка кэша процесса --worker: CACHE_DIR/worker-N с первым свободным N.
+
+    DiskCache держит индекс и захваты записей в памяти процесса, поэтому воркеры
+    не делят одну папку. Слот занят, пока открыт заблокированный worker-N.lock:
+    перезапущенный воркер подхватывает кэш завершившегося.
+    """
+    global _cache_slot
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    n = 0
+    while True:
+        f = open(CACHE_DIR / f"worker-{n}.lock", 'a+b')
+        if _try_lock(f):
+            _cache_slot = f
+            return CACHE_DIR / f"worker-{n}"
+        f.close()
+        n += 1
+
+
+class FileIdIndex:
+    """Telegram file_id уже доставленных сегментов (SQLite).
+
+    Ключ — (ID видео, скорость, номер сегмента, профиль кодирования). Таблица
+    renditions отмечает наборы, отправленные целиком: такой запрос можно обслужить
+    одними file_id, без загрузки, кодирования и выгрузки. Рядом с file_id хранится
+    kind — 'audio' или 'document' (так Telegram сохраняет, например, OGG Opus): file_id
+    документа sendAudio не принимает. Используется только из потока event loop.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path))
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS segments (
+                video_id TEXT NOT NULL, speed TEXT NOT NULL, idx INTEGER NOT NULL,
+                profile TEXT NOT NULL, file_id TEXT NOT NULL, kind TEXT NOT NULL DEFAULT 'audio',
+                PRIMARY KEY (video_id, speed, idx, profile)
+            );
+            CREATE TABLE IF NOT EXISTS renditions (
+                video_id TEXT NOT NULL, speed TEXT NOT NULL, profile TEXT NOT NULL,
+                segments INTEGER NOT NULL,
+                PRIMARY KEY (video_id, speed, profile)
+            );
+        ''')
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(segments)')}
+        if 'kind' not in columns:
+            # База от прежней версии: все её file_id — аудио
+            self._db.execute("ALTER TABLE segments ADD COLUMN kind TEXT NOT NULL DEFAULT 'audio'")
+        self._db.commit()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get(self, video_id: str, speed: float, idx: int, profile: str) -> tuple[str, str] | None:
+        """(file_id, kind) сегмента или None."""
+        row = self._db.execute(
+            'SELECT file_id, kind FROM segments WHERE video_id=? AND speed=? AND idx=? AND profile=?',
+            (video_id, f"{speed:.2f}", idx, profile),
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def put(self, video_id: str, speed: float, idx: int, profile: str, file_id: str, kind: str = 'audio') -> None:
+        self._db.execute(
+            'INSERT OR REPLACE INTO segments (video_id, speed, idx, profile, file_id, kind) VALUES (?, ?, ?, ?, ?, ?)',
+            (video_id, f"{speed:.2f}", idx, profile, file_id, kind),
+        )
+        self._db.commit()
+
+    def forget(self, video_id: str, speed: float, idx: int, profile: str) -> None:
+        """Убирает устаревший file_id; набор целиком больше не считается известным."""
+        self._db.execute(
+            'DELETE FROM segments WHERE video_id=? AND speed=? AND idx=? AND profile=?',
+            (video_id, f"{speed:.2f}", idx, profile),
+        )
+        self._db.execute(
+            'DELETE FROM renditions WHERE video_id=? AND speed=? AND profile=?',
+            (video_id, f"{speed:.2f}", profile),
+        )
+        self._db.commit()
+
+    def complete(self, video_id: str, speed: float, profile: str, segments: int) -> None:
+        self._db.execute(
+            'INSERT OR REPLACE INTO renditions VALUES (?, ?, ?, ?)',
+            (video_id, f"{speed:.2f}", profile, segments),
+        )
+        self._db.commit()
+
+    def rendition(self, video_id: str, speed: float, profile: str) -> list[tuple[str, str]] | None:
+        """(file_id, kind) всех сегментов по порядку, если набор был доставлен целиком."""
+        row = self._db.execute(
+            'SELECT segments FROM renditions WHERE video_id=? AND speed=? AND profile=?',
+            (video_id, f"{speed:.2f}", profile),
+        ).fetchone()
+        if not row:
+            return None
+        ids = [self.get(video_id, speed, i, profile) for i in range(1, row[0] + 1)]
+        return None if None in ids else ids
+
+
+file_ids = FileIdIndex(FILE_ID_DB)
+
+
+def rendition_profile(speed: float) -> str:
+    """Профиль набора сегментов для кэша и индекса file_id: от него зависит содержимое файлов."""
+    p = OUTPUT_PROFILE
+    key = f"{OUTPUT_PROFILE_NAME}:{p['codec']}:{p['bitrate']}:{p.get('channels') or 'src'}ch@{SEGMENT_S}s"
+    # На 1.0× с stream copy результат зависит от режима, а не только от профиля
+    if SILENCE_SPLIT:
+        key += f"+silence{SILENCE_WINDOW_S:g}s"
+    return f"copy+{key}" if STREAM_COPY and speed == 1.0 else key
+
+def segment_cache_key(video_id: str, speed: float) -> str:
+    return f"seg:{video_id}:{speed:.2f}:{rendition_profile(speed)}"
+
+def source_cache_key(video_id: str) -> str:
+    return f"src:{video_id}:{DOWNLOAD_FORMAT}"
+
+def cleanup_stale_work_dirs(unfinished: list[dict]) -> None:
+    """Удаляет папки задач в TMP_DIR, кроме папок незавершённых задач из job_store."""
+    keep = {Path(job['work_dir']).resolve() for job in unfinished if job['work_dir']}
+    for stale in TMP_DIR.iterdir():
+        if stale.is_dir() and stale.resolve() not in keep:
+            cleanup_work_dir(stale)
+
 def cleanup_legacy_temp_files():
     """Очищает старые временные файлы в корне проекта (на случай остатков до перехода на tmp/)."""
     temp_patterns = [
@@ -126,32 +1708,82 @@ async def cmd_start(message: types.Message):
 @dp.message(lambda m: 'youtube.com' in m.text or 'youtu.be' in m.text)
 async def handle_link(message: types.Message):
     logger.info(f"Получена ссылка от пользователя {message.from_user.id}: {message.text[:50]}...")
-    dq = pending_videos.setdefault(message.chat.id, deque())
+    # По каноническому ID одинаковые видео склеиваются независимо от формы ссылки
+    url = message.text.strip()
+    video_id = extract_video_id(url)
+    if video_id:
+        url = canonical_video_url(video_id)
+    about = ""
+    playlist_url = None if video_id else collection_url(url)
+    if playlist_url:
+        # Плейлист или канал: список записей одним плоским запросом, сами видео — позже, по одному
+        url = playlist_url
+        try:
+            loop = asyncio.get_event_loop()
+            info = await loop.run_in_executor(executor, probe_collection, url)
+        except Exception as e:
+            await message.answer(str(e))
+            return
+        if not info['entries']:
+            await message.answer("❌ В плейлисте нет доступных видео.")
+            return
+        remember_probe(info, key=url)
+        total = sum(entry['duration'] or 0 for entry in info['entries'])
+        about = f"Плейлист «{info['title']}»: {len(info['entries'])} видео"
+        if total:
+            about += f", {format_duration(total)}"
+        about += ". "
+    elif PREFLIGHT_PROBE:
+        try:
+            info = await preflight(url, video_id)
+        except Exception as e:
+            await message.answer(str(e))
+            return
+        # ID из метаданных — и для ссылок, которые extract_video_id не разобрал
+        if not video_id and info.get('id'):
+            video_id = info['id']
+            url = canonical_video_url(video_id)
+        about = f"«{info.get('title', 'audio')}»"
+        if info.get('duration'):
+            about += f", {format_duration(info['duration'])}"
+        about += ". "
+    pending = pending_videos.setdefault(message.chat.id, {})
     speed_msg = await message.answer(
-        f"Ссылка #{len(dq)+1} в очереди. Выбери скорость:",
+        f"{about}Ссылка #{len(pending)+1} в очереди. Выбери скорость:",
         reply_markup=speed_keyboard()
     )
-    dq.append((message.text.strip(), message.message_id, speed_msg.message_id))
+    pending[speed_msg.message_id] = (url, video_id, message.message_id)
     logger.info(f"Ссылка добавлена в очередь для чата {message.chat.id}")
 
 @dp.callback_query(lambda c: c.data.startswith("speed:"))
 async def handle_speed(cb: types.CallbackQuery):
     chat_id = cb.message.chat.id
     logger.info(f"Получен выбор скорости от пользователя {cb.from_user.id}: {cb.data}")
-    dq = pending_videos.get(chat_id)
-    if not dq:
+    # Скорость относится к ссылке, под которой нажата кнопка
+    speed_msg_id = cb.message.message_id
+    pending = pending_videos.get(chat_id, {})
+    if speed_msg_id not in pending:
         await cb.answer("Сначала отправь ссылку.", show_alert=True)
         return
 
     speed = float(cb.data.split(":", 1)[1])
-    url, orig_msg_id, speed_msg_id = dq.popleft()
+    url, video_id, orig_msg_id = pending.pop(speed_msg_id)
+    if video_id is None and collection_url(url):
+        await start_batch(cb, url, speed, speed_msg_id)
+        return
     try:
         logger.info(f"Добавляем задачу в очередь: URL={url[:50]}..., speed={speed}, chat_id={chat_id}")
-        await task_queue.put((url, chat_id, orig_msg_id, speed))
-        with active_tasks_lock:
-            total_tasks = task_queue.qsize() - 1 + active_tasks
-        logger.info(f"Задача добавлена в очередь. Всего задач: {total_tasks}")
-        await cb.message.answer(f"Задача на {speed}× принята. До тебя в очереди {total_tasks} видео.")
+        status, ahead = await submit_task(url, video_id, chat_id, orig_msg_id, speed)
+        if status == 'attached':
+            await cb.message.answer(f"Это видео на {speed}× уже обрабатывается — пришлю сегменты вместе со всеми.")
+        elif status == 'duplicate':
+            await cb.message.answer(f"Это видео на {speed}× уже в твоей очереди.")
+        else:
+            logger.info(f"Задача добавлена в очередь. В очереди: {task_queue.qsize()}, перед ней: {ahead}")
+            info = cached_probe(video_id)
+            eta = job_eta.estimate(ahead, info.get('duration') if info else None)
+            eta_text = f" Ориентировочно будет готово через {format_duration(eta)}." if eta else ""
+            await cb.message.answer(f"Задача на {speed}× принята. До тебя в очереди {ahead} видео.{eta_text}")
         try:
             await bot.delete_message(chat_id=chat_id, message_id=speed_msg_id)
         except Exception as e:
@@ -160,9 +1792,91 @@ async def handle_speed(cb: types.CallbackQuery):
         await cb.message.answer("Очередь переполнена, попробуй позже.")
     await cb.answer()
 
-def _user_friendly_download_error(exc: Exception) -> str:
-    """Превращает ошибку yt-dlp в понятное сообщение для пользователя."""
-    err = str(exc).lower()
+
+async def start_batch(cb: types.CallbackQuery, url: str, speed: float, speed_msg_id: int) -> None:
+    """Запускает PlaylistBatch по записям, полученным в handle_link."""
+    chat_id = cb.message.chat.id
+    info = cached_probe(url)
+    if info is None:
+        # Кэш протух, пока выбирали скорость — извлекаем список заново
+        try:
+            info = await asyncio.get_event_loop().run_in_executor(executor, probe_collection, url)
+        except Exception as e:
+            await cb.message.answer(str(e))
+            await cb.answer()
+            return
+    batch_id = job_store.add_batch(chat_id, url, info['title'], speed, info['entries'])
+    PlaylistBatch(job_store.unfinished_batch(batch_id)).start()
+    logger.info(f"Плейлист {url} ({len(info['entries'])} видео, {speed}×) принят для чата {chat_id}")
+    await cb.message.answer(
+        f"Плейлист на {speed}× принят: {len(info['entries'])} видео. "
+        "Буду присылать их по порядку, по одному видео в очереди за раз."
+    )
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=speed_msg_id)
+    except Exception as e:
+        logger.error(f"Ошибка удаления сообщения 'Выбери скорость': {e}")
+    await cb.answer()
+
+
+async def preflight(url: str, video_id: str | None) -> dict:
+    """Быстрая проверка ссылки до выбора скорости: метаданные без загрузки.
+
+    Бросает исключение с понятным текстом, если видео скачать не выйдет
+    (приватное, DRM, регион, трансляция) или оно длиннее max_duration_s.
+    """
+    info = cached_probe(video_id)
+    if info is None:
+        loop = asyncio.get_event_loop()
+        info = await loop.run_in_executor(executor, probe_video, url)
+        remember_probe(info)
+    if info.get('is_live'):
+        raise Exception("❌ Это прямая трансляция — дождись её окончания.")
+    duration = info.get('duration') or 0
+    if MAX_DURATION_S and duration > MAX_DURATION_S:
+        raise Exception(f"❌ Видео длиннее {format_duration(MAX_DURATION_S)} ({format_duration(duration)}) — "
+                        "такие не обрабатываю.")
+    return info
+
+
+async def submit_task(url: str, video_id: str | None, chat_id: int, orig_msg_id: int, speed: float,
+                      job: dict | None = None) -> tuple[str, int]:
+    """Ставит задачу в очередь или подписывает чат на такую же задачу в работе.
+
+    Возвращает ('queued', позиция), ('attached', 0) или ('duplicate', 0). job — запись
+    из job_store для задачи, восстановленной после перезапуска.
+    """
+    if job_queue is not None:
+        # Задачи выполняют отдельные воркеры; хранит и раздаёт их общая очередь
+        ahead = await job_queue.submit({
+            'id': uuid.uuid4().hex[:12], 'chat_id': chat_id, 'url': url,
+            'video_id': video_id, 'speed': speed, 'orig_msg_id': orig_msg_id,
+        })
+        return ('duplicate', 0) if ahead is None else ('queued', ahead)
+    resumed_from = job['last_segment'] if job else 0
+    shared = inflight_jobs.get((video_id, speed)) if video_id else None
+    if shared is not None:
+        # То же видео на той же скорости уже в работе — подписываемся на него
+        job_id = job['id'] if job else job_store.add(chat_id, url, video_id, speed, orig_msg_id)
+        if shared.attach(chat_id, orig_msg_id, job_id, start=resumed_from):
+            return 'attached', 0
+        job_store.finish(job_id)
+        return 'duplicate', 0
+    if job is None:
+        if task_queue.full():
+            raise asyncio.QueueFull
+        job_id = job_store.add(chat_id, url, video_id, speed, orig_msg_id)
+    else:
+        job_id = job['id']
+    ahead = await task_queue.put((url, chat_id, orig_msg_id, speed, job_id), force=job is not None)
+    # Продолжение с середины ведущим не делаем: подписчикам нечего было бы переслать
+    if video_id and not resumed_from:
+        inflight_jobs[(video_id, speed)] = SharedJob(video_id, speed, chat_id)
+    return 'queued', ahead
+
+def _user_friendly_download_error(exc: Exception) -> str:
+    """Превращает ошибку yt-dlp в понятное сообщение для пользователя."""
+    err = str(exc).lower()
     if "403" in err or "forbidden" in err:
         return (
             "❌ Доступ к видео запрещён (403).\n\n"
@@ -183,148 +1897,1218 @@ def _user_friendly_download_error(exc: Exception) -> str:
     return f"❌ Не удалось загрузить видео:\n{exc}"
 
 
-async def task_worker():
-    global active_tasks
-    logger.info("Task worker запущен")
+async def task_worker(worker_id: int = 0):
+    logger.info(f"Task worker #{worker_id} запущен")
     while True:
         logger.info("Ожидание задачи из очереди...")
-        url, chat_id, orig_msg_id, speed = await task_queue.get()
-        logger.info(f"Получена задача: URL={url[:50]}..., chat_id={chat_id}, speed={speed}")
-        
-        with active_tasks_lock:
-            active_tasks += 1
-        logger.info(f"Активных задач: {active_tasks}")
+        task = await task_queue.get()
+        try:
+            await run_task(task, worker_id)
+        finally:
+            await task_queue.task_done(task[1])
+
+
+async def run_task(task: tuple[str, int, int, float, str], worker_id: int = 0) -> None:
+    """Выполняет одну задачу (url, chat_id, orig_msg_id, speed, job_id) из любой очереди.
+
+    При отмене (остановка бота) задача и её папка остаются в job_store до следующего запуска.
+    """
+    global active_tasks
+    url, chat_id, orig_msg_id, speed, job_id = task
+    logger.info(f"Воркер #{worker_id} получил задачу: URL={url[:50]}..., chat_id={chat_id}, speed={speed}")
 
+    with active_tasks_lock:
+        active_tasks += 1
+    logger.info(f"Активных задач: {active_tasks}")
+
+    video_id = extract_video_id(url)
+    job = inflight_jobs.get((video_id, speed)) if video_id else None
+    if job is not None and job.leader != chat_id:
+        job = None
+    failed_segments, error_msg = 0, None
+    completed = False
+
+    stored = job_store.get(job_id)
+    resumed = stored is not None and stored['state'] == 'running'
+    # Продолженная задача работает в прежней папке: там может лежать исходник.
+    # Задаче из общей очереди папку назначает job_store.adopt
+    if stored is not None and stored['work_dir']:
+        work_dir = Path(stored['work_dir'])
+    else:
         work_dir = TMP_DIR / uuid.uuid4().hex[:12]
-        work_dir.mkdir(parents=True, exist_ok=True)
-        try:
-            # Пересылаем оригинальное сообщение
+    work_dir.mkdir(parents=True, exist_ok=True)
+    job_store.start(job_id, work_dir)
+    token = current_job_id.set(job_id)
+    started = time.monotonic()
+    trace = JobTrace(job_id, chat_id, url, speed)
+    trace_token = current_trace.set(trace)
+    try:
+        if resumed:
+            logger.info(f"Продолжаем задачу {job_id} после перезапуска с сегмента {stored['last_segment'] + 1}")
+            await bot.send_message(
+                chat_id=chat_id,
+                text=f"Бот перезапускался — продолжаю с сегмента {stored['last_segment'] + 1}.",
+            )
+        elif orig_msg_id:
+            # Пересылаем оригинальное сообщение (у записей плейлиста его нет)
             logger.info(f"Пересылаем оригинальное сообщение в чат {chat_id}")
             await bot.forward_message(chat_id=chat_id, from_chat_id=chat_id, message_id=orig_msg_id)
-            
-            # Обрабатываем видео (все файлы — в work_dir)
-            logger.info(f"Начинаем обработку видео для чата {chat_id}")
-            await process_video(url, chat_id, orig_msg_id, speed, work_dir)
-            logger.info(f"Обработка видео завершена для чата {chat_id}")
-            
+
+        # Обрабатываем видео (все файлы — в work_dir)
+        logger.info(f"Начинаем обработку видео для чата {chat_id}")
+        failed_segments = await process_video(url, chat_id, orig_msg_id, speed, work_dir)
+        completed = True
+        logger.info(f"Обработка видео завершена для чата {chat_id}")
+
+    except Exception as e:
+        completed = True
+        msg = str(e).strip()
+        error_msg = msg if msg.startswith("❌") else f"❌ Ошибка при обработке видео:\n{msg}"
+        await bot.send_message(chat_id=chat_id, text=error_msg)
+        logger.error(f"Ошибка обработки видео {url}: {e}")
+
+    finally:
+        with active_tasks_lock:
+            active_tasks -= 1
+        current_job_id.reset(token)
+        current_trace.reset(trace_token)
+        if job is not None:
+            # Новые запросы после этого момента обслужит индекс file_id
+            inflight_jobs.pop((video_id, speed), None)
+        if completed:
+            result = 'error' if error_msg else 'partial' if failed_segments else 'ok'
+            jobs_total.inc(result=result)
+            trace.emit(result)
+            if job is not None:
+                await job.finish(failed_segments, error_msg)
+            # Длительность записана, только если исходник качался, а не взят из кэша
+            done = job_store.get(job_id)
+            if result == 'ok' and done and done['duration'] and not resumed:
+                job_eta.observe(time.monotonic() - started, done['duration'])
+            job_store.finish(job_id)
+            cleanup_work_dir(work_dir)
+            resolve_batch_waiter(job_id)
+
+
+async def queue_worker(worker_id: int, running: dict[str, asyncio.Task], lost: set[str]) -> None:
+    """Воркер процесса python Bot.py --worker: берёт задачи из общей очереди job_queue.
+
+    running — выполняемые задачи этого процесса (их аренду продлевает queue_heartbeat),
+    lost — задачи, аренду которых забрали: их отмена не означает остановку воркера.
+    """
+    logger.info(f"Воркер очереди #{worker_id} запущен ({WORKER_NAME})")
+    while True:
+        try:
+            claimed = await job_queue.claim(WORKER_NAME)
         except Exception as e:
-            msg = str(e).strip()
-            error_msg = msg if msg.startswith("❌") else f"❌ Ошибка при обработке видео:\n{msg}"
-            await bot.send_message(chat_id=chat_id, text=error_msg)
-            logger.error(f"Ошибка обработки видео {url}: {e}")
-                
-        finally:
-            task_queue.task_done()
-            with active_tasks_lock:
-                active_tasks -= 1
+            logger.error(f"Очередь задач недоступна: {e}")
+            claimed = None
+        if claimed is None:
+            await asyncio.sleep(QUEUE_POLL_S)
+            continue
+        job_id = claimed['id']
+        if claimed['attempts'] > QUEUE_MAX_ATTEMPTS:
+            logger.error(f"Задача {job_id} прерывалась {claimed['attempts'] - 1} раз — снимаем её")
+            with contextlib.suppress(Exception):
+                await bot.send_message(chat_id=claimed['chat_id'],
+                                       text="❌ Не удалось обработать видео: обработка несколько раз прерывалась.")
+            await job_queue.complete(WORKER_NAME, job_id)
+            continue
+        # Задачу начинал другой воркер — продолжаем с последнего доставленного сегмента
+        work_dir = job_store.adopt(claimed, resumed=claimed['attempts'] > 1 or claimed['last_segment'] > 0)
+        running[job_id] = asyncio.create_task(run_task(
+            (claimed['url'], claimed['chat_id'], claimed['orig_msg_id'], claimed['speed'], job_id), worker_id,
+        ))
+        try:
+            await running[job_id]
+        except asyncio.CancelledError:
+            stored = job_store.get(job_id)
+            if job_id not in lost:
+                # Воркер останавливается: сразу возвращаем задачу в очередь, не дожидаясь аренды
+                with contextlib.suppress(Exception):
+                    await job_queue.release(WORKER_NAME, job_id, stored['last_segment'] if stored else 0)
+                raise
+            logger.warning(f"Задачу {job_id} забрали у воркера {WORKER_NAME} (аренда истекла)")
+            # Запись в общей базе машины мог уже перенять другой воркер — тогда она его
+            if job_store.owned(job_id):
+                job_store.finish(job_id)
             cleanup_work_dir(work_dir)
+        else:
+            try:
+                await job_queue.complete(WORKER_NAME, job_id)
+            except Exception as e:
+                logger.error(f"Не удалось отметить задачу {job_id} выполненной: {e}")
+        finally:
+            running.pop(job_id, None)
+            lost.discard(job_id)
+
+
+async def queue_heartbeat(running: dict[str, asyncio.Task], lost: set[str]) -> None:
+    """Продлевает аренду задач процесса и сообщает очереди доставленные сегменты."""
+    while True:
+        await asyncio.sleep(QUEUE_HEARTBEAT_S)
+        progress = {job_id: (job_store.get(job_id) or {}).get('last_segment', 0) for job_id in running}
+        try:
+            gone = await job_queue.heartbeat(WORKER_NAME, progress)
+        except Exception as e:
+            logger.warning(f"Heartbeat не отправлен: {e}")
+            continue
+        for job_id in gone:
+            if job_id in running:
+                lost.add(job_id)
+                running[job_id].cancel()
+
+
+def atempo_filter(s: float) -> str:
+    parts = []
+    while s > 2.0:
+        parts.append('atempo=2.0')
+        s /= 2.0
+    parts.append(f'atempo={s:.2f}')
+    return ','.join(parts)
+
+
+# Без SIGSTOP (Windows) ffmpeg на паузу не поставить — см. produce_segments и _feed_stdin
+CAN_SUSPEND = hasattr(signal, 'SIGSTOP')
+
+
+def _suspend_process(proc) -> bool:
+    """Приостанавливает процесс (SIGSTOP). На платформах без сигналов — ничего не делает."""
+    if not CAN_SUSPEND or proc.returncode is not None:
+        return False
+    proc.send_signal(signal.SIGSTOP)
+    return True
+
+def _resume_process(proc) -> None:
+    if hasattr(signal, 'SIGCONT') and proc.returncode is None:
+        proc.send_signal(signal.SIGCONT)
+
+
+class SegmentBuffer:
+    """Очередь готовых сегментов между ffmpeg и отправкой в Telegram.
+
+    Ограничена и по числу файлов (segment_prefetch), и по их суммарному размеру
+    (segment_disk_budget_mb). Событие room сброшено, пока места нет, — по нему
+    segment_audio ставит ffmpeg на паузу.
+    """
+
+    def __init__(self, depth: int, max_bytes: int):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.room = asyncio.Event()
+        self.room.set()
+        self._items: deque[tuple[Path, int]] = deque()
+        self._bytes = 0
+        self._closed = False
+        self._changed = asyncio.Condition()
+
+    def _update_room(self) -> None:
+        # Пустой буфер всегда «с местом», иначе один крупный сегмент заблокирует всё
+        if not self._items or (len(self._items) < self.depth and self._bytes < self.max_bytes):
+            self.room.set()
+        else:
+            self.room.clear()
+
+    async def put(self, path: Path) -> None:
+        size = path.stat().st_size if path.exists() else 0
+        async with self._changed:
+            self._items.append((path, size))
+            self._bytes += size
+            self._update_room()
+            self._changed.notify_all()
+
+    async def close(self) -> None:
+        async with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    async def get(self) -> Path | None:
+        """Следующий сегмент по порядку; None — ffmpeg закончил и буфер пуст."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._items or self._closed)
+            if not self._items:
+                return None
+            path, size = self._items.popleft()
+            self._bytes -= size
+            self._update_room()
+            return path
 
 
-def process_segment(input_file: str, start: float, duration: float, filter_str: str, output_file: str):
-    """Обработка одного сегмента аудио"""
+class StreamFeed:
+    """Мост «поток загрузки → stdin ffmpeg»: ограниченная очередь кусков.
+
+    Поток загрузки кладёт куски через put() и ждёт, пока ffmpeg их не заберёт
+    (в том числе пока ffmpeg стоит на паузе). None — конец данных, исключение —
+    ошибка загрузки. После close() put() бросает StreamFeed.Closed.
+    """
+
+    class Closed(Exception):
+        pass
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int = 32):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._closed = threading.Event()
+
+    def put(self, item) -> None:
+        """Вызывается из потока загрузки."""
+        if self._closed.is_set():
+            raise StreamFeed.Closed
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self) -> None:
+        """Вызывается из event loop; освобождает поток загрузки, если тот ждёт места."""
+        self._closed.set()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+async def _feed_stdin(proc, feed: StreamFeed, room: asyncio.Event | None = None) -> None:
+    """Пишет вход из feed в stdin ffmpeg; пока room сброшен, вход не подаётся и ffmpeg простаивает."""
+    try:
+        while (chunk := await feed.get()) is not None:
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if room is not None:
+                await room.wait()
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg завершился раньше — его собственная ошибка всплывёт из segment_audio
+        pass
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+        raise
+    finally:
+        feed.close()
+        with contextlib.suppress(Exception):
+            proc.stdin.close()
+
+
+def output_plan(speed: float, source_codec: str | None) -> tuple[list[str], str]:
+    """Аргументы ffmpeg для аудио и расширение сегментов.
+
+    На 1.0× кодек источника, который Telegram примет как есть (Opus/Vorbis → OGG,
+    AAC → M4A, MP3), копируется без перекодирования. Иначе — atempo и выбранный профиль.
+    """
+    if STREAM_COPY and speed == 1.0 and source_codec:
+        ext = COPY_CONTAINERS.get(source_codec.split('.')[0].lower())
+        if ext:
+            return ['-c:a', 'copy'], ext
+    args = [] if speed == 1.0 else ['-filter:a', atempo_filter(speed)]
+    args += ['-c:a', OUTPUT_PROFILE['codec'], '-b:a', str(OUTPUT_PROFILE['bitrate'])]
+    if OUTPUT_PROFILE.get('channels'):
+        args += ['-ac', str(OUTPUT_PROFILE['channels'])]
+    return args, OUTPUT_PROFILE['ext']
+
+
+def quiet_cut_points(blocks, rate: int, targets: list[float], ranges: list[tuple[float, float]]) -> list[float]:
+    """Самая тихая точка в каждом диапазоне ranges (секунды от начала PCM).
+
+    blocks — куски моно PCM int16 подряд. Огибающая RMS считается векторно по кадрам
+    SILENCE_FRAME_S и целиком не хранится: из каждого куска берутся только кадры ещё
+    не пройденных диапазонов, так что память не растёт с длиной входа. Уровень
+    округляется до 1 дБ — из одинаково тихих кадров берётся ближайший к target.
+    """
+    # numpy нужен только для silence_split
+    import numpy as np
+    frame = max(1, int(rate * SILENCE_FRAME_S))
+    best: list[tuple | None] = [None] * len(targets)  # (уровень дБ, расстояние, время)
+    carry = np.empty(0, dtype=np.int16)
+    offset = 0  # номер первого сэмпла carry
+    first = 0  # первый диапазон, который ещё не пройден
+    for block in blocks:
+        samples = np.concatenate((carry, block)) if carry.size else block
+        n = samples.size // frame
+        if n:
+            frames = samples[:n * frame].reshape(n, frame).astype(np.float32) / 32768
+            level = np.round(10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10))
+            times = (offset + (np.arange(n) + 0.5) * frame) / rate
+            end = (offset + n * frame) / rate
+            i = first
+            while i < len(targets) and ranges[i][0] < end:
+                lo, hi = ranges[i]
+                mask = (times >= lo) & (times <= hi)
+                if mask.any():
+                    dist = np.abs(times[mask] - targets[i])
+                    k = np.lexsort((dist, level[mask]))[0]
+                    candidate = (level[mask][k], dist[k], float(times[mask][k]))
+                    if best[i] is None or candidate[:2] < best[i][:2]:
+                        best[i] = candidate
+                i += 1
+            while first < len(targets) and ranges[first][1] <= end:
+                first += 1
+        carry = samples[n * frame:]
+        offset += n * frame
+    return [t if c is None else c[2] for t, c in zip(targets, best)]
+
+
+def analyze_cut_points(input_file: str, duration: float, segment_in_s: float, window: float) -> list[float]:
+    """Точки реза по паузам (секунды входа) для всех границ сегментов.
+
+    Декодируются только окна ±window вокруг номинальных границ: один ffmpeg на группу
+    до SILENCE_GROUP окон (-ss/-t на каждый вход, concat) отдаёт их подряд как PCM 8 кГц
+    моно, а NumPy ищет в каждом окне самую тихую точку. Работает в потоке executor;
+    при ошибке ffmpeg возвращает номинальные границы.
+    """
+    import numpy as np
+    boundaries = [k * segment_in_s for k in range(1, math.ceil(duration / segment_in_s))]
+    # Окно не выходит за конец входа, иначе тишина дополнения выиграет у настоящих пауз
+    windows = [(max(0.0, b - window), min(duration, b + window)) for b in boundaries]
+    block_bytes = SILENCE_RATE * 2 * SILENCE_BLOCK_S
+    cuts = []
+    with timed_stage('silence_analysis'):
+        for start in range(0, len(windows), SILENCE_GROUP):
+            group = windows[start:start + SILENCE_GROUP]
+            cmd = ['ffmpeg', '-v', 'error']
+            filters, labels, ranges, targets, offset = [], '', [], [], 0.0
+            for i, (lo, hi) in enumerate(group):
+                length = hi - lo
+                cmd += ['-ss', f"{lo:.3f}", '-t', f"{length:.3f}", '-i', input_file]
+                # Длина каждого окна в PCM точно равна length — по ней время переводится обратно
+                filters.append(f"[{i}:a]aformat=sample_fmts=s16:sample_rates={SILENCE_RATE}:channel_layouts=mono,"
+                               f"apad=whole_dur={length:.3f},atrim=duration={length:.3f}[w{i}]")
+                labels += f"[w{i}]"
+                ranges.append((offset, offset + length))
+                targets.append(offset + boundaries[start + i] - lo)
+                offset += length
+            cmd += ['-filter_complex', ';'.join(filters) + f";{labels}concat=n={len(group)}:v=0:a=1[out]",
+                    '-map', '[out]', '-f', 's16le', 'pipe:1']
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            with proc:
+                blocks = iter(lambda: proc.stdout.read(block_bytes), b'')
+                found = quiet_cut_points(
+                    (np.frombuffer(data[:len(data) // 2 * 2], dtype='<i2') for data in blocks),
+                    SILENCE_RATE, targets, ranges,
+                )
+            if proc.returncode != 0:
+                logger.warning(f"Анализ пауз не удался (ffmpeg {proc.returncode}), режем по фиксированным границам")
+                return boundaries
+            cuts += [lo + (t - r_lo) for (lo, _), (r_lo, _), t in zip(group, ranges, found)]
+    shifts = [round(c - b, 1) for c, b in zip(cuts, boundaries)]
+    logger.info(f"Точки реза по паузам: сдвиги {shifts} с")
+    return cuts
+
+
+async def segment_audio(input_file: str, audio_args: list[str], ext: str, work_dir: Path, title_safe: str,
+                        room: asyncio.Event | None = None, feed: StreamFeed | None = None,
+                        start_at: float = 0.0, start_number: int = 1, segment_times: list[float] | None = None):
+    """Режет аудио на сегменты за один запуск ffmpeg.
+
+    Вход декодируется один раз, цепочка atempo строится один раз, а сегментный муксер
+    пишет все пронумерованные файлы подряд (audio_args и ext — из output_plan). Путь к сегменту отдаётся сразу, как только
+    ffmpeg его закрыл (имена приходят через -segment_list в stdout).
+    Если передан room, то пока он сброшен, ffmpeg стоит на паузе. С feed вход
+    (input_file='pipe:0') подаётся в stdin по мере загрузки. start_at/start_number —
+    продолжение с середины: позиция во входе (с) и номер первого сегмента.
+    segment_times — явные точки реза (с от start_at, в шкале результата) вместо равных отрезков.
+    """
+    # Длина сегмента задаётся в выходной шкале времени, т.е. уже после atempo
+    pattern = work_dir / f"%02d__{title_safe.replace('%', '%%')}.{ext}"
+    if segment_times is None:
+        split = ['-segment_time', str(SEGMENT_S)]
+    else:
+        # Пустой список — остался последний сегмент: точка за концом входа не режет ничего
+        split = ['-segment_times', ','.join(f"{t:.3f}" for t in segment_times) or '1e9']
     cmd = [
-        'ffmpeg', '-y', '-ss', str(start), '-t', str(duration),
-        '-i', input_file, '-filter:a', filter_str, output_file
+        'ffmpeg', '-y', '-v', 'error', *(['-ss', str(start_at)] if start_at else []),
+        '-i', input_file, '-vn', *audio_args,
+        '-f', 'segment', *split, '-segment_start_number', str(start_number),
+        '-reset_timestamps', '1', '-segment_list', 'pipe:1', '-segment_list_type', 'flat',
+        str(pattern),
     ]
+    await ffmpeg_slots.acquire()
+    holds_slot = True
     try:
-        return subprocess.run(cmd, check=True, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-    except UnicodeDecodeError:
-        # Если UTF-8 не работает, используем бинарный режим
-        return subprocess.run(cmd, check=True, capture_output=True)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.PIPE if feed is not None else asyncio.subprocess.DEVNULL,
+        )
+    except BaseException:
+        ffmpeg_slots.release()
+        raise
+    # stderr читаем параллельно, чтобы ffmpeg не встал на переполненном пайпе
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    # Без SIGSTOP ffmpeg со стриминговым входом останавливается, оставшись без данных
+    writer = (asyncio.create_task(_feed_stdin(proc, feed, None if CAN_SUSPEND else room))
+              if feed is not None else None)
+    try:
+        # Время кодирования сегмента — от закрытия предыдущего, без пауз по backpressure
+        encode_started = time.monotonic()
+        async for line in proc.stdout:
+            name = line.decode('utf-8', errors='ignore').strip()
+            if name:
+                path = work_dir / Path(name).name
+                observe_stage('encode', time.monotonic() - encode_started)
+                with contextlib.suppress(OSError):
+                    count_bytes('encoded', path.stat().st_size)
+                yield path
+            if room is not None and not room.is_set():
+                suspended = _suspend_process(proc)
+                if suspended:
+                    # Остановленный ffmpeg не занимает CPU — отдаём слот другим задачам
+                    ffmpeg_slots.release()
+                    holds_slot = False
+                await room.wait()
+                if suspended:
+                    await ffmpeg_slots.acquire()
+                    holds_slot = True
+                    _resume_process(proc)
+            encode_started = time.monotonic()
+        await proc.wait()
+        stderr = (await stderr_task).decode('utf-8', errors='ignore')
+        # Ошибка загрузки важнее кода возврата ffmpeg, которого из-за неё убили
+        if writer is not None and writer.done():
+            writer.result()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        if not stderr_task.done():
+            stderr_task.cancel()
+        if writer is not None and not writer.done():
+            writer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await writer
+        if holds_slot:
+            ffmpeg_slots.release()
 
 
-async def process_video(video_url: str, chat_id: int, orig_msg_id: int, speed: float, work_dir: Path):
-    logger.info(f"process_video вызвана: URL={video_url[:50]}..., chat_id={chat_id}, speed={speed}")
-    loop = asyncio.get_event_loop()
+async def publish_segment(video_id: str | None, speed: float, idx: int, file_id: str | None,
+                          kind: str = 'audio') -> None:
+    """Передаёт file_id доставленного сегмента подписчикам общей задачи, если они есть."""
+    job = inflight_jobs.get((video_id, speed)) if video_id else None
+    if job is not None and file_id:
+        await job.publish(idx, file_id, kind)
+
 
-    def blocking_download():
+async def send_file_id(chat_id: int, file_id: str, kind: str = 'audio') -> None:
+    """Отправляет уже загруженный файл по file_id тем методом, каким его сохранил Telegram."""
+    if kind == 'document':
+        await bot.send_document(chat_id=chat_id, document=file_id)
+    else:
+        await bot.send_audio(chat_id=chat_id, audio=file_id)
+
+
+async def deliver_segment(chat_id: int, path: Path, video_id: str | None, speed: float, idx: int) -> None:
+    """Отправляет сегмент: по известному file_id, если он есть, иначе загрузкой файла.
+
+    file_id загруженного файла запоминается. Если Telegram отверг старый file_id,
+    он забывается, и файл загружается заново.
+    """
+    if video_id:
+        known = file_ids.get(video_id, speed, idx, rendition_profile(speed))
+        if known:
+            file_id, kind = known
+            try:
+                with timed_stage('send_file_id'):
+                    await send_file_id(chat_id, file_id, kind)
+                file_ids.hits += 1
+                job_store.checkpoint(current_job_id.get(), idx)
+                await publish_segment(video_id, speed, idx, file_id, kind)
+                return
+            except TelegramBadRequest as e:
+                logger.warning(f"file_id сегмента {idx} ({video_id}) отвергнут: {e}")
+                file_ids.stale += 1
+                file_ids.forget(video_id, speed, idx, rendition_profile(speed))
+        file_ids.misses += 1
+    size = path.stat().st_size
+    with timed_stage('send_audio'):
+        msg = await bot.send_audio(chat_id=chat_id, audio=FSInputFile(str(path)))
+    count_bytes('uploaded', size)
+    job_store.checkpoint(current_job_id.get(), idx)
+    # Не-MP3/M4A (например, OGG Opus) Telegram может сохранить как документ
+    kind = 'audio' if msg.audio else 'document'
+    media = msg.audio or msg.document
+    if video_id and media:
+        file_ids.put(video_id, speed, idx, rendition_profile(speed), media.file_id, kind)
+        await publish_segment(video_id, speed, idx, media.file_id, kind)
+
+
+async def send_known_file_ids(video_id: str, speed: float, chat_id: int, skip: int = 0) -> tuple[int, int] | None:
+    """Пересылает целиком доставленный ранее набор по file_id, кроме первых skip.
+
+    Возвращает (доставлено, всего) или None, если набор неизвестен. Отправка
+    останавливается на первом отвергнутом file_id — остальное догрузит обычный путь.
+    """
+    known = file_ids.rendition(video_id, speed, rendition_profile(speed))
+    if not known:
+        return None
+    logger.info(f"Набор {video_id}@{speed} известен по file_id ({len(known)} шт.), отправляем в чат {chat_id}")
+    for idx, (file_id, kind) in enumerate(known, 1):
+        if idx <= skip:
+            continue
         try:
-            logger.info(f"Начинаем загрузку видео: {video_url[:50]}...")
-            # Все файлы задачи — в папке work_dir
-            filename_template = str(work_dir / 'input.%(ext)s')
-            logger.info(f"Шаблон имени файла: {filename_template}")
-            
-            opts = {
-                'format': 'bestaudio/best',
-                'outtmpl': filename_template,
-                'quiet': True,
-                'no-playlist': True,
-                'noprogress': True,
-                'retries': 5,
-                'fragment_retries': 5,
-                'file_access_retries': 5,
-                'sleep_interval': 1,
-                'max_sleep_interval': 5,
-                'ignoreerrors': False,
-                'no_warnings': False,
-                # Один поток загрузки фрагментов — стабильнее, меньше шанс блокировки
-                'concurrent_fragment_downloads': 1,
-                'extractor_args': {
-                    'youtube': {
-                        'player_client': YOUTUBE_PLAYER_CLIENTS,
-                    }
-                },
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
-                                  '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-                },
-                'socket_timeout': 30,
+            with timed_stage('send_file_id'):
+                await send_file_id(chat_id, file_id, kind)
+            file_ids.hits += 1
+            job_store.checkpoint(current_job_id.get(), idx)
+            await publish_segment(video_id, speed, idx, file_id, kind)
+        except TelegramBadRequest as e:
+            logger.warning(f"file_id сегмента {idx} ({video_id}) отвергнут, загружаем заново: {e}")
+            file_ids.stale += 1
+            file_ids.forget(video_id, speed, idx, rendition_profile(speed))
+            return idx - 1, len(known)
+    return len(known), len(known)
+
+
+async def send_cached_segments(key: str, chat_id: int, video_id: str, speed: float, skip: int = 0) -> bool:
+    """Отправляет сегменты из кэша, кроме первых skip; False — в кэше их нет."""
+    cached = segment_cache.acquire(key)
+    if cached is None:
+        return False
+    entry, meta = cached
+    try:
+        # Номер сегмента — числовой префикс «NN__»: со 100-го строковая сортировка ставит 100 перед 11
+        segments = sorted((p for p in entry.iterdir() if p.name != 'meta.json'),
+                          key=lambda p: int(p.name.split('__', 1)[0]))
+        logger.info(f"Сегменты найдены в кэше ({len(segments)} шт.), отправляем в чат {chat_id}")
+        for i, path in enumerate(segments, 1):
+            if i <= skip:
+                continue
+            await deliver_segment(chat_id, path, video_id, speed, i)
+            logger.info(f"Сегмент {i} из кэша отправлен в чат {chat_id}")
+        file_ids.complete(video_id, speed, rendition_profile(speed), len(segments))
+    finally:
+        segment_cache.release(key)
+    return True
+
+
+def build_ydl_opts(filename_template: str | None = None) -> dict:
+    """Опции yt-dlp: клиенты YouTube, PO Token и cookies из config.yaml."""
+    opts = {
+        'format': DOWNLOAD_FORMAT,
+        'quiet': True,
+        'noplaylist': True,
+        'noprogress': True,
+        'retries': 5,
+        'fragment_retries': 5,
+        'file_access_retries': 5,
+        'ignoreerrors': False,
+        'no_warnings': False,
+        # Фрагменты (DASH/HLS) — стартовым числом соединений; адаптивная загрузка — в RangeDownload
+        'concurrent_fragment_downloads': DOWNLOAD_CONNECTIONS_START,
+        'extractor_args': {
+            'youtube': {
+                'player_client': YOUTUBE_PLAYER_CLIENTS,
             }
+        },
+        'http_headers': {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                          '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+        },
+        'socket_timeout': 30,
+        'cachedir': str(YDL_CACHE_DIR),
+    }
 
-            # Если задан PO Token (см. issue 12482/PO Token Guide) — используем
-            youtube_po_token = cfg.get("youtube_po_token")
-            if youtube_po_token:
-                try:
-                    opts['extractor_args']['youtube']['po_token'] = [str(youtube_po_token)]
-                except Exception:
-                    pass
+    # Если задан PO Token (см. issue 12482/PO Token Guide) — используем
+    youtube_po_token = cfg.get("youtube_po_token")
+    if youtube_po_token:
+        try:
+            opts['extractor_args']['youtube']['po_token'] = [str(youtube_po_token)]
+        except Exception:
+            pass
 
-            # Если хотим включить форматы без PO Token (может привести к 403, но иногда помогает)
-            if cfg.get("youtube_formats_missing_pot"):
-                try:
-                    opts['extractor_args']['youtube']['formats'] = ['missing_pot']
-                except Exception:
-                    pass
-
-            # Cookies (часто критично против 403): либо cookiefile, либо cookies_from_browser
-            cookiefile = cfg.get("youtube_cookiefile")
-            if cookiefile:
-                opts["cookiefile"] = str(cookiefile)
-
-            cookies_from_browser = cfg.get("youtube_cookies_from_browser")
-            if cookies_from_browser:
-                # формат: "firefox" или "chrome", опционально можно передать как список в config
-                opts["cookiesfrombrowser"] = cookies_from_browser
-
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                logger.info("Создан экземпляр YoutubeDL, начинаем извлечение информации...")
-                info = ydl.extract_info(video_url, download=True)
-                logger.info("Информация о видео извлечена, проверяем результат...")
-                if not info:
-                    raise Exception("Не удалось получить информацию о видео")
-                title = info.get('title', 'audio')
-                safe_title = sanitize_filename(title)
-                logger.info(f"Название видео: {title}")
-                path = ydl.prepare_filename(info)
-                logger.info(f"Путь к файлу: {path}")
-                if not path or not os.path.exists(path):
-                    raise Exception("Файл не был загружен")
-                logger.info(f"Файл успешно загружен: {path}")
-                return path, safe_title
-        except Exception as e:
-            logger.error(f"Ошибка загрузки видео {video_url}: {e}")
-            raise Exception(_user_friendly_download_error(e))
-        except UnicodeDecodeError as e:
-            logger.error(f"Ошибка кодировки при загрузке видео {video_url}: {e}")
-            raise Exception(f"Ошибка кодировки при загрузке видео: {e}")
+    # Если хотим включить форматы без PO Token (может привести к 403, но иногда помогает)
+    if cfg.get("youtube_formats_missing_pot"):
+        try:
+            opts['extractor_args']['youtube']['formats'] = ['missing_pot']
+        except Exception:
+            pass
 
-    logger.info("Запускаем загрузку в отдельном потоке...")
-    input_file, title_safe = await loop.run_in_executor(executor, blocking_download)
-    logger.info(f"Загрузка завершена: {input_file}")
+    # Cookies (часто критично против 403): либо cookiefile, либо cookies_from_browser
+    cookiefile = cfg.get("youtube_cookiefile")
+    if cookiefile:
+        opts["cookiefile"] = str(cookiefile)
+
+    cookies_from_browser = cfg.get("youtube_cookies_from_browser")
+    if cookies_from_browser:
+        # формат: "firefox" или "chrome", опционально можно передать как список в config
+        opts["cookiesfrombrowser"] = cookies_from_browser
+
+
+    if YDL_SLEEP_INTERVAL:
+        opts['sleep_interval'] = YDL_SLEEP_INTERVAL
+        opts['max_sleep_interval'] = YDL_SLEEP_INTERVAL * 5
+
+    if filename_template:
+        opts['outtmpl'] = filename_template
+    return opts
 
-    def get_duration(path: str) -> float:
-        cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-               '-of', 'default=noprint_wrappers=1:nokey=1', path]
+
+class YdlPool:
+    """Пул долгоживущих экземпляров YoutubeDL с общими опциями.
+
+    Экземпляр держит экстракторы YouTube с загруженным player JS и расшифровкой
+    подписей; новый YoutubeDL на каждую задачу всё это терял бы. Экземпляр не
+    потокобезопасен, поэтому поток executor берёт его на время одного вызова.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle: list[yt_dlp.YoutubeDL] = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    def _create(self) -> yt_dlp.YoutubeDL:
+        try:
+            return yt_dlp.YoutubeDL(build_ydl_opts())
+        except BaseException:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    def _take(self) -> yt_dlp.YoutubeDL:
+        with self._cond:
+            self._cond.wait_for(lambda: self._idle or self._created < self.size)
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        return self._create()
+
+    def _give(self, ydl: yt_dlp.YoutubeDL) -> None:
+        with self._cond:
+            self._idle.append(ydl)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def get(self, outtmpl: str | None = None, **params):
+        """Экземпляр на время блока; outtmpl и params действуют только в этом вызове."""
+        ydl = self._take()
+        templates = ydl.params['outtmpl']
+        previous = templates.get('default')
+        saved = {key: ydl.params.get(key) for key in params}
+        if outtmpl:
+            templates['default'] = outtmpl
+        ydl.params.update(params)
+        try:
+            yield ydl
+        finally:
+            templates['default'] = previous
+            ydl.params.update(saved)
+            self._give(ydl)
+
+    def warm(self) -> None:
+        """Создаёт недостающие экземпляры и прогревает каждый извлечением YDL_WARMUP_URL."""
+        started = time.monotonic()
+        network = bool(YDL_WARMUP_URL)
+        while True:
+            with self._cond:
+                if self._created >= self.size:
+                    break
+                self._created += 1
+            ydl = self._create()
+            try:
+                ydl.get_info_extractor('Youtube')
+                if network:
+                    ydl.extract_info(YDL_WARMUP_URL, download=False)
+            except Exception as e:
+                # Без сети прогреваться дальше бессмысленно; экземпляры всё равно пригодятся
+                logger.warning(f"Прогрев yt-dlp не удался: {e}")
+                network = False
+            finally:
+                self._give(ydl)
+        logger.info(f"Пул yt-dlp готов: {self.size} экз. за {time.monotonic() - started:.1f} с, кэш {YDL_CACHE_DIR}")
+
+    def close(self) -> None:
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for ydl in idle:
+            with contextlib.suppress(Exception):
+                ydl.close()
+
+
+ydl_pool = YdlPool(YDL_POOL_SIZE)
+# Метаданные из предпроверки по ID видео: (время получения, info dict)
+probe_cache: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+PROBE_CACHE_SIZE = 64
+
+
+def remember_probe(info: dict, key: str | None = None) -> None:
+    key = key or info.get('id')
+    if not key:
+        return
+    probe_cache[key] = (time.monotonic(), info)
+    probe_cache.move_to_end(key)
+    while len(probe_cache) > PROBE_CACHE_SIZE:
+        probe_cache.popitem(last=False)
+
+
+def cached_probe(video_id: str | None) -> dict | None:
+    """Свежие метаданные из предпроверки (по ID видео или ссылке плейлиста) или None."""
+    entry = probe_cache.get(video_id) if video_id else None
+    if entry is None or time.monotonic() - entry[0] > PROBE_TTL_S:
+        return None
+    return entry[1]
+
+
+def probe_video(video_url: str) -> dict:
+    """Метаданные видео без загрузки (download=False): название, длительность, ссылка на поток."""
+    started = time.monotonic()
+    try:
+        with ydl_pool.get() as ydl:
+            info = ydl.extract_info(video_url, download=False)
+    except Exception as e:
+        observe_stage('probe', time.monotonic() - started)
+        logger.error(f"Ошибка получения метаданных {video_url}: {e}")
+        raise Exception(_user_friendly_download_error(e))
+    if not info:
+        raise Exception("Не удалось получить информацию о видео")
+    observe_stage('probe', time.monotonic() - started, _player_client(info))
+    return info
+
+
+def probe_collection(url: str) -> dict:
+    """Записи плейлиста или канала одним плоским извлечением (extract_flat), без запроса каждого видео.
+
+    Возвращает {'id', 'title', 'entries': [{'id', 'title', 'duration'}]}; приватные,
+    удалённые, идущие трансляции и видео длиннее max_duration_s пропускаются.
+    """
+    started = time.monotonic()
+    try:
+        with ydl_pool.get(extract_flat='in_playlist', noplaylist=False, playlistend=BATCH_MAX_VIDEOS) as ydl:
+            info = ydl.extract_info(url, download=False)
+    except Exception as e:
+        observe_stage('probe', time.monotonic() - started)
+        logger.error(f"Ошибка получения списка {url}: {e}")
+        raise Exception(_user_friendly_download_error(e))
+    observe_stage('probe', time.monotonic() - started)
+    entries = []
+    for entry in (info or {}).get('entries') or []:
+        video_id = (entry or {}).get('id')
+        # Вложенные плейлисты и вкладки канала — не видео
+        if not video_id or not _VIDEO_ID_RE.match(video_id):
+            continue
+        if entry.get('live_status') in ('is_live', 'is_upcoming'):
+            continue
+        if entry.get('title') in ('[Private video]', '[Deleted video]'):
+            continue
+        if MAX_DURATION_S and (entry.get('duration') or 0) > MAX_DURATION_S:
+            continue
+        entries.append({'id': video_id, 'title': entry.get('title') or video_id, 'duration': entry.get('duration')})
+    logger.info(f"Список {url}: {len(entries)} видео за {time.monotonic() - started:.1f} с")
+    return {'id': (info or {}).get('id'), 'title': (info or {}).get('title') or url, 'entries': entries}
+
+
+def _is_streamable(info: dict) -> bool:
+    """Поток можно отдавать ffmpeg через pipe: прямой http(s) и контейнер без seek назад."""
+    return bool(
+        info.get('url')
+        and info.get('duration')
+        and info.get('protocol') in ('http', 'https')
+        and info.get('ext') in STREAMABLE_EXTS
+    )
+
+
+class BandwidthBudget:
+    """Общий лимит скорости загрузки для всех задач (байт/с); вызывается из потоков загрузки."""
+
+    BURST_S = 0.5
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def take(self, amount: int) -> None:
+        """Ждёт, пока amount уже прочитанных байт уложатся в лимит."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now - self.BURST_S) + amount / self.rate
+            wait = self._next - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ConnectionGovernor:
+    """Сколько Range-соединений держать к одному клиенту YouTube (c= в ссылке googlevideo).
+
+    Состояние общее для всех задач: 403/429 в одной загрузке вдвое уменьшают число
+    соединений (до одного) и ставят клиента на паузу с растущим backoff. После
+    DOWNLOAD_RAMP_CHUNKS кусков подряд без ошибок добавляется соединение, если
+    прошлое добавление подняло суммарную скорость, а не просто поделило канал.
+    """
+
+    def __init__(self, start: int, maximum: int):
+        self.start = start
+        self.maximum = maximum
+        self.active = 0
+        self._limit: dict[str, int] = {}
+        self._streak: dict[str, int] = {}
+        self._strikes: dict[str, int] = {}
+        self._pause_until: dict[str, float] = {}
+        # EWMA скорости одного соединения (байт/с) при n соединениях
+        self._rate: dict[tuple[str, int], float] = {}
+        self._lock = threading.Lock()
+
+    def limit(self, client: str) -> int:
+        with self._lock:
+            return self._limit.get(client, self.start)
+
+    def pause(self, client: str) -> float:
+        """Сколько секунд к клиенту ещё нельзя обращаться после 403/429."""
+        with self._lock:
+            return max(0.0, self._pause_until.get(client, 0.0) - time.monotonic())
+
+    def throttled(self, client: str, status: int, retry_after: float | None) -> None:
+        with self._lock:
+            limit = max(1, self._limit.get(client, self.start) // 2)
+            self._limit[client] = limit
+            self._streak[client] = 0
+            strikes = self._strikes[client] = self._strikes.get(client, 0) + 1
+            backoff = retry_after or min(30.0, 2.0 ** strikes)
+            self._pause_until[client] = max(self._pause_until.get(client, 0.0), time.monotonic() + backoff)
+        download_throttled_total.inc(client=client, status=str(status))
+        logger.warning(f"HTTP {status} от клиента {client or '?'}: соединений теперь {limit}, пауза {backoff:.0f} с")
+
+    def succeeded(self, client: str, connections: int, rate: float) -> None:
+        """Кусок скачан без ошибок при connections соединениях со скоростью rate на одно."""
+        with self._lock:
+            key = (client, connections)
+            previous = self._rate.get(key)
+            self._rate[key] = rate if previous is None else 0.3 * rate + 0.7 * previous
+            self._strikes[client] = 0
+            limit = self._limit.get(client, self.start)
+            self._streak[client] = self._streak.get(client, 0) + 1
+            if self._streak[client] < DOWNLOAD_RAMP_CHUNKS or limit >= self.maximum:
+                return
+            self._streak[client] = 0
+            current, lower = self._rate.get((client, limit)), self._rate.get((client, limit - 1))
+            if current and lower and limit * current < 1.1 * (limit - 1) * lower:
+                # Лишнее соединение не ускорило загрузку: канал уже загружен
+                return
+            self._limit[client] = limit + 1
+        logger.info(f"Клиент {client or '?'}: соединений теперь {limit + 1}")
+
+    def connection(self, delta: int) -> None:
+        with self._lock:
+            self.active += delta
+
+
+download_budget = BandwidthBudget(DOWNLOAD_BANDWIDTH)
+download_governor = ConnectionGovernor(DOWNLOAD_CONNECTIONS_START, DOWNLOAD_CONNECTIONS)
+
+
+class _RangeChunk:
+    __slots__ = ('start', 'end', 'received', 'data', 'done')
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.received = 0
+        # Принятые, но ещё не выданные байты
+        self.data = bytearray()
+        self.done = False
+
+
+class RangeDownload:
+    """Загрузка потока по Range несколькими соединениями; байты выдаются строго по порядку.
+
+    Поток делится на куски STREAM_CHUNK. Каждое соединение (поток) берёт следующий
+    кусок, пока соединений не больше, чем разрешает download_governor для клиента,
+    и пока вперёд от выдаваемого куска буферизовано не больше DOWNLOAD_CONNECTIONS
+    кусков. Вызывающий поток отдаёт байты в sink по порядку, головной кусок — по
+    мере прихода, поэтому ffmpeg начинает работу так же рано, как при одном соединении.
+    Пока размер потока неизвестен (нет filesize и Content-Range), куски идут по одному.
+    """
+
+    def __init__(self, url: str, headers: dict, client: str = '', total: int | None = None):
+        self.url = url
+        self.headers = headers
+        self.client = client
+        self.total = total
+        self._chunks: dict[int, _RangeChunk] = {}
+        self._next = 0
+        self._fed = 0
+        self._active = 0
+        self._error: Exception | None = None
+        self._stopped = False
+        self._cond = threading.Condition()
+
+    def run(self, sink) -> int:
+        """Качает весь поток, вызывая sink(block) по порядку; возвращает число байт."""
+        fetchers = [threading.Thread(target=self._fetch_loop, daemon=True) for _ in range(DOWNLOAD_CONNECTIONS)]
+        for t in fetchers:
+            t.start()
+        size = 0
+        try:
+            index = 0
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._error is not None or self._has_data(index))
+                    if self._error is not None:
+                        raise self._error
+                    chunk = self._chunks[index]
+                    block, chunk.data = bytes(chunk.data), bytearray()
+                    # done читаем только под замком: иначе можно уйти дальше, не выдав хвост куска
+                    finished = chunk.done
+                    if finished:
+                        del self._chunks[index]
+                        self._fed = index + 1
+                        self._cond.notify_all()
+                if block:
+                    sink(block)
+                    size += len(block)
+                if finished:
+                    if self.total is not None and chunk.end + 1 >= self.total:
+                        return size
+                    index += 1
+        finally:
+            # Не дожидаемся соединений: каждое бросит работу на следующем блоке
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+
+    def _has_data(self, index: int) -> bool:
+        chunk = self._chunks.get(index)
+        return chunk is not None and (chunk.done or len(chunk.data) > 0)
+
+    def _can_start(self) -> bool:
+        if self._stopped or self._error is not None:
+            return True
+        if self.total is not None and self._next * STREAM_CHUNK >= self.total:
+            return False
+        if self.total is None and self._next > 0:
+            previous = self._chunks.get(self._next - 1)
+            if previous is not None and not previous.done:
+                return False
+        return (self._active < download_governor.limit(self.client)
+                and self._next <= self._fed + DOWNLOAD_CONNECTIONS
+                and download_governor.pause(self.client) == 0)
+
+    def _fetch_loop(self) -> None:
+        while True:
+            with self._cond:
+                # Лимит и пауза governor меняются без уведомления — перепроверяем по таймауту
+                while not self._can_start():
+                    self._cond.wait(0.2)
+                if self._stopped or self._error is not None:
+                    return
+                index = self._next
+                self._next += 1
+                chunk = self._chunks[index] = _RangeChunk(index * STREAM_CHUNK, (index + 1) * STREAM_CHUNK - 1)
+                self._active += 1
+            download_governor.connection(+1)
+            try:
+                self._fetch(chunk)
+            except Exception as e:
+                with self._cond:
+                    self._error = self._error or e
+                    self._cond.notify_all()
+                return
+            finally:
+                download_governor.connection(-1)
+                with self._cond:
+                    self._active -= 1
+                    self._cond.notify_all()
+
+    def _finish(self, chunk: _RangeChunk, eof: bool) -> None:
+        with self._cond:
+            if eof:
+                # Ответ короче запрошенного (или 416) — это конец потока
+                self.total = chunk.start + chunk.received
+                chunk.end = self.total - 1
+            chunk.done = True
+            self._cond.notify_all()
+
+    def _fetch(self, chunk: _RangeChunk) -> None:
+        for attempt in range(1, STREAM_RETRIES + 1):
+            if (wait := download_governor.pause(self.client)) > 0:
+                time.sleep(wait)
+            if self._stopped:
+                return
+            pos = chunk.start + chunk.received
+            started, got = time.monotonic(), 0
+            try:
+                req = Request(self.url, headers={**self.headers, 'Range': f'bytes={pos}-{chunk.end}'})
+                # Экземпляр пула нужен только чтобы открыть запрос; тело читается уже без него
+                with ydl_pool.get() as ydl:
+                    resp = ydl.urlopen(req)
+                with resp:
+                    # 200 вместо 206 — сервер игнорирует Range и отдаёт файл целиком
+                    whole = resp.status == 200
+                    skip = pos if whole else 0
+                    if whole:
+                        chunk.end = 2 ** 62
+                    elif self.total is None and (m := re.search(r'/(\d+)$', resp.headers.get('Content-Range', ''))):
+                        with self._cond:
+                            self.total = int(m.group(1))
+                            self._cond.notify_all()
+                    while block := resp.read(STREAM_BLOCK):
+                        if self._stopped:
+                            return
+                        download_budget.take(len(block))
+                        count_bytes('downloaded', len(block))
+                        if skip:
+                            cut = min(skip, len(block))
+                            block, skip = block[cut:], skip - cut
+                        got += len(block)
+                        with self._cond:
+                            chunk.data += block
+                            chunk.received += len(block)
+                            self._cond.notify_all()
+                pos = chunk.start + chunk.received
+                if not whole and self.total is not None and pos < min(chunk.end + 1, self.total):
+                    raise RequestError(f"соединение оборвалось на {pos} из {self.total} байт")
+                self._finish(chunk, eof=whole or pos <= chunk.end)
+                elapsed = time.monotonic() - started
+                if got and elapsed > 0:
+                    download_governor.succeeded(self.client, self._active, got / elapsed)
+                return
+            except HTTPError as e:
+                if e.status == 416 and pos > 0:
+                    self._finish(chunk, eof=True)
+                    return
+                if e.status in (403, 429):
+                    retry_after = e.response.headers.get('Retry-After') if e.response is not None else None
+                    download_governor.throttled(
+                        self.client, e.status, float(retry_after) if retry_after and retry_after.isdigit() else None,
+                    )
+                    if attempt == STREAM_RETRIES:
+                        raise
+                    continue
+                if e.status < 500 or attempt == STREAM_RETRIES:
+                    raise
+                logger.warning(f"HTTP {e.status} с позиции {pos} (попытка {attempt})")
+                time.sleep(attempt)
+            except RequestError as e:
+                if attempt == STREAM_RETRIES:
+                    raise
+                logger.warning(f"Сбой загрузки с позиции {pos} (попытка {attempt}): {e}")
+                time.sleep(attempt)
+
+
+def stream_download(info: dict, path: Path, feed: StreamFeed) -> int:
+    """Качает выбранный аудиопоток по Range (RangeDownload): пишет в файл и сразу отдаёт в ffmpeg.
+
+    Работает в потоке executor. Ошибка загрузки передаётся в feed, чтобы её увидел
+    segment_audio; если ffmpeg уже не читает (feed закрыт), загрузка просто прекращается.
+    """
+    client = _player_client(info)
+    download = RangeDownload(info['url'], dict(info.get('http_headers') or {}), client,
+                             info.get('filesize') or None)
+    written = 0
+    started = time.monotonic()
+    try:
+        with open(path, 'wb') as f:
+            def sink(block: bytes) -> None:
+                nonlocal written
+                f.write(block)
+                feed.put(block)
+                written += len(block)
+
+            size = download.run(sink)
+        feed.put(None)
+        elapsed = time.monotonic() - started
+        observe_stage('download', elapsed, client)
+        logger.info(f"Стриминговая загрузка завершена: {size} байт за {elapsed:.1f} с, "
+                    f"соединений к клиенту {client or '?'}: {download_governor.limit(client)}")
+        return size
+    except StreamFeed.Closed:
+        logger.info(f"Стриминговая загрузка прервана на {written} байтах: ffmpeg больше не читает")
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка стриминговой загрузки {info.get('id')}: {e}")
+        with contextlib.suppress(StreamFeed.Closed):
+            feed.put(Exception(_user_friendly_download_error(e)))
+        raise
+
+
+def fetch_stream(info: dict, path: Path) -> int:
+    """Качает выбранный аудиопоток по Range целиком в файл, без подачи в ffmpeg; работает в потоке executor."""
+    client = _player_client(info)
+    started = time.monotonic()
+    with open(path, 'wb') as f:
+        size = RangeDownload(info['url'], dict(info.get('http_headers') or {}), client,
+                             info.get('filesize') or None).run(f.write)
+    observe_stage('download', time.monotonic() - started, client)
+    logger.info(f"Загрузка потока завершена: {size} байт за {time.monotonic() - started:.1f} с")
+    return size
+
+
+def budget_progress_hook():
+    """Progress hook yt-dlp: прочитанные байты проходят через общий download_budget.
+
+    Хук вызывается из потока загрузки, поэтому ожидание в take() тормозит само чтение.
+    downloaded_bytes — нарастающий итог по файлу, в бюджет идёт только прирост.
+    """
+    seen: dict[str, int] = {}
+    lock = threading.Lock()
+
+    def hook(d: dict) -> None:
+        if d.get('status') != 'downloading':
+            return
+        done = d.get('downloaded_bytes') or 0
+        name = d.get('tmpfilename') or d.get('filename') or ''
+        with lock:
+            # После повтора загрузка начинается заново — прирост считаем от нового итога
+            delta = done - seen.get(name, 0)
+            seen[name] = done
+        if delta > 0:
+            download_budget.take(delta)
+
+    return hook
+
+
+def download_source(video_url: str, work_dir: Path) -> tuple[str, str, str | None, float | None, str | None]:
+    """Качает аудио через yt-dlp в work_dir/source (путь без стриминга); работает в потоке executor.
+
+    Возвращает (путь, безопасное название, ID видео, длительность, кодек).
+    """
+    try:
+        logger.info(f"Начинаем загрузку видео: {video_url[:50]}...")
+        # Исходник — в отдельной подпапке work_dir, чтобы целиком перенести её в кэш
+        filename_template = str(work_dir / 'source' / 'input.%(ext)s')
+        logger.info(f"Шаблон имени файла: {filename_template}")
+
+        started = time.monotonic()
+        # Из пула — только извлечение: пул держит WORKERS + 1 экземпляров, и занять их
+        # на всё скачивание значило бы остановить предпроверки ссылок и RangeDownload
+        with ydl_pool.get() as ydl:
+            logger.info("Получен экземпляр YoutubeDL из пула, начинаем извлечение информации...")
+            info = ydl.extract_info(video_url, download=False)
+        logger.info("Информация о видео извлечена, проверяем результат...")
+        if not info:
+            raise Exception("Не удалось получить информацию о видео")
+        # Скачивание — отдельным экземпляром: ссылки на форматы уже получены, player JS не нужен
+        opts = build_ydl_opts(filename_template)
+        if DOWNLOAD_BANDWIDTH:
+            opts['progress_hooks'] = [budget_progress_hook()]
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.process_ie_result(info, download=True)
+            title = info.get('title', 'audio')
+            safe_title = sanitize_filename(title)
+            logger.info(f"Название видео: {title}")
+            path = ydl.prepare_filename(info)
+            logger.info(f"Путь к файлу: {path}")
+            if not path or not os.path.exists(path):
+                raise Exception("Файл не был загружен")
+            logger.info(f"Файл успешно загружен: {path}")
+            observe_stage('download', time.monotonic() - started, _player_client(info))
+            count_bytes('downloaded', os.path.getsize(path))
+            return path, safe_title, info.get('id'), info.get('duration'), info.get('acodec')
+    except Exception as e:
+        logger.error(f"Ошибка загрузки видео {video_url}: {e}")
+        raise Exception(_user_friendly_download_error(e))
+    except UnicodeDecodeError as e:
+        logger.error(f"Ошибка кодировки при загрузке видео {video_url}: {e}")
+        raise Exception(f"Ошибка кодировки при загрузке видео: {e}")
+
+
+def get_duration(path: str) -> float:
+    """Длительность файла через ffprobe, если её нет в метаданных."""
+    cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+           '-of', 'default=noprint_wrappers=1:nokey=1', path]
+    with timed_stage('duration'):
         try:
             return float(subprocess.check_output(cmd, encoding='utf-8', errors='ignore'))
         except UnicodeDecodeError:
@@ -332,73 +3116,326 @@ async def process_video(video_url: str, chat_id: int, orig_msg_id: int, speed: f
             result = subprocess.check_output(cmd)
             return float(result.decode('utf-8', errors='ignore').strip())
 
-    logger.info("Получаем длительность видео...")
-    duration = await loop.run_in_executor(executor, lambda: get_duration(input_file))
+
+def prefetch_source(video_url: str, video_id: str) -> int:
+    """Заранее кладёт исходник записи плейлиста в source_cache; работает в потоке executor.
+
+    Запись остаётся захваченной, пока пакет не отпустит её после задачи этой записи, —
+    иначе её могло бы вытеснить раньше, чем она пригодится. Возвращает размер в байтах.
+    """
+    key = source_cache_key(video_id)
+    cached = source_cache.acquire(key)
+    if cached is not None:
+        return _dir_size(cached[0])
+    work_dir = TMP_DIR / f"prefetch-{uuid.uuid4().hex[:12]}"
+    source_dir = work_dir / 'source'
+    source_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        with timed_stage('prefetch'):
+            info = probe_video(video_url)
+            if _is_streamable(info):
+                path = source_dir / f"input.{info['ext']}"
+                with open(path, 'wb') as f:
+                    RangeDownload(info['url'], dict(info.get('http_headers') or {}), _player_client(info),
+                                  info.get('filesize') or None).run(f.write)
+                title = sanitize_filename(info.get('title', 'audio'))
+                duration, acodec = info.get('duration'), info.get('acodec')
+            else:
+                downloaded, title, _, duration, acodec = download_source(video_url, work_dir)
+                path = Path(downloaded)
+            if not duration:
+                duration = get_duration(str(path))
+        meta = {'file': path.name, 'title': title, 'duration': float(duration), 'acodec': acodec}
+        entry = source_cache.store(key, path.parent, meta)
+        logger.info(f"Исходник {video_id} скачан заранее: {_dir_size(entry) // 1024} КБ")
+        return _dir_size(entry)
+    finally:
+        cleanup_work_dir(work_dir)
+
+
+async def process_video(video_url: str, chat_id: int, orig_msg_id: int, speed: float, work_dir: Path) -> int:
+    """Доставляет видео в чат сегментами; возвращает число неудавшихся сегментов."""
+    logger.info(f"process_video вызвана: URL={video_url[:50]}..., chat_id={chat_id}, speed={speed}")
+    loop = asyncio.get_event_loop()
+    started_at = time.monotonic()
+    video_id = extract_video_id(video_url)
+    # Задача, прерванная перезапуском, продолжается со следующего недоставленного сегмента
+    job_id = current_job_id.get()
+    job = job_store.get(job_id)
+    resume_from = job['last_segment'] if job else 0
+
+    # Набор уже был доставлен: шлём file_id, без кодирования и выгрузки.
+    # Если какой-то file_id устарел, остальное догружается обычным путём
+    delivered = resume_from
+    if video_id:
+        known = await send_known_file_ids(video_id, speed, chat_id, skip=resume_from)
+        if known is not None:
+            delivered, total = max(known[0], resume_from), known[1]
+            if delivered == total:
+                logger.info(f"file_id: попаданий {file_ids.hits}, промахов {file_ids.misses}, устаревших {file_ids.stale}")
+                await bot.send_message(chat_id=chat_id, text="Готово!")
+                return 0
+
+    # Готовые сегменты в кэше: ни загрузки, ни ffprobe, ни ffmpeg
+    if video_id and await send_cached_segments(
+        segment_cache_key(video_id, speed), chat_id, video_id, speed, skip=delivered
+    ):
+        await bot.send_message(chat_id=chat_id, text="Готово!")
+        return 0
+
+    src_key = source_cache_key(video_id) if video_id else None
+    cached = source_cache.acquire(src_key) if src_key else None
+    if cached is not None:
+        entry, meta = cached
+        input_file, title_safe, duration = str(entry / meta['file']), meta['title'], meta['duration']
+        logger.info(f"Исходное аудио найдено в кэше: {input_file}")
+        try:
+            return await render_and_send(input_file, title_safe, duration, video_id, chat_id, speed, work_dir,
+                                         skip=delivered, started_at=started_at,
+                                         source_codec=meta.get('acodec'), start_segment=resume_from)
+        finally:
+            source_cache.release(src_key)
+
+    # Исходник, скачанный до перезапуска и оставшийся в work_dir задачи
+    if job and job['source_path'] and Path(job['source_path']).exists():
+        logger.info(f"Используем исходник прерванной задачи: {job['source_path']}")
+        return await render_and_send(job['source_path'], job['title'], job['duration'], video_id, chat_id, speed,
+                                     work_dir, skip=delivered, started_at=started_at,
+                                     source_codec=job['acodec'], start_segment=resume_from)
+
+    # Стриминг: сегменты режутся, пока yt-dlp ещё качает. Длительность — из info dict
+    info = None
+    if STREAMING_INGEST and not SILENCE_SPLIT:
+        info = cached_probe(video_id)
+        if info is None:
+            logger.info("Получаем метаданные видео (без загрузки)...")
+            info = await loop.run_in_executor(executor, probe_video, video_url)
+        else:
+            logger.info("Метаданные видео взяты из предпроверки ссылки")
+    if info is not None and _is_streamable(info):
+        video_id = video_id or info.get('id')
+        if (trace := current_trace.get()) is not None:
+            trace.client = _player_client(info)
+        title_safe = sanitize_filename(info.get('title', 'audio'))
+        duration = float(info['duration'])
+        source_dir = work_dir / 'source'
+        source_dir.mkdir(parents=True, exist_ok=True)
+        input_path = source_dir / f"input.{info['ext']}"
+        acodec = info.get('acodec')
+        complete = input_path.exists() and input_path.stat().st_size == info.get('filesize')
+        if resume_from:
+            # Продолжение после перезапуска: стриминг начал бы кодировать с первого сегмента.
+            # Исходник докачивается целиком (если его нет), нарезка — с недоставленного сегмента
+            if complete:
+                logger.info(f"Исходник прерванной задачи скачан полностью: {input_path}")
+            else:
+                await loop.run_in_executor(executor, fetch_stream, info, input_path)
+            if video_id:
+                src_key = source_cache_key(video_id)
+                meta = {'file': input_path.name, 'title': title_safe, 'duration': duration, 'acodec': acodec}
+                entry = await loop.run_in_executor(executor, source_cache.store, src_key, source_dir, meta)
+                input_path = entry / meta['file']
+            job_store.set_source(job_id, input_path, title_safe, duration, acodec)
+            try:
+                return await render_and_send(str(input_path), title_safe, duration, video_id, chat_id, speed,
+                                             work_dir, skip=delivered, started_at=started_at, source_codec=acodec,
+                                             start_segment=resume_from)
+            finally:
+                if video_id:
+                    source_cache.release(src_key)
+
+        logger.info(f"Стриминговая загрузка формата {info.get('format_id')} ({info['ext']}), "
+                    f"длительность {duration} секунд")
+        feed = StreamFeed(loop)
+        download = loop.run_in_executor(executor, stream_download, info, input_path, feed)
+
+        def source_ready(future: asyncio.Future) -> None:
+            # Исходник записан, пока сегменты ещё кодируются: после перезапуска задача
+            # продолжит с него, без повторной загрузки и кодирования доставленного
+            if not future.cancelled() and future.exception() is None:
+                job_store.set_source(job_id, input_path, title_safe, duration, acodec)
+
+        download.add_done_callback(source_ready)
+        try:
+            failed_segments = await render_and_send('pipe:0', title_safe, duration, video_id, chat_id, speed, work_dir,
+                                                    skip=delivered, started_at=started_at, feed=feed,
+                                                    source_codec=info.get('acodec'))
+        finally:
+            feed.close()
+            if not download.done():
+                with contextlib.suppress(Exception):
+                    await download
+        await download
+        if video_id:
+            src_key = source_cache_key(video_id)
+            meta = {'file': input_path.name, 'title': title_safe, 'duration': duration, 'acodec': acodec}
+            entry = await loop.run_in_executor(executor, source_cache.store, src_key, source_dir, meta)
+            source_cache.release(src_key)
+            input_path = entry / meta['file']
+        job_store.set_source(job_id, input_path, title_safe, duration, acodec)
+        return failed_segments
+
+    logger.info("Запускаем загрузку в отдельном потоке...")
+    input_file, title_safe, info_id, duration, acodec = await loop.run_in_executor(
+        executor, download_source, video_url, work_dir
+    )
+    logger.info(f"Загрузка завершена: {input_file}")
+    if not duration:
+        logger.info("Длительности нет в метаданных, получаем через ffprobe...")
+        duration = await loop.run_in_executor(executor, lambda: get_duration(input_file))
     logger.info(f"Длительность видео: {duration} секунд")
+    video_id = video_id or info_id
+    if video_id:
+        src_key = source_cache_key(video_id)
+        meta = {'file': Path(input_file).name, 'title': title_safe, 'duration': duration, 'acodec': acodec}
+        entry = await loop.run_in_executor(
+            executor, source_cache.store, src_key, Path(input_file).parent, meta
+        )
+        input_file = str(entry / meta['file'])
+    job_store.set_source(job_id, input_file, title_safe, duration, acodec)
+    try:
+        return await render_and_send(input_file, title_safe, duration, video_id, chat_id, speed, work_dir,
+                                     skip=delivered, started_at=started_at, source_codec=acodec,
+                                     start_segment=resume_from)
+    finally:
+        if video_id:
+            source_cache.release(src_key)
+
+
+async def render_and_send(input_file: str, title_safe: str, duration: float, video_id: str | None,
+                          chat_id: int, speed: float, work_dir: Path, skip: int = 0,
+                          started_at: float | None = None, feed: StreamFeed | None = None,
+                          source_codec: str | None = None, start_segment: int = 0):
+    """Нарезает исходник и отправляет сегменты; полный набор сегментов сохраняет в кэш.
+
+    Первые skip сегментов уже доставлены (по file_id) — они только кодируются для кэша.
+    С start_segment нарезка начинается сразу с сегмента start_segment + 1 (после
+    перезапуска), более ранние сегменты не кодируются вовсе.
+    С feed вход читается из stdin (input_file='pipe:0') по мере загрузки.
+    """
+    loop = asyncio.get_event_loop()
     segment_in_s = SEGMENT_S * speed
     total_segments = math.ceil(duration / segment_in_s)
     logger.info(f"Будет создано {total_segments} сегментов по {segment_in_s} секунд каждый")
 
-    def atempo_filter(s: float) -> str:
-        parts = []
-        while s > 2.0:
-            parts.append('atempo=2.0')
-            s /= 2.0
-        parts.append(f'atempo={s:.2f}')
-        return ','.join(parts)
+    # Точки реза по паузам; анализ детерминирован, поэтому после перезапуска они те же
+    cuts = None
+    start_at = start_segment * segment_in_s
+    if SILENCE_SPLIT and feed is None and total_segments > 1:
+        window = min(SILENCE_WINDOW_S * speed, segment_in_s / 2)
+        logger.info(f"Ищем паузы в окне ±{window:.0f} с вокруг границ сегментов...")
+        async with ffmpeg_slots:
+            cuts = await loop.run_in_executor(executor, analyze_cut_points, input_file, duration, segment_in_s, window)
+        total_segments = len(cuts) + 1
+        start_at = cuts[start_segment - 1] if start_segment else 0.0
 
-    filter_str = atempo_filter(speed)
+    audio_args, ext = output_plan(speed, source_codec)
+    if audio_args[-1] == 'copy':
+        logger.info(f"Быстрый путь: {source_codec} копируется в .{ext} без перекодирования")
+    else:
+        logger.info(f"Кодирование: профиль {OUTPUT_PROFILE_NAME} ({' '.join(audio_args)})")
 
-    # Обрабатываем сегменты по порядку, чтобы не было путаницы с сортировкой
-    logger.info("Начинаем обработку сегментов...")
-    failed_segments = 0
-    for i in range(total_segments):
-        start = i * segment_in_s
-        segment_num = f"{i+1:02d}"
-        out_path = work_dir / f"{segment_num}__{title_safe}.mp3"
-        logger.info(f"Обрабатываем сегмент {i+1}/{total_segments}: {out_path.name}")
-        
+    # Один проход ffmpeg на всё видео. Кодирование идёт параллельно с отправкой:
+    # ffmpeg опережает отправку не больше чем на SEGMENT_PREFETCH сегментов
+    logger.info(f"Начинаем нарезку сегментов за один проход ffmpeg (prefetch={SEGMENT_PREFETCH})...")
+    buffer = SegmentBuffer(SEGMENT_PREFETCH, SEGMENT_DISK_BUDGET)
+    # Отправленные сегменты складываем сюда, чтобы потом целиком положить в кэш
+    rendered_dir = work_dir / 'rendered'
+    rendered_dir.mkdir(parents=True, exist_ok=True)
+
+    # Без SIGSTOP ffmpeg с файловым входом нельзя приостановить: когда место кончается,
+    # он завершается после готового сегмента и перезапускается со следующего
+    batched = feed is None and not CAN_SUSPEND
+
+    async def produce_segments():
+        produced = start_segment
+        at = start_at
         try:
-            await loop.run_in_executor(
-                executor,
-                process_segment,
-                input_file,
-                start,
-                segment_in_s,
-                filter_str,
-                str(out_path),
-            )
-            await bot.send_audio(chat_id=chat_id, audio=FSInputFile(str(out_path)))
-            logger.info(f"Сегмент {i+1} отправлен в чат {chat_id}")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Ошибка обработки сегмента {i+1}: {e}")
-            await bot.send_message(chat_id=chat_id, text=f"Ошибка обработки сегмента {i+1}")
-            failed_segments += 1
-            continue
-        except UnicodeDecodeError as e:
-            logger.error(f"Ошибка кодировки при обработке сегмента {i+1}: {e}")
-            await bot.send_message(chat_id=chat_id, text=f"Ошибка кодировки при обработке сегмента {i+1}")
-            failed_segments += 1
-            continue
-        except Exception as e:
-            logger.error(f"Ошибка отправки/обработки сегмента {i+1}: {e}")
-            failed_segments += 1
-            raise
+            while True:
+                async with contextlib.aclosing(
+                    segment_audio(input_file, audio_args, ext, work_dir, title_safe,
+                                  room=None if batched else buffer.room, feed=feed,
+                                  start_at=at, start_number=produced + 1,
+                                  segment_times=None if cuts is None else
+                                  [(c - at) / speed for c in cuts[produced:]])
+                ) as segments:
+                    async for path in segments:
+                        await buffer.put(path)
+                        produced += 1
+                        # После последнего сегмента перезапускать нечего — ffmpeg уже заканчивает
+                        if batched and not buffer.room.is_set() and produced < total_segments:
+                            break
+                    else:
+                        return
+                logger.info(f"Нет места под сегменты: ffmpeg остановлен после сегмента {produced}")
+                await buffer.room.wait()
+                at = cuts[produced - 1] if cuts is not None else produced * segment_in_s
         finally:
-            if out_path.exists():
-                try:
-                    out_path.unlink()
-                except Exception as e:
-                    logger.error(f"Не удалось удалить сегмент {out_path}: {e}")
+            await buffer.close()
+
+    producer = asyncio.create_task(produce_segments())
+    failed_segments = 0
+    done_segments = start_segment
+    try:
+        while (out_path := await buffer.get()) is not None:
+            done_segments += 1
+            logger.info(f"Сегмент {done_segments}/{total_segments} готов: {out_path.name}")
+            try:
+                if done_segments > skip:
+                    await deliver_segment(chat_id, out_path, video_id, speed, done_segments)
+                    logger.info(f"Сегмент {done_segments} отправлен в чат {chat_id}")
+                    if started_at is not None:
+                        ttfs = time.monotonic() - started_at
+                        observe_stage('ttfs', ttfs)
+                        logger.info(f"Время до первого сегмента (TTFS): {ttfs:.1f} с"
+                                    f"{' (стриминг)' if feed else ''}")
+                        started_at = None
+                if video_id:
+                    out_path.rename(rendered_dir / out_path.name)
+            except Exception as e:
+                logger.error(f"Ошибка отправки сегмента {done_segments}: {e}")
+                failed_segments += 1
+                raise
+            finally:
+                if out_path.exists():
+                    try:
+                        out_path.unlink()
+                    except Exception as e:
+                        logger.error(f"Не удалось удалить сегмент {out_path}: {e}")
+        await producer
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Ошибка нарезки после сегмента {done_segments}: {e.stderr}")
+        await bot.send_message(chat_id=chat_id, text=f"Ошибка обработки сегмента {done_segments + 1}")
+        failed_segments += max(total_segments - done_segments, 1)
+    finally:
+        if not producer.done():
+            producer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await producer
 
     # Папку work_dir удалит task_worker в finally
 
+    if failed_segments == 0 and video_id:
+        file_ids.complete(video_id, speed, rendition_profile(speed), done_segments)
+        logger.info(f"file_id: попаданий {file_ids.hits}, промахов {file_ids.misses}, устаревших {file_ids.stale}")
+    # В кэш сегментов попадает только полный набор
+    if failed_segments == 0 and video_id and not start_segment:
+        seg_key = segment_cache_key(video_id, speed)
+        meta = {'title': title_safe, 'segments': done_segments}
+        await loop.run_in_executor(executor, segment_cache.store, seg_key, rendered_dir, meta)
+        segment_cache.release(seg_key)
+
     if failed_segments == 0:
         await bot.send_message(chat_id=chat_id, text="Готово!")
-        # Очищаем логи только если все сегменты успешно доставлены
-        clear_logs()
+        # Очищаем логи только если все сегменты успешно доставлены и других задач в работе нет:
+        # иначе вместе с логом пропали бы строки задач, которые ещё идут
+        with active_tasks_lock:
+            alone = active_tasks <= 1
+        if alone:
+            clear_logs()
     else:
         await bot.send_message(chat_id=chat_id, text=f"Готово, но с ошибками: {failed_segments} сегм.")
+    return failed_segments
 
 
 def check_dependencies():
@@ -408,10 +3445,94 @@ def check_dependencies():
         subprocess.run(['ffprobe', '-version'], capture_output=True, check=True, encoding='utf-8', errors='ignore')
     except (subprocess.CalledProcessError, FileNotFoundError):
         raise RuntimeError("ffmpeg и ffprobe должны быть установлены в системе")
+    if SILENCE_SPLIT and importlib.util.find_spec('numpy') is None:
+        raise RuntimeError("Для silence_split нужен numpy: pip install numpy")
+
 
 
 
 
+def make_broker_app(queue: SqliteJobQueue, token: str | None = None) -> web.Application:
+    """HTTP-брокер над SqliteJobQueue для queue_backend: http (POST /<метод> с JSON-аргументами)."""
+
+    async def call(request: web.Request) -> web.Response:
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            raise web.HTTPUnauthorized()
+        method = request.match_info['method']
+        if method not in HttpJobQueue.METHODS:
+            raise web.HTTPNotFound()
+        payload = await request.json() if request.can_read_body else {}
+        try:
+            result = await getattr(queue, method)(**payload)
+        except asyncio.QueueFull:
+            raise web.HTTPTooManyRequests()
+        return web.json_response({'result': result})
+
+    async def stats(request: web.Request) -> web.Response:
+        lines = []
+        for key, value in (await queue.stats()).items():
+            lines += [f"# TYPE ytbot_broker_{key} gauge", f"ytbot_broker_{key} {value}"]
+        return web.Response(text='\n'.join(lines) + '\n', content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', stats)
+    app.router.add_post('/{method}', call)
+    return app
+
+
+async def main_broker():
+    logger.info(f"Запуск брокера очереди на {BROKER_HOST}:{BROKER_PORT}, база {QUEUE_DB}")
+    queue = job_queue if isinstance(job_queue, SqliteJobQueue) else SqliteJobQueue(QUEUE_DB, TASK_QUEUE_SIZE)
+    runner = web.AppRunner(make_broker_app(queue, QUEUE_TOKEN), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, BROKER_HOST, BROKER_PORT).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def main_worker():
+    if job_queue is None:
+        raise RuntimeError("Для --worker нужен queue_backend: sqlite или http")
+    global source_cache, segment_cache
+    logger.info(f"Запуск воркера {WORKER_NAME}, очередь: {QUEUE_BACKEND}")
+    check_dependencies()
+    cache_root = claim_worker_cache_dir()
+    logger.info(f"Кэш воркера: {cache_root}")
+    source_cache = DiskCache(cache_root / "source", SOURCE_CACHE_BUDGET, "source")
+    segment_cache = DiskCache(cache_root / "segments", SEGMENT_CACHE_BUDGET, "segments")
+    TMP_DIR.mkdir(parents=True, exist_ok=True)
+    # Локальные задачи, которых уже нет в очереди, доделал другой воркер
+    unfinished = job_store.unfinished()
+    if unfinished:
+        known = set(await job_queue.known([job['id'] for job in unfinished]))
+        for job in unfinished:
+            if job['id'] not in known:
+                job_store.finish(job['id'])
+    cleanup_stale_work_dirs(job_store.unfinished())
+    # Прогрев пула yt-dlp идёт в фоне и не задерживает старт
+    asyncio.get_event_loop().run_in_executor(executor, ydl_pool.warm)
+
+    running: dict[str, asyncio.Task] = {}
+    lost: set[str] = set()
+    logger.info(f"Создаем воркеры очереди: {WORKERS}, ffmpeg одновременно: {FFMPEG_PROCESSES}")
+    tasks = [asyncio.create_task(queue_worker(i, running, lost)) for i in range(WORKERS)]
+    tasks.append(asyncio.create_task(queue_heartbeat(running, lost)))
+    metrics_runner = await start_metrics_server()
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if isinstance(job_queue, HttpJobQueue):
+            await job_queue.close()
+        ydl_pool.close()
+        await bot.session.close()
+
 
 async def main():
     logger.info("Запуск бота...")
@@ -423,13 +3544,30 @@ async def main():
     TMP_DIR.mkdir(parents=True, exist_ok=True)
     logger.info("Очищаем старые временные файлы...")
     cleanup_legacy_temp_files()
-    for stale in TMP_DIR.iterdir():
-        if stale.is_dir():
-            cleanup_work_dir(stale)
-    
-    # Создаем один воркер для последовательной обработки
-    logger.info("Создаем task worker...")
-    asyncio.create_task(task_worker())
+    if job_queue is None:
+        # Папки незавершённых задач не трогаем: в них исходники для продолжения
+        unfinished = job_store.unfinished()
+        cleanup_stale_work_dirs(unfinished)
+        # Несколько воркеров; ffmpeg дополнительно ограничен ffmpeg_slots
+        logger.info(f"Создаем task workers: {WORKERS}, ffmpeg одновременно: {FFMPEG_PROCESSES}")
+        workers = [asyncio.create_task(task_worker(i)) for i in range(WORKERS)]
+    else:
+        # Задачи выполняют процессы python Bot.py --worker; их папки и job_store здесь не трогаем
+        logger.info(f"Очередь задач: {QUEUE_BACKEND}, обработка — в отдельных воркерах")
+        unfinished = []
+        workers = []
+    metrics_runner = await start_metrics_server()
+    # Прогрев пула yt-dlp идёт в фоне и не задерживает старт
+    asyncio.get_event_loop().run_in_executor(executor, ydl_pool.warm)
+
+    # Пакеты — раньше задач: текущая запись пакета должна найти своего ожидающего
+    for batch in job_store.unfinished_batches():
+        logger.info(f"Продолжаем плейлист {batch['id']} для чата {batch['chat_id']} с записи {batch['next_entry'] + 1}")
+        PlaylistBatch(batch).start()
+    if unfinished:
+        logger.info(f"Восстанавливаем незавершённые задачи: {len(unfinished)}")
+    for job in unfinished:
+        await submit_task(job['url'], job['video_id'], job['chat_id'], job['orig_msg_id'], job['speed'], job=job)
     
     try:
         logger.info("Начинаем polling...")
@@ -437,11 +3575,22 @@ async def main():
     except KeyboardInterrupt:
         logger.info("Получен сигнал прерывания...")
         cleanup_legacy_temp_files()
-        for stale in TMP_DIR.iterdir():
-            if stale.is_dir():
-                cleanup_work_dir(stale)
+        if job_queue is None:
+            cleanup_stale_work_dirs(job_store.unfinished())
         logger.info("Бот остановлен")
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        ydl_pool.close()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="YouTube Audio Cut Bot")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--worker', action='store_true', help="только обработка задач из queue_backend (sqlite/http)")
+    mode.add_argument('--broker', action='store_true', help="HTTP-брокер очереди для queue_backend: http")
+    args = parser.parse_args()
+    asyncio.run(main_broker() if args.broker else main_worker() if args.worker else main())
@@ -0,0 +1,70 @@
+"""Общие помощники для бенчмарков: временный конфиг, импорт Bot.py, синтетическое аудио."""
+import contextlib
+import os
+import sys
+import subprocess
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Формат токена проверяется aiogram, поэтому нужен правдоподобный фиктивный
+FAKE_TOKEN = "123456:AAbenchmarkbenchmarkbenchmarkbench"
+
+
+def load_bot(extra_cfg: dict | None = None):
+    """Импортирует Bot.py с временным config.yaml (реальный токен не нужен)."""
+    import yaml
+    tmp = Path(tempfile.mkdtemp(prefix="bench_cfg_"))
+    # Кэш и индекс file_id — во временной папке, чтобы не трогать рабочие
+    cfg = {"telegram_token": FAKE_TOKEN, "cache_dir": str(tmp / "cache"), "file_id_db": str(tmp / "file_ids.sqlite3"),
+           "job_db": str(tmp / "jobs.sqlite3"), "queue_db": str(tmp / "queue.sqlite3")}
+    cfg.update(extra_cfg or {})
+    cfg_path = tmp / "config.yaml"
+    cfg_path.write_text(yaml.safe_dump(cfg, allow_unicode=True), encoding="utf-8")
+    os.environ["BOT_CONFIG"] = str(cfg_path)
+    if str(ROOT) not in sys.path:
+        sys.path.insert(0, str(ROOT))
+    import Bot
+    return Bot
+
+
+def make_synthetic_audio(path: Path, duration_s: int, codec: str = "libopus", bitrate: str = "64k") -> Path:
+    """Генерирует синтетическое аудио заданной длины через lavfi (речь заменяет шум + тон)."""
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f'sine=frequency=220:duration={duration_s}',
+        '-f', 'lavfi', '-i', f'anoisesrc=color=pink:amplitude=0.05:duration={duration_s}',
+        '-filter_complex', 'amix=inputs=2', '-ac', '2',
+        '-c:a', codec, '-b:a', bitrate,
+        # M4A как у YouTube (DASH): фрагментированный MP4, читается из pipe
+        *(['-movflags', 'frag_keyframe+empty_moov'] if path.suffix == '.m4a' else []),
+        str(path),
+    ]
+    subprocess.run(cmd, check=True)
+    return path
+
+
+def child_cpu_seconds() -> float:
+    """Суммарное CPU-время завершившихся дочерних процессов (ffmpeg)."""
+    t = os.times()
+    return t.children_user + t.children_system
+
+
+def rss_tree_bytes() -> int:
+    """Текущий RSS процесса и его прямых потомков (ffmpeg); только Linux, иначе 0."""
+    def rss(pid) -> int:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    total = rss('self')
+    for children in Path('/proc/self/task').glob('*/children'):
+        with contextlib.suppress(OSError):
+            total += sum(rss(pid) for pid in children.read_text().split())
+    return total
@@ -0,0 +1,90 @@
+"""Адаптивная загрузка по Range (Bot.RangeDownload) против одного соединения.
+
+Синтетическое аудио раздаёт FakeTelegram по /media с ограничением скорости на
+соединение (как googlevideo на одно соединение) и, по желанию, с лимитом
+одновременных соединений: лишние получают 429. Сценарии:
+  1 соединение   — как stream_download до адаптивного режима;
+  адаптивно      — старт с --start соединений, рост до --connections;
+  N задач        — несколько загрузок разом с общим лимитом --budget-mbps.
+Для каждого — время, скорость, ответы 429, пик соединений и итоговое число
+соединений у governor; содержимое сверяется с исходником по SHA-256.
+Пример:
+    python bench/bench_download.py --duration 1800 --conn-mbps 8 --server-connections 3
+"""
+import argparse
+import hashlib
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from _common import load_bot, make_synthetic_audio
+from fake_telegram import FakeTelegram
+
+CLIENT = 'BENCH'
+
+
+def download(Bot, url: str, total: int | None) -> tuple[str, int]:
+    digest = hashlib.sha256()
+    size = Bot.RangeDownload(url, {}, CLIENT, total).run(digest.update)
+    return digest.hexdigest(), size
+
+
+def scenario(Bot, server: FakeTelegram, url: str, total: int, expected: str, name: str,
+             connections: int, start: int, budget_mbps: float, jobs: int) -> None:
+    Bot.DOWNLOAD_CONNECTIONS = connections
+    Bot.download_governor = Bot.ConnectionGovernor(min(start, connections), connections)
+    Bot.download_budget = Bot.BandwidthBudget(budget_mbps * 1e6 / 8)
+    server.media_throttled = server.media_peak = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(jobs) as pool:
+        results = list(pool.map(lambda _: download(Bot, url, total), range(jobs)))
+    wall = time.perf_counter() - started
+    ok = all(digest == expected and size == total for digest, size in results)
+    mbps = total * jobs * 8 / wall / 1e6
+    print(f"| {name:<22} | {wall:>7.2f} | {mbps:>7.1f} | {server.media_throttled:>5} | {server.media_peak:>4} | "
+          f"{Bot.download_governor.limit(CLIENT):>5} | {'да' if ok else 'НЕТ':>6} |")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=int, default=1800, help='длина синтетического аудио, с')
+    parser.add_argument('--conn-mbps', type=float, default=8.0, help='скорость раздачи на одно соединение')
+    parser.add_argument('--server-connections', type=int, default=0,
+                        help='сколько соединений сервер терпит одновременно (0 — без лимита)')
+    parser.add_argument('--connections', type=int, default=6)
+    parser.add_argument('--start', type=int, default=2)
+    parser.add_argument('--chunk-mb', type=float, default=2)
+    parser.add_argument('--jobs', type=int, default=3, help='одновременных загрузок в сценарии с лимитом')
+    parser.add_argument('--budget-mbps', type=float, default=40.0, help='общий лимит для сценария с N задачами')
+    args = parser.parse_args()
+
+    Bot = load_bot({"metrics_port": 0, "download_chunk_mb": args.chunk_mb, "ydl_warmup_url": ""})
+    server = FakeTelegram(downlink_mbps=args.conn_mbps, media_connections=args.server_connections)
+    server.start()
+    tmp = Path(tempfile.mkdtemp(prefix="bench_download_"))
+    try:
+        src = make_synthetic_audio(tmp / "src.webm", args.duration, codec="libopus", bitrate="128k")
+        server.media[src.name] = src
+        url = server.media_url(src.name)
+        total = src.stat().st_size
+        expected = hashlib.sha256(src.read_bytes()).hexdigest()
+        print(f"Файл {total / 1e6:.1f} МБ, {args.conn_mbps} Мбит/с на соединение, "
+              f"сервер терпит {args.server_connections or '∞'} соединений, кусок {args.chunk_mb} МБ")
+        print(f"| {'сценарий':<22} | {'wall, с':>7} | {'Мбит/с':>7} | {'429':>5} | {'пик':>4} | "
+              f"{'итог':>5} | {'SHA ок':>6} |")
+        print(f"|{'-' * 24}|{'-' * 9}|{'-' * 9}|{'-' * 7}|{'-' * 6}|{'-' * 7}|{'-' * 8}|")
+        scenario(Bot, server, url, total, expected, "1 соединение", 1, 1, 0, 1)
+        scenario(Bot, server, url, total, expected, f"адаптивно {args.start}→{args.connections}",
+                 args.connections, args.start, 0, 1)
+        scenario(Bot, server, url, total, expected, f"{args.jobs} задачи, {args.budget_mbps:g} Мбит/с",
+                 args.connections, args.start, args.budget_mbps, args.jobs)
+    finally:
+        server.stop()
+        Bot.ydl_pool.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Сквозной офлайн-бенчмарк: N пользователей, заглушка Bot API и синтетическое аудио.
+
+Бот импортируется с telegram_api_server, указывающим на FakeTelegram (задержка и
+аплинк настраиваются). probe_video подменяется: вместо YouTube он отдаёт ссылку на
+синтетическое аудио (lavfi) с того же сервера, а stream_download качает его по Range.
+Каждый пользователь по очереди отправляет ссылки и выбирает скорость — апдейты идут
+через dp.feed_update, то есть через настоящие handle_link/handle_speed, а обрабатывают
+их настоящие task_worker.
+
+Отчёт: задач в час, время до первого сегмента (TTFS), p50/p99 времени задачи,
+пиковый объём tmp/ и кэша, пиковый RSS бота вместе с ffmpeg.
+Пример:
+    python bench/bench_e2e.py --users 8 --videos-per-user 2 --durations 600,1800 --codecs opus,aac
+"""
+import argparse
+import asyncio
+import itertools
+import math
+import resource
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from _common import load_bot, make_synthetic_audio, rss_tree_bytes
+from fake_telegram import FakeTelegram
+
+# codec -> (кодер ffmpeg, расширение, acodec как в info dict yt-dlp)
+CODECS = {
+    'opus': ('libopus', 'webm', 'opus'),
+    'aac': ('aac', 'm4a', 'mp4a.40.2'),
+    'mp3': ('libmp3lame', 'mp3', 'mp3'),
+}
+DONE_PREFIXES = ("Готово", "❌", "Очередь переполнена")
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    # nearest-rank
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class Harness:
+    def __init__(self, Bot, server: FakeTelegram, speed: float, probe_delay: float):
+        self.Bot = Bot
+        self.server = server
+        self.speed = speed
+        self.probe_delay = probe_delay
+        self.catalog: dict[str, dict] = {}
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.ttfs: list[float] = []
+        self.latency: list[float] = []
+        self.failed = 0
+
+    def fake_probe(self, video_url: str) -> dict:
+        """Замена probe_video: метаданные синтетического «видео» без обращения к YouTube."""
+        time.sleep(self.probe_delay)
+        return dict(self.catalog[self.Bot.extract_video_id(video_url)])
+
+    async def feed(self, **update) -> None:
+        types = self.Bot.types
+        await self.Bot.dp.feed_update(self.Bot.bot, types.Update(update_id=next(self.update_ids), **update))
+
+    def message(self, chat_id: int, text: str):
+        types = self.Bot.types
+        return types.Message(
+            message_id=next(self.message_ids), date=datetime.now(),
+            chat=types.Chat(id=chat_id, type='private'),
+            from_user=types.User(id=chat_id, is_bot=False, first_name='bench'),
+            text=text,
+        )
+
+    async def run_job(self, chat_id: int, video_id: str) -> None:
+        types = self.Bot.types
+        link = self.message(chat_id, f"https://youtu.be/{video_id}")
+        await self.feed(message=link)
+        started = time.monotonic()
+        await self.feed(callback_query=types.CallbackQuery(
+            id=str(next(self.update_ids)), from_user=link.from_user, chat_instance='bench',
+            data=f"speed:{self.speed}", message=link,
+        ))
+        first_audio = None
+        while True:
+            events = self.server.chat_events(chat_id, since=started)
+            if first_audio is None:
+                first_audio = next((e.t for e in events if e.method in ('sendAudio', 'sendDocument')), None)
+            done = next((e for e in events if e.method == 'sendMessage' and e.text.startswith(DONE_PREFIXES)), None)
+            if done is not None:
+                break
+            await asyncio.sleep(0.02)
+        if done.text.startswith("Готово") and first_audio is not None:
+            self.ttfs.append(first_audio - started)
+            self.latency.append(done.t - started)
+        else:
+            self.failed += 1
+            print(f"  чат {chat_id}, {video_id}: {done.text.splitlines()[0]}")
+
+    async def run_user(self, chat_id: int, video_ids: list[str]) -> None:
+        for video_id in video_ids:
+            await self.run_job(chat_id, video_id)
+
+
+async def sample_usage(Bot, peaks: dict) -> None:
+    while True:
+        disk = Bot._dir_size(Bot.TMP_DIR) + Bot._dir_size(Bot.CACHE_DIR)
+        peaks['disk'] = max(peaks['disk'], disk)
+        peaks['rss'] = max(peaks['rss'], rss_tree_bytes())
+        await asyncio.sleep(0.25)
+
+
+async def run(args, Bot, server: FakeTelegram, harness: Harness) -> float:
+    peaks = {'disk': 0, 'rss': 0}
+    sampler = asyncio.create_task(sample_usage(Bot, peaks))
+    workers = [asyncio.create_task(Bot.task_worker(i)) for i in range(Bot.WORKERS)]
+    videos = iter(harness.catalog)
+    users = [
+        harness.run_user(1000 + u, [next(videos) for _ in range(args.videos_per_user)])
+        for u in range(args.users)
+    ]
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*users)
+    finally:
+        wall = time.monotonic() - started
+        for task in [sampler, *workers]:
+            task.cancel()
+        await asyncio.gather(sampler, *workers, return_exceptions=True)
+        await Bot.bot.session.close()
+    harness.peaks = peaks
+    return wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--videos-per-user', type=int, default=2)
+    parser.add_argument('--durations', default='600,1800', help='длины синтетических видео, с (по кругу)')
+    parser.add_argument('--codecs', default='opus,aac', help=f"кодеки источника: {', '.join(CODECS)}")
+    parser.add_argument('--speed', type=float, default=1.5)
+    parser.add_argument('--segment-min', type=float, default=10, help='длина сегмента, мин')
+    parser.add_argument('--workers', type=int, default=None, help='по умолчанию — как в Bot.py')
+    parser.add_argument('--ffmpeg-processes', type=int, default=None)
+    parser.add_argument('--api-latency-ms', type=float, default=50)
+    parser.add_argument('--uplink-mbps', type=float, default=20.0, help='аплинк к Bot API')
+    parser.add_argument('--downlink-mbps', type=float, default=0.0, help='скорость «YouTube», 0 — без ограничения')
+    parser.add_argument('--telegram-chat-rate', type=float, default=0.0,
+                        help='flood control заглушки: сообщений/с в чат, чаще — 429 (0 — выключен)')
+    parser.add_argument('--probe-ms', type=float, default=300, help='задержка извлечения метаданных')
+    args = parser.parse_args()
+
+    server = FakeTelegram(args.api_latency_ms / 1000, args.uplink_mbps, args.downlink_mbps, args.telegram_chat_rate)
+    server.start()
+    tmp = Path(tempfile.mkdtemp(prefix="bench_e2e_"))
+    extra = {
+        'telegram_api_server': server.api_base,
+        'segment_length_ms': int(args.segment_min * 60 * 1000),
+        'streaming_ingest': True,
+        'task_queue_size': args.users * args.videos_per_user,
+        'metrics_port': 0,
+        'trace_log': str(tmp / 'traces.jsonl'),
+    }
+    if args.workers:
+        extra['workers'] = args.workers
+    if args.ffmpeg_processes:
+        extra['ffmpeg_processes'] = args.ffmpeg_processes
+    Bot = load_bot(extra)
+    harness = Harness(Bot, server, args.speed, args.probe_ms / 1000)
+    try:
+        durations = [int(d) for d in args.durations.split(',')]
+        codecs = args.codecs.split(',')
+        sources = {}
+        for duration, codec in itertools.product(durations, codecs):
+            encoder, ext, _ = CODECS[codec]
+            name = f"{codec}_{duration}.{ext}"
+            sources[duration, codec] = make_synthetic_audio(tmp / name, duration, codec=encoder, bitrate="128k")
+            server.media[name] = sources[duration, codec]
+        # Каждая задача — отдельное видео, чтобы не срабатывали кэш и склейка одинаковых задач
+        combos = itertools.cycle(sources)
+        for n in range(args.users * args.videos_per_user):
+            duration, codec = next(combos)
+            video_id = f"bench{n:06d}"
+            harness.catalog[video_id] = {
+                'id': video_id, 'title': f"bench {n}", 'duration': float(duration),
+                'url': server.media_url(sources[duration, codec].name), 'protocol': 'http',
+                'ext': CODECS[codec][1], 'acodec': CODECS[codec][2], 'format_id': 'bench',
+            }
+        Bot.probe_video = harness.fake_probe
+
+        wall = asyncio.run(run(args, Bot, server, harness))
+    finally:
+        server.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    jobs = len(harness.latency)
+    uploaded = sum(e.size for e in server.events if e.method in ('sendAudio', 'sendDocument'))
+    print(f"Пользователей {args.users} × {args.videos_per_user} видео, {args.durations} с, {args.codecs}, "
+          f"{args.speed}×; воркеров {Bot.WORKERS}, ffmpeg {Bot.FFMPEG_PROCESSES}")
+    print(f"Задач: {jobs} успешно, {harness.failed} с ошибкой за {wall:.1f} с → {jobs / wall * 3600:.0f} задач/ч")
+    print(f"TTFS:  p50 {percentile(harness.ttfs, 50):.2f} с, p99 {percentile(harness.ttfs, 99):.2f} с")
+    print(f"Задача: p50 {percentile(harness.latency, 50):.2f} с, p99 {percentile(harness.latency, 99):.2f} с")
+    print(f"Пик диска (tmp + кэш): {harness.peaks['disk'] / 1e6:.1f} МБ, "
+          f"пик RSS (бот + ffmpeg): {harness.peaks['rss'] / 1e6:.1f} МБ "
+          f"(ru_maxrss бота {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} МБ)")
+    print(f"Выгружено в Bot API: {uploaded / 1e6:.1f} МБ, ответов 429: {server.flood_errors}")
+    for line in Bot.stage_seconds.render():
+        if line.startswith('ytbot_stage_seconds_sum') or line.startswith('ytbot_stage_seconds_count'):
+            print(f"  {line}")
+
+
+if __name__ == '__main__':
+    main()
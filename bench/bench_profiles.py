@@ -0,0 +1,62 @@
+"""Таблица по профилям вывода: время кодирования и объём, который уйдёт в Telegram.
+
+Для каждого профиля из OUTPUT_PROFILES (плюс stream copy на 1.0×) нарезает одно и то же
+синтетическое аудио через segment_audio и считает wall/CPU время и байты сегментов.
+Пример:
+    python bench/bench_profiles.py --duration 3600 --speed 1.5 --uplink-mbps 20
+"""
+import argparse
+import asyncio
+import contextlib
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from _common import child_cpu_seconds, load_bot, make_synthetic_audio
+
+
+async def render(Bot, input_file: str, audio_args: list[str], ext: str, out_dir: Path) -> int:
+    total = 0
+    async with contextlib.aclosing(Bot.segment_audio(input_file, audio_args, ext, out_dir, "bench")) as segments:
+        async for path in segments:
+            total += path.stat().st_size
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=int, default=3600, help='длина синтетического аудио, с')
+    parser.add_argument('--speed', type=float, default=1.5)
+    parser.add_argument('--uplink-mbps', type=float, default=20.0, help='для оценки времени выгрузки')
+    args = parser.parse_args()
+
+    Bot = load_bot()
+    tmp = Path(tempfile.mkdtemp(prefix="bench_prof_"))
+    try:
+        # Источник как у YouTube bestaudio: Opus в WebM
+        src = make_synthetic_audio(tmp / "input.webm", args.duration, codec="libopus", bitrate="128k")
+        runs = []
+        for name, profile in Bot.OUTPUT_PROFILES.items():
+            Bot.OUTPUT_PROFILE_NAME, Bot.OUTPUT_PROFILE = name, profile
+            runs.append((f"{name} {args.speed}×", *Bot.output_plan(args.speed, None)))
+        runs.append(("copy 1.0×", *Bot.output_plan(1.0, "opus")))
+
+        print(f"Вход: {args.duration} с Opus/WebM, аплинк {args.uplink_mbps} Мбит/с")
+        print(f"| {'профиль':<16} | {'wall, с':>8} | {'cpu, с':>8} | {'МБ':>8} | {'выгрузка, с':>11} |")
+        print(f"|{'-' * 18}|{'-' * 10}|{'-' * 10}|{'-' * 10}|{'-' * 13}|")
+        for label, audio_args, ext in runs:
+            out_dir = tmp / label.replace(' ', '_')
+            out_dir.mkdir()
+            cpu0, wall0 = child_cpu_seconds(), time.perf_counter()
+            size = asyncio.run(render(Bot, str(src), audio_args, ext, out_dir))
+            wall, cpu = time.perf_counter() - wall0, child_cpu_seconds() - cpu0
+            upload = size * 8 / (args.uplink_mbps * 1e6)
+            print(f"| {label:<16} | {wall:>8.2f} | {cpu:>8.2f} | {size / 1e6:>8.2f} | {upload:>11.1f} |")
+            shutil.rmtree(out_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
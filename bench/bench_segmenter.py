@@ -0,0 +1,76 @@
+"""Сравнение нарезки: отдельный ffmpeg на каждый сегмент против одного прохода segment_audio.
+
+Пример:
+    python bench/bench_segmenter.py --duration 10800 --speed 1.5
+"""
+import argparse
+import asyncio
+import contextlib
+import math
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from _common import child_cpu_seconds, load_bot, make_synthetic_audio
+
+
+def legacy_per_segment(Bot, input_file: str, filter_str: str, speed: float, duration: float, out_dir: Path) -> int:
+    """Прежний путь process_video: `ffmpeg -ss start -t duration -i input` на каждый сегмент."""
+    segment_in_s = Bot.SEGMENT_S * speed
+    total = math.ceil(duration / segment_in_s)
+    for i in range(total):
+        cmd = [
+            'ffmpeg', '-y', '-v', 'error', '-ss', str(i * segment_in_s), '-t', str(segment_in_s),
+            '-i', input_file, '-filter:a', filter_str, str(out_dir / f"{i+1:02d}__legacy.mp3"),
+        ]
+        subprocess.run(cmd, check=True, capture_output=True)
+    return total
+
+
+async def single_pass(Bot, input_file: str, speed: float, out_dir: Path) -> int:
+    count = 0
+    audio_args, ext = Bot.output_plan(speed, None)
+    async with contextlib.aclosing(Bot.segment_audio(input_file, audio_args, ext, out_dir, "single")) as segments:
+        async for _ in segments:
+            count += 1
+    return count
+
+
+def measure(label: str, fn):
+    cpu0, wall0 = child_cpu_seconds(), time.perf_counter()
+    count = fn()
+    wall, cpu = time.perf_counter() - wall0, child_cpu_seconds() - cpu0
+    print(f"{label:<14} {count:>9} {wall:>10.2f} {cpu:>10.2f}")
+    return wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=int, default=3 * 3600, help='длина синтетического аудио, с')
+    parser.add_argument('--speed', type=float, default=1.5)
+    parser.add_argument('--segment-ms', type=int, default=10 * 60 * 1000)
+    args = parser.parse_args()
+
+    Bot = load_bot({"segment_length_ms": args.segment_ms})
+    tmp = Path(tempfile.mkdtemp(prefix="bench_seg_"))
+    try:
+        src = make_synthetic_audio(tmp / "input.webm", args.duration)
+        filter_str = Bot.atempo_filter(args.speed)
+        legacy_dir, single_dir = tmp / "legacy", tmp / "single"
+        legacy_dir.mkdir()
+        single_dir.mkdir()
+
+        print(f"Вход: {args.duration} с, скорость {args.speed}×, сегмент {args.segment_ms // 1000} с")
+        print(f"{'путь':<14} {'сегментов':>9} {'wall, с':>10} {'cpu, с':>10}")
+        lw, lc = measure("per-segment", lambda: legacy_per_segment(
+            Bot, str(src), filter_str, args.speed, args.duration, legacy_dir))
+        sw, sc = measure("single-pass", lambda: asyncio.run(single_pass(Bot, str(src), args.speed, single_dir)))
+        print(f"Ускорение: wall ×{lw / sw:.2f}, cpu ×{lc / sc:.2f}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Точки реза по паузам: огибающая RMS на NumPy против ffmpeg silencedetect.
+
+Генерирует синтетическую «речь» (тон с неровными паузами поверх тихого шума) и ищет
+точку реза у каждой границы сегмента тремя способами:
+  numpy            — Bot.analyze_cut_points: один ffmpeg декодирует только окна вокруг
+                     границ в PCM 8 кГц, огибающая RMS — на NumPy;
+  silencedetect    — один проход ffmpeg -af silencedetect по всему файлу;
+  silencedetect/b  — отдельный ffmpeg -ss ... silencedetect на окно каждой границы.
+Для каждого способа — wall/CPU время и громкость в точках реза (чем тише, тем лучше;
+«в звуке» — точки громче -30 дБ).
+Пример:
+    python bench/bench_silence.py --duration 10800 --speed 1.5 --window 15
+"""
+import argparse
+import math
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from _common import child_cpu_seconds, load_bot
+
+NOISE_DB = -30
+MIN_SILENCE_S = 0.25
+
+
+def make_speechlike_audio(path: Path, duration_s: int) -> Path:
+    """Тон с модуляцией и неровными паузами (сумма двух синусов ниже порога) плюс тихий шум."""
+    speech = ("0.5*sin(2*PI*180*t)*(0.6+0.4*sin(2*PI*3*t))"
+              "*gt(sin(2*PI*t/5.3)+sin(2*PI*t/2.9)\\,-0.8)")
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f"aevalsrc=exprs='{speech}':s=48000:d={duration_s}",
+        '-f', 'lavfi', '-i', f'anoisesrc=color=pink:amplitude=0.005:duration={duration_s}',
+        '-filter_complex', 'amix=inputs=2:normalize=0', '-ac', '1',
+        '-c:a', 'libopus', '-b:a', '64k', str(path),
+    ]
+    subprocess.run(cmd, check=True)
+    return path
+
+
+def parse_silences(stderr: str, offset: float = 0.0) -> list[tuple[float, float]]:
+    starts = [float(x) for x in re.findall(r'silence_start: (-?[\d.]+)', stderr)]
+    ends = [float(x) for x in re.findall(r'silence_end: (-?[\d.]+)', stderr)]
+    return [(s + offset, e + offset) for s, e in zip(starts, ends)]
+
+
+def nearest_silence(silences, boundary: float, window: float) -> float:
+    """Середина паузы, ближайшей к границе в пределах окна; иначе сама граница."""
+    best = None
+    for start, end in silences:
+        mid = (max(start, boundary - window) + min(end, boundary + window)) / 2
+        if abs(mid - boundary) <= window and (best is None or abs(mid - boundary) < abs(best - boundary)):
+            best = mid
+    return boundary if best is None else best
+
+
+def silencedetect_full(src: Path, boundaries, window: float) -> list[float]:
+    cmd = ['ffmpeg', '-v', 'info', '-nostats', '-i', str(src),
+           '-af', f'silencedetect=noise={NOISE_DB}dB:d={MIN_SILENCE_S}', '-f', 'null', '-']
+    stderr = subprocess.run(cmd, capture_output=True, text=True, errors='ignore').stderr
+    silences = parse_silences(stderr)
+    return [nearest_silence(silences, b, window) for b in boundaries]
+
+
+def silencedetect_per_boundary(src: Path, boundaries, window: float) -> list[float]:
+    cuts = []
+    for b in boundaries:
+        start = max(0.0, b - window)
+        cmd = ['ffmpeg', '-v', 'info', '-nostats', '-ss', str(start), '-t', str(2 * window), '-i', str(src),
+               '-af', f'silencedetect=noise={NOISE_DB}dB:d={MIN_SILENCE_S}', '-f', 'null', '-']
+        stderr = subprocess.run(cmd, capture_output=True, text=True, errors='ignore').stderr
+        cuts.append(nearest_silence(parse_silences(stderr, offset=start), b, window))
+    return cuts
+
+
+def levels_at(src: Path, cuts: list[float], rate: int = 8000) -> np.ndarray:
+    """Громкость (дБ) в окне 100 мс вокруг каждой точки реза."""
+    out = []
+    for c in cuts:
+        pcm = subprocess.run(['ffmpeg', '-v', 'error', '-ss', str(max(0.0, c - 0.05)), '-t', '0.1', '-i', str(src),
+                              '-ac', '1', '-ar', str(rate), '-f', 's16le', '-'], capture_output=True, check=True).stdout
+        chunk = np.frombuffer(pcm, dtype='<i2').astype(np.float32) / 32768
+        out.append(10 * math.log10(float(np.mean(chunk * chunk)) + 1e-10) if chunk.size else 0.0)
+    return np.array(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=int, default=3600, help='длина синтетического аудио, с')
+    parser.add_argument('--speed', type=float, default=1.5)
+    parser.add_argument('--window', type=float, default=15, help='окно поиска ±, с результата')
+    args = parser.parse_args()
+
+    Bot = load_bot({"metrics_port": 0})
+    tmp = Path(tempfile.mkdtemp(prefix="bench_silence_"))
+    try:
+        src = make_speechlike_audio(tmp / "speech.webm", args.duration)
+        segment_in_s = Bot.SEGMENT_S * args.speed
+        window = min(args.window * args.speed, segment_in_s / 2)
+        boundaries = [k * segment_in_s for k in range(1, math.ceil(args.duration / segment_in_s))]
+        methods = [
+            ('numpy', lambda: Bot.analyze_cut_points(str(src), args.duration, segment_in_s, window)),
+            ('silencedetect', lambda: silencedetect_full(src, boundaries, window)),
+            ('silencedetect/b', lambda: silencedetect_per_boundary(src, boundaries, window)),
+        ]
+        print(f"Вход: {args.duration} с, {len(boundaries)} границ, окно ±{window:.1f} с входа")
+        print(f"| {'способ':<16} | {'wall, с':>8} | {'cpu, с':>8} | {'медиана, дБ':>11} | {'в звуке':>7} |")
+        print(f"|{'-' * 18}|{'-' * 10}|{'-' * 10}|{'-' * 13}|{'-' * 9}|")
+        nominal = levels_at(src, boundaries)
+        print(f"| {'фикс. границы':<16} | {'—':>8} | {'—':>8} | {np.median(nominal):>11.1f} | "
+              f"{int((nominal > NOISE_DB).sum()):>7} |")
+        for name, run in methods:
+            cpu0, proc0, wall0 = child_cpu_seconds(), time.process_time(), time.perf_counter()
+            cuts = run()
+            wall = time.perf_counter() - wall0
+            cpu = child_cpu_seconds() - cpu0 + time.process_time() - proc0
+            levels = levels_at(src, cuts)
+            print(f"| {name:<16} | {wall:>8.2f} | {cpu:>8.2f} | {np.median(levels):>11.1f} | "
+                  f"{int((levels > NOISE_DB).sum()):>7} |")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
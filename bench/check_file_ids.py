@@ -0,0 +1,141 @@
+"""Проверка повторной отправки по file_id против FakeTelegram (без сети и токена).
+
+Одно и то же видео на одной скорости прогоняется через настоящие submit_task/task_worker
+несколько раз:
+  1. первый прогон — сегменты загружаются в Bot API, file_id запоминаются;
+  2. повтор — ни одной multipart-загрузки, file_ids.hits == число сегментов;
+  3. FakeTelegram отвергает старые file_id (stale_file_ids) — каждый сегмент
+     загружается заново, повтор после этого снова обходится без загрузок.
+Прогоняется для профиля mp3 (Telegram хранит аудио) и для stream copy Opus на 1.0×
+(OGG — Telegram хранит документ, его file_id sendAudio не принимает).
+Код возврата 1, если какая-то проверка не прошла.
+Пример:
+    python bench/check_file_ids.py --duration 180 --segment-s 60
+"""
+import argparse
+import asyncio
+import math
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+from _common import load_bot, make_synthetic_audio
+from fake_telegram import FakeTelegram
+
+CASES = [
+    # (название, скорость, кодек источника, расширение, acodec)
+    ('mp3 1.5×', 1.5, 'libopus', 'webm', 'opus'),
+    ('copy Opus 1.0× (документ)', 1.0, 'libopus', 'webm', 'opus'),
+]
+
+
+async def run_once(Bot, server: FakeTelegram, chat_id: int, url: str, video_id: str, speed: float) -> str:
+    """Одна задача от начала до итогового сообщения; возвращает его текст."""
+    since = len(server.events)
+    await Bot.submit_task(url, video_id, chat_id, 1, speed)
+    while True:
+        done = [e for e in server.events[since:] if e.chat_id == chat_id and e.method == 'sendMessage'
+                and e.text.startswith(("Готово", "❌"))]
+        if done:
+            return done[0].text
+        await asyncio.sleep(0.05)
+
+
+async def check(Bot, server: FakeTelegram, video_id: str, speed: float, expected: int) -> list[str]:
+    url = Bot.canonical_video_url(video_id)
+    worker = asyncio.create_task(Bot.task_worker(0))
+    problems = []
+
+    def expect(ok: bool, what: str) -> None:
+        print(f"  {'ок ' if ok else 'НЕТ'} {what}")
+        if not ok:
+            problems.append(what)
+
+    try:
+        uploads = server.uploads
+        text = await run_once(Bot, server, 1, url, video_id, speed)
+        # Хвост источника может дать ещё один короткий сегмент — N берём из первого прогона
+        segments = server.uploads - uploads
+        expect(text == "Готово!" and segments >= expected,
+               f"первый прогон: {segments} загрузок (ожидалось не меньше {expected}), «{text}»")
+
+        uploads, hits = server.uploads, Bot.file_ids.hits
+        text = await run_once(Bot, server, 2, url, video_id, speed)
+        expect(text == "Готово!" and server.uploads == uploads and Bot.file_ids.hits - hits == segments,
+               f"повтор: {server.uploads - uploads} загрузок, hits {Bot.file_ids.hits - hits} из {segments}")
+
+        server.stale_file_ids = True
+        uploads, stale = server.uploads, Bot.file_ids.stale
+        text = await run_once(Bot, server, 3, url, video_id, speed)
+        server.stale_file_ids = False
+        expect(text == "Готово!" and server.uploads - uploads == segments and Bot.file_ids.stale > stale,
+               f"устаревшие file_id: {server.uploads - uploads} новых загрузок из {segments}, "
+               f"отвергнуто {Bot.file_ids.stale - stale}")
+
+        uploads, hits = server.uploads, Bot.file_ids.hits
+        text = await run_once(Bot, server, 4, url, video_id, speed)
+        expect(text == "Готово!" and server.uploads == uploads and Bot.file_ids.hits - hits == segments,
+               f"повтор с новыми file_id: {server.uploads - uploads} загрузок, hits {Bot.file_ids.hits - hits}")
+    finally:
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+    return problems
+
+
+async def run_all(Bot, server: FakeTelegram, cases: list[tuple[str, float, str, int]]) -> list[str]:
+    problems = []
+    try:
+        for name, speed, video_id, expected in cases:
+            print(name)
+            problems += await check(Bot, server, video_id, speed, expected)
+    finally:
+        await Bot.bot.session.close()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=int, default=180, help='длина синтетического аудио, с')
+    parser.add_argument('--segment-s', type=int, default=60, help='длина сегмента результата, с')
+    args = parser.parse_args()
+
+    server = FakeTelegram(latency=0.01, uplink_mbps=0)
+    server.start()
+    tmp = Path(tempfile.mkdtemp(prefix="check_file_ids_"))
+    Bot = load_bot({
+        'telegram_api_server': server.api_base,
+        'segment_length_ms': args.segment_s * 1000,
+        'stream_copy': True,
+        'metrics_port': 0,
+        'ydl_warmup_url': '',
+        'trace_log': str(tmp / 'traces.jsonl'),
+    })
+    try:
+        cases = []
+        probes = {}
+        for n, (name, speed, codec, ext, acodec) in enumerate(CASES):
+            src = make_synthetic_audio(tmp / f"src{n}.{ext}", args.duration, codec=codec)
+            server.media[src.name] = src
+            video_id = f"check{n:06d}"
+            probes[video_id] = {
+                'id': video_id, 'title': f"check {n}", 'duration': float(args.duration),
+                'url': server.media_url(src.name), 'protocol': 'http', 'ext': ext, 'acodec': acodec,
+                'format_id': 'check',
+            }
+            # Сегментов в результате не меньше, чем целых отрезков длительности на этой скорости
+            cases.append((name, speed, video_id, math.floor(args.duration / speed / args.segment_s)))
+        Bot.probe_video = lambda url: dict(probes[Bot.extract_video_id(url)])
+        problems = asyncio.run(run_all(Bot, server, cases))
+    finally:
+        server.stop()
+        Bot.ydl_pool.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+    if problems:
+        print(f"Не прошло проверок: {len(problems)}")
+        sys.exit(1)
+    print("Все проверки прошли")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Проверка общей очереди с отдельными воркерами: аренда, повторная выдача, adopt.
+
+Брокер (make_broker_app над SqliteJobQueue) работает в этом процессе, рядом —
+FakeTelegram, который раздаёт синтетическое аудио и принимает сегменты. Два воркера
+(python Bot.py --worker с queue_backend: http) запускаются отдельными процессами на
+общих job_db и cache_dir. Когда в чат доставлено --kill-after сегментов, воркер с
+задачей убивается SIGKILL, без release. Проверяется, что:
+  1. после истечения аренды задачу получает второй воркер (attempts = 2);
+  2. он продолжает с сегмента, следующего за последним доставленным, — ни один
+     доставленный сегмент не загружается заново, ни один не пропущен (загрузка,
+     которую убитый воркер не успел отметить, может повториться — одна);
+  3. adopt берёт папку и исходник умершего воркера: аудио не качается второй раз,
+     исходное сообщение заново не пересылается;
+  4. «Готово!» приходит один раз, задача уходит из очереди.
+Код возврата 1, если какая-то проверка не прошла.
+Пример:
+    python bench/check_queue.py --duration 240 --segment-s 30 --lease-s 3
+"""
+import argparse
+import asyncio
+import json
+import math
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+from _common import load_bot, make_synthetic_audio
+from fake_telegram import FakeTelegram
+
+TOKEN = "check-queue"
+CHAT_ID = 1
+SPEED = 1.5
+JOB_ID = "checkqueue01"
+VIDEO_ID = "checkqueue1"
+
+
+def run_worker(config_path: str) -> None:
+    """Режим дочернего процесса: воркер очереди с подменённым probe_video."""
+    spec = json.loads(Path(config_path).read_text(encoding='utf-8'))
+    Bot = load_bot(spec['cfg'])
+    Bot.probe_video = lambda url: dict(spec['probe'])
+    asyncio.run(Bot.main_worker())
+
+
+def queue_row(db: Path) -> dict | None:
+    with sqlite3.connect(str(db)) as conn:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute('SELECT worker, attempts, last_segment FROM queue WHERE id=?', (JOB_ID,)).fetchone()
+    return dict(row) if row else None
+
+
+def segment_number(event) -> int:
+    return int(re.match(r'(\d+)__', event.name).group(1))
+
+
+async def wait_for(predicate, timeout: float, step: float = 0.1) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(step)
+    return False
+
+
+async def run_check(Bot, server: FakeTelegram, tmp: Path, shared: dict, probe: dict, source_size: int,
+                    args) -> list[str]:
+    problems = []
+
+    def expect(ok: bool, what: str) -> None:
+        print(f"  {'ок ' if ok else 'НЕТ'} {what}")
+        if not ok:
+            problems.append(what)
+
+    def uploads() -> list:
+        return [e for e in server.chat_events(CHAT_ID) if e.method in ('sendAudio', 'sendDocument') and e.name]
+
+    def finished() -> list[str]:
+        return [e.text for e in server.chat_events(CHAT_ID)
+                if e.method == 'sendMessage' and e.text.startswith(("Готово", "❌"))]
+
+    runner = web.AppRunner(Bot.make_broker_app(Bot.job_queue, TOKEN), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    spec = tmp / 'worker.json'
+    spec.write_text(json.dumps({
+        'cfg': {**shared, 'queue_backend': 'http', 'queue_url': f"http://127.0.0.1:{port}", 'queue_token': TOKEN},
+        'probe': probe,
+    }), encoding='utf-8')
+    # cwd — временная папка: туда пишут bot.log оба воркера
+    workers = {}
+    for _ in range(2):
+        proc = subprocess.Popen([sys.executable, __file__, '--worker-config', str(spec)], cwd=str(tmp),
+                                stdout=subprocess.DEVNULL)
+        workers[proc.pid] = proc
+    try:
+        await Bot.job_queue.submit({
+            'id': JOB_ID, 'chat_id': CHAT_ID, 'url': Bot.canonical_video_url(VIDEO_ID),
+            'video_id': VIDEO_ID, 'speed': SPEED, 'orig_msg_id': 1,
+        })
+        if not await wait_for(lambda: len(uploads()) >= args.kill_after, args.timeout):
+            expect(False, f"за {args.timeout} с не доставлено {args.kill_after} сегментов")
+            return problems
+        row = queue_row(Bot.QUEUE_DB)
+        first = int(row['worker'].rpartition(':')[2])
+        workers[first].kill()
+        workers[first].wait()
+        delivered = (Bot.job_store.get(JOB_ID) or {}).get('last_segment', 0)
+        print(f"  воркер {row['worker']} убит после сегмента {delivered}")
+
+        claims = []
+
+        def claimed_again() -> bool:
+            current = queue_row(Bot.QUEUE_DB)
+            if current and current['worker'] and current['worker'] != row['worker']:
+                claims.append(current)
+            return bool(claims)
+
+        await wait_for(claimed_again, args.lease_s * 3 + 10)
+        # Всё, что пришло до повторной выдачи, загрузил убитый воркер (в том числе загрузка «в полёте»)
+        killed_at = len(uploads())
+        expect(bool(claims) and claims[0]['attempts'] == 2,
+               f"повторная выдача после аренды: {claims[0] if claims else 'нет'}")
+        await wait_for(lambda: finished(), args.timeout)
+        await asyncio.sleep(args.lease_s)
+
+        before = [segment_number(e) for e in uploads()[:killed_at]]
+        after = [segment_number(e) for e in uploads()[killed_at:]]
+        total = max(before + after)
+        expect(total >= math.floor(args.duration / SPEED / args.segment_s),
+               f"сегментов {total} (ожидалось не меньше {math.floor(args.duration / SPEED / args.segment_s)})")
+        expect(bool(after) and after == list(range(delivered + 1, total + 1)) and len(before) - delivered <= 1
+               and sorted(set(before + after)) == list(range(1, total + 1)),
+               f"продолжение с сегмента {delivered + 1}: до {before}, после {after}")
+        forwards = sum(e.method == 'forwardMessage' for e in server.chat_events(CHAT_ID))
+        expect(server.media_bytes == source_size and forwards == 1,
+               f"adopt: скачано {server.media_bytes} Б из {source_size}, пересылок исходного сообщения {forwards}")
+        done = finished()
+        expect(done == ["Готово!"], f"итог: {done}")
+        expect(await Bot.job_queue.known([JOB_ID]) == [], "задача ушла из очереди")
+    finally:
+        for proc in workers.values():
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in workers.values():
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        await runner.cleanup()
+        await Bot.bot.session.close()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=int, default=240, help='длина синтетического аудио, с')
+    parser.add_argument('--segment-s', type=int, default=30, help='длина сегмента результата, с')
+    parser.add_argument('--lease-s', type=float, default=3, help='queue_lease_s воркеров')
+    parser.add_argument('--kill-after', type=int, default=2, help='после скольких доставленных сегментов убить воркер')
+    parser.add_argument('--uplink-mbps', type=float, default=2, help='аплинк FakeTelegram: задача должна идти долго')
+    parser.add_argument('--timeout', type=float, default=180, help='сколько ждать каждого этапа, с')
+    parser.add_argument('--worker-config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker_config:
+        run_worker(args.worker_config)
+        return
+
+    server = FakeTelegram(latency=0.01, uplink_mbps=args.uplink_mbps)
+    server.start()
+    tmp = Path(tempfile.mkdtemp(prefix="check_queue_"))
+    src = make_synthetic_audio(tmp / "src.webm", args.duration)
+    server.media[src.name] = src
+    probe = {
+        'id': VIDEO_ID, 'title': "check queue", 'duration': float(args.duration),
+        'url': server.media_url(src.name), 'protocol': 'http', 'ext': 'webm', 'acodec': 'opus',
+        'format_id': 'check',
+    }
+    # Общие для брокера и обоих воркеров: одна машина — одни job_db и cache_dir
+    shared = {
+        'telegram_api_server': server.api_base,
+        'segment_length_ms': args.segment_s * 1000,
+        'workers': 1,
+        'queue_lease_s': args.lease_s,
+        'queue_poll_s': 0.2,
+        'metrics_port': 0,
+        'ydl_warmup_url': '',
+        'cache_dir': str(tmp / 'cache'),
+        'file_id_db': str(tmp / 'file_ids.sqlite3'),
+        'job_db': str(tmp / 'jobs.sqlite3'),
+        'queue_db': str(tmp / 'queue.sqlite3'),
+    }
+    Bot = load_bot({**shared, 'queue_backend': 'sqlite'})
+    try:
+        problems = asyncio.run(run_check(Bot, server, tmp, shared, probe, src.stat().st_size, args))
+    finally:
+        server.stop()
+        Bot.ydl_pool.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+    if problems:
+        print(f"Не прошло проверок: {len(problems)}")
+        sys.exit(1)
+    print("Все проверки прошли")
+
+
+if __name__ == '__main__':
+    main()
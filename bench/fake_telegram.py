@@ -0,0 +1,213 @@
+"""Заглушка Bot API и источника аудио для офлайн-бенчмарков.
+
+FakeTelegram принимает вызовы бота (sendAudio, sendDocument, sendMessage, forwardMessage и
+служебные deleteMessage/answerCallbackQuery/getMe) с заданной задержкой и пропускной
+способностью аплинка и записывает их по чатам. Как настоящий Telegram, файлы с
+расширением из document_exts (OGG) сохраняются документом, а file_id документа
+sendAudio отвергает (400); stale_file_ids=True отвергает любой ранее выданный file_id,
+как после его устаревания. Тот же сервер раздаёт синтетическое аудио по
+/media/<имя> с поддержкой Range — как googlevideo для stream_download.
+Скорость раздачи ограничивается на каждое соединение, а media_connections задаёт,
+сколько соединений сервер терпит одновременно: лишние получают 429, как у googlevideo.
+Сервер работает в отдельном потоке со своим event loop, чтобы не мешать боту.
+"""
+import asyncio
+import itertools
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from aiohttp import web
+
+BLOCK = 64 * 1024
+SENDS = ('sendAudio', 'sendDocument', 'sendMessage', 'forwardMessage')
+
+
+@dataclass
+class Event:
+    t: float
+    chat_id: int
+    method: str
+    text: str = ''
+    size: int = 0
+    # Имя загруженного файла (sendAudio/sendDocument с multipart)
+    name: str = ''
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.05, uplink_mbps: float = 20.0, downlink_mbps: float = 0.0,
+                 chat_rate: float = 0.0, media_connections: int = 0, document_exts: tuple[str, ...] = ('.ogg',)):
+        self.latency = latency
+        self.uplink_mbps = uplink_mbps
+        # 0 — раздача без ограничения скорости
+        self.downlink_mbps = downlink_mbps
+        # Как flood control Telegram: чаще chat_rate сообщений в секунду в один чат — 429 (0 — без лимита)
+        self.chat_rate = chat_rate
+        self._last_send: dict[int, float] = {}
+        self.flood_errors = 0
+        # 0 — без ограничения числа одновременных загрузок /media
+        self.media_connections = media_connections
+        self._media_active = 0
+        self.media_peak = 0
+        self.media_throttled = 0
+        # Сколько байт аудио раздано — по нему видно, качался ли исходник заново
+        self.media_bytes = 0
+        self.media: dict[str, Path] = {}
+        self.events: list[Event] = []
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1_000_000)
+        self._file_ids = itertools.count(1)
+        self.document_exts = document_exts
+        # Выданные file_id -> 'audio' | 'document'
+        self.issued: dict[str, str] = {}
+        self.stale_file_ids = False
+        self.uploads = 0
+        self.rejected_file_ids = 0
+        self._runner: web.AppRunner | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self.port = 0
+
+    # --- Bot API ---
+    async def _api(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        form = await request.post()
+        # Тело multipart приходит chunked, поэтому размер считаем по самим файлам
+        size = sum(v.file.seek(0, 2) for v in form.values() if isinstance(v, web.FileField))
+        delay = self.latency + (size * 8 / (self.uplink_mbps * 1e6) if size and self.uplink_mbps else 0)
+        await asyncio.sleep(delay)
+
+        chat_id = int(form.get('chat_id') or 0)
+        if self.chat_rate and method in SENDS:
+            now, last = time.monotonic(), self._last_send.get(chat_id, 0.0)
+            if now - last < 1 / self.chat_rate:
+                self.flood_errors += 1
+                retry_after = max(1, round(1 / self.chat_rate))
+                return web.json_response({
+                    'ok': False, 'error_code': 429, 'parameters': {'retry_after': retry_after},
+                    'description': f"Too Many Requests: retry after {retry_after}",
+                })
+            self._last_send[chat_id] = now
+        media = form.get('audio') if method == 'sendAudio' else form.get('document')
+        if isinstance(media, str) and media.startswith('attach://'):
+            # aiogram кладёт файл в отдельное поле и ссылается на него attach://<имя>
+            media = form.get(media[len('attach://'):])
+        if method in ('sendAudio', 'sendDocument') and isinstance(media, str):
+            # Повторная отправка по file_id: устаревший или документ через sendAudio — 400
+            kind = self.issued.get(media)
+            if kind is None or self.stale_file_ids or (method == 'sendAudio' and kind == 'document'):
+                self.rejected_file_ids += 1
+                return web.json_response({
+                    'ok': False, 'error_code': 400,
+                    'description': "Bad Request: wrong file identifier/HTTP URL specified",
+                }, status=400)
+        name = (media.filename or '') if isinstance(media, web.FileField) else ''
+        self._record(Event(time.monotonic(), chat_id, method, str(form.get('text') or ''), size, name))
+        if method in SENDS:
+            result = {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+            }
+            if method == 'sendMessage':
+                result['text'] = str(form.get('text') or '')
+            elif isinstance(media, str):
+                kind = self.issued[media]
+                result[kind] = {'file_id': media, 'file_unique_id': media, **({'duration': 0} if kind == 'audio' else {})}
+            elif media is not None:
+                self.uploads += 1
+                kind = 'document' if Path(media.filename or '').suffix in self.document_exts else 'audio'
+                file_id = f"fake-{kind}-{next(self._file_ids)}"
+                self.issued[file_id] = kind
+                result[kind] = {'file_id': file_id, 'file_unique_id': file_id, **({'duration': 0} if kind == 'audio' else {})}
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    # --- «googlevideo» ---
+    async def _media(self, request: web.Request) -> web.StreamResponse:
+        path = self.media.get(request.match_info['name'])
+        if path is None:
+            raise web.HTTPNotFound()
+        total = path.stat().st_size
+        rng = request.http_range
+        start = rng.start or 0
+        stop = min(rng.stop if rng.stop is not None else total, total)
+        if start >= total:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{total}'})
+        if self.media_connections and self._media_active >= self.media_connections:
+            self.media_throttled += 1
+            raise web.HTTPTooManyRequests(headers={'Retry-After': '1'})
+        self._media_active += 1
+        self.media_peak = max(self.media_peak, self._media_active)
+        try:
+            return await self._send_range(request, path, start, stop, total)
+        finally:
+            self._media_active -= 1
+
+    async def _send_range(self, request: web.Request, path: Path, start: int, stop: int,
+                          total: int) -> web.StreamResponse:
+        partial = 'Range' in request.headers
+        resp = web.StreamResponse(status=206 if partial else 200)
+        resp.content_length = stop - start
+        resp.content_type = 'application/octet-stream'
+        if partial:
+            resp.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{total}'
+        await resp.prepare(request)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = stop - start
+            while left > 0:
+                block = f.read(min(BLOCK, left))
+                left -= len(block)
+                self.media_bytes += len(block)
+                await resp.write(block)
+                if self.downlink_mbps:
+                    await asyncio.sleep(len(block) * 8 / (self.downlink_mbps * 1e6))
+        await resp.write_eof()
+        return resp
+
+    def _record(self, event: Event) -> None:
+        with self._lock:
+            self.events.append(event)
+
+    def chat_events(self, chat_id: int, since: float = 0.0) -> list[Event]:
+        with self._lock:
+            return [e for e in self.events if e.chat_id == chat_id and e.t >= since]
+
+    def media_url(self, name: str) -> str:
+        # c= — как у googlevideo: по нему метрики бота различают клиентов YouTube
+        return f"http://127.0.0.1:{self.port}/media/{name}?c=BENCH"
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    # --- Запуск в отдельном потоке ---
+    def start(self) -> None:
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            app = web.Application(client_max_size=1024 ** 3)
+            app.router.add_post('/bot{token}/{method}', self._api)
+            app.router.add_get('/media/{name}', self._media)
+            self._runner = web.AppRunner(app, access_log=None)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, '127.0.0.1', 0)
+            self._loop.run_until_complete(site.start())
+            self.port = site._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)